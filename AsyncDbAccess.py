@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from Cache import SingleFlight
+from DbAccess import DbUnavailable
+
+class AsyncDbAccess():
+    """Non-blocking Database Access
+
+    Wraps a DbAccess so every one of its methods returns a Deferred instead
+    of blocking the reactor. Calls run on a bounded pool of worker threads
+    and DbAccess opens one connection per thread, so the pool size is also
+    the maximum number of DB connections.
+
+    If the DB goes away, calls fail fast with DbUnavailable while a timer
+    keeps trying to reconnect in the background. At most maxPending calls
+    may be waiting for a worker; any more fail straight away so a stalled
+    DB can't build up an unbounded backlog.
+
+    With no reactor the calls run inline and return already-fired
+    Deferreds, which is handy for tests and scripts.
+    """
+
+    def __init__(self, db, reactor=None, minThreads=1, maxThreads=4, maxPending=100):
+        self.db = db
+        self.reactor = reactor
+        self.maxPending = maxPending
+        self.pending = 0
+        self.reconnectCall = None
+        self.seenFlush = None
+        self.tellChecks = SingleFlight()
+        self.threadPool = None
+        if reactor:
+            self.threadPool = ThreadPool(minThreads, maxThreads, "gthx-db")
+            reactor.callWhenRunning(self.threadPool.start)
+            # Let pending writes go out before the workers are stopped
+            reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def run(self, method, *args, **kwargs):
+        """Call a DbAccess method off the reactor thread
+
+        Returns a Deferred that fires with the method's result.
+        """
+        if not self.threadPool:
+            return defer.maybeDeferred(method, *args, **kwargs)
+        if self.pending >= self.maxPending:
+            return defer.fail(DbUnavailable("Too many DB calls waiting (%d)" % self.pending))
+        self.pending = self.pending + 1
+        d = threads.deferToThreadPool(self.reactor, self.threadPool, method, *args, **kwargs)
+        d.addBoth(self.finished)
+        return d
+
+    def finished(self, result):
+        self.pending = self.pending - 1
+        if isinstance(result, Failure) and result.check(DbUnavailable):
+            self.scheduleReconnect()
+        return result
+
+    def scheduleReconnect(self):
+        """Retry the connection on a timer until the DB is back"""
+        if self.reconnectCall and self.reconnectCall.active():
+            return
+        delay = max(self.db.retryIn(), self.db.minRetryDelay)
+        self.reconnectCall = self.reactor.callLater(delay, self.tryReconnect)
+
+    def tryReconnect(self):
+        def reconnected(result):
+            print("DB connection is back. Flushing buffered updates.")
+            return self.flush()
+        def failed(failure):
+            failure.trap(DbUnavailable)
+            # Usually finished() has already scheduled the next try, but
+            # not if run() turned the attempt away because the pool is full
+            self.scheduleReconnect()
+        self.run(self.db.reconnect).addCallbacks(reconnected, failed)
+
+    def getTell(self, recipient):
+        # Almost nobody has a tell waiting, so answer from memory when we
+        # can and skip the trip to a worker thread
+        if self.db.hasTell(recipient):
+            return self.run(self.db.getTell, recipient)
+        if self.db.tellsCurrent():
+            return defer.succeed(())
+        # Another bot may have added a tell since we last looked. Everyone
+        # who speaks while that's being checked shares the one check.
+        def refreshed(result):
+            if not self.db.hasTell(recipient):
+                return ()
+            return self.run(self.db.getTell, recipient)
+        return self.tellChecks.run("tells", self.run, self.db.refreshTellRecipients).addCallback(refreshed)
+
+    def updateSeen(self, nick, channel, message):
+        # Every channel line lands here, but the update only goes into a
+        # buffer in memory. Do that on the reactor thread so chatter doesn't
+        # use up workers or maxPending, and only hand a flush to a worker
+        # when the buffer is full and one isn't already on its way.
+        if not self.db.bufferSeen(nick, channel, message):
+            return defer.succeed(None)
+        if self.seenFlush:
+            return defer.succeed(None)
+        def flushed(result):
+            self.seenFlush = None
+            return result
+        d = self.run(self.db.flushSeen)
+        if not d.called:
+            self.seenFlush = d
+        return d.addBoth(flushed)
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+        def call(*args, **kwargs):
+            return self.run(method, *args, **kwargs)
+        return call
+
+    def stop(self):
+        if self.reconnectCall and self.reconnectCall.active():
+            self.reconnectCall.cancel()
+        if self.threadPool:
+            self.threadPool.stop()
+        self.db.close()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+class TtlCache():
+    """A bounded LRU cache whose entries also expire after a time to live
+
+    Safe to use from several threads. get() returns None for a miss, so
+    don't store None as a value.
+
+    To avoid caching a value that was read just before it was changed,
+    take a token() before reading from the source and pass it to put().
+    If the key was invalidated in the meantime the put is ignored.
+    """
+
+    def __init__(self, maxSize=1000, ttl=300, clock=time.time):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                self.misses = self.misses + 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return value
+
+    def token(self):
+        with self.lock:
+            return self.invalidations
+
+    def put(self, key, value, ttl=None, token=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            if token is not None and token != self.invalidations:
+                return
+            self.entries[key] = (value, self.clock() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.invalidations = self.invalidations + 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.invalidations = self.invalidations + 1
+            self.entries.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+class SingleFlight():
+    """Shares one call between everyone who asks for the same key while it runs
+
+    The first run() for a key calls the function. Later ones for the same
+    key, until it finishes, get the same result without calling it again.
+    Each caller gets its own Deferred, so their callbacks don't interfere.
+
+    Only for use from the reactor thread.
+    """
+
+    def __init__(self):
+        self.pending = dict()
+
+    def run(self, key, f, *args, **kwargs):
+        d = defer.Deferred()
+        if key in self.pending:
+            self.pending[key].append(d)
+        else:
+            self.pending[key] = [d]
+            defer.maybeDeferred(f, *args, **kwargs).addBoth(self.finished, key)
+        return d
+
+    def finished(self, result, key):
+        for d in self.pending.pop(key):
+            d.callback(result)
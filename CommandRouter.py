@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import re
+
+class Command():
+    def __init__(self, name, order, handler, regex=None, search=False, hints=None):
+        self.name = name
+        self.order = order
+        self.handler = handler
+        self.regex = regex
+        self.search = search
+        self.hints = hints
+        self.ignoreCase = bool(regex and regex.flags & re.IGNORECASE)
+
+    def match(self, text):
+        if not self.regex:
+            return None
+        if self.search:
+            return self.regex.search(text)
+        return self.regex.match(text)
+
+class CommandRouter():
+    """Works out which commands a line contains and calls their handlers
+
+    There are three kinds of command:
+     - exact: the whole line is the command, like "status?"
+     - keyword: the line starts with a keyword, like "seen", and then
+       has to match the command's pattern
+     - pattern: anything else, like a factoid query. A pattern can have
+       hints, strings of which at least one must be in any line the
+       pattern matches. Patterns whose hints aren't in the line are
+       skipped without running the regex.
+
+    Exact and keyword commands are found with a dictionary lookup, so
+    adding more of them doesn't slow down routing.
+
+    A line can contain more than one command. The handlers are called in
+    the order the commands were added, with the command's match object
+    (None for exact commands) and whatever context route() was given. A
+    handler returns True if it dealt with the line and nothing after it
+    should run.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.exact = {}
+        self.keywords = {}
+        self.patterns = []
+        self.ignoreCase = False
+
+    def add(self, name, handler, regex=None, search=False, hints=None):
+        command = Command(name, len(self.commands), handler, regex, search, hints)
+        self.commands.append(command)
+        return command
+
+    def addExact(self, text, handler):
+        self.exact[text] = self.add(text, handler)
+
+    def addKeyword(self, keyword, regex, handler):
+        """The line's first word must be keyword and the line must match regex"""
+        self.keywords.setdefault(keyword, []).append(self.add(keyword, handler, re.compile(regex)))
+
+    def addPattern(self, name, regex, handler, search=False, flags=0, hints=None):
+        """Match regex against the start of the line, or anywhere if search is set
+
+        Hints for an IGNORECASE pattern must be lower case.
+        """
+        command = self.add(name, handler, re.compile(regex, flags), search, hints)
+        self.patterns.append(command)
+        self.ignoreCase = self.ignoreCase or (command.ignoreCase and bool(hints))
+
+    def classify(self, text):
+        """Returns the commands text might contain, in the order to try them"""
+        candidates = []
+        command = self.exact.get(text)
+        if command:
+            candidates.append(command)
+        words = text.split(None, 1)
+        if words and words[0] in self.keywords:
+            candidates.extend(self.keywords[words[0]])
+        found = len(candidates)
+        lower = text.lower() if self.ignoreCase else text
+        for command in self.patterns:
+            if command.hints:
+                haystack = lower if command.ignoreCase else text
+                for hint in command.hints:
+                    if hint in haystack:
+                        break
+                else:
+                    continue
+            candidates.append(command)
+        if found and len(candidates) > found:
+            candidates.sort(key=lambda command: command.order)
+        return candidates
+
+    def route(self, text, context):
+        """Call the handlers for the commands in text
+
+        Returns True if one of them handled the line.
+        """
+        for command in self.classify(text):
+            m = command.match(text)
+            if command.regex and not m:
+                continue
+            if command.handler(m, context):
+                return True
+        return False
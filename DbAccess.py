@@ -6,8 +6,22 @@
 # SHOW CREATE TABLE <tableName>;
 # Change locked factoids to not print anything and instead throw an exception
 
-import time, sys, os, string
-import MySQLdb
+import time, sys, os, string, re
+import random
+import threading
+
+try:
+    import MySQLdb
+    MySQLError = MySQLdb.Error
+except ImportError:
+    # Only needed for the MySQL backend
+    MySQLdb = None
+    class MySQLError(Exception):
+        pass
+
+from datetime import datetime, timedelta
+
+from Cache import TtlCache
 
 class Seen:
     id = 0
@@ -24,59 +38,241 @@ class Tell:
     message = 4
     inTracked = 5
 
+# MySQL client errors that mean the connection needs to be reopened
+CONNECTION_LOST = (2006, 2013)
+
+# Tables that count references to an item
+REF_TABLES = ("refs", "thingiverseRefs", "youtubeRefs")
+
+# Reference tables by the stats() type that reads them
+STATS_TABLES = dict(thingiverse="thingiverseRefs", youtube="youtubeRefs")
+
+class DbUnavailable(Exception):
+    """The DB connection is down and we're waiting to retry
+
+    Raised straight away instead of blocking until the DB comes back.
+    """
+    pass
+
+def likeToRegex(pattern):
+    """Convert a LIKE pattern into a compiled regular expression
+
+    Matches the way MySQL treats the pattern passed by seen(): '%' and '_'
+    are wildcards, everything else is literal and the match ignores case.
+    """
+    regex = ""
+    for c in pattern:
+        if c == "%":
+            regex += ".*"
+        elif c == "_":
+            regex += "."
+        else:
+            regex += re.escape(c)
+    return re.compile(regex + r"\Z", re.IGNORECASE | re.DOTALL)
+
 class DbAccess():
     """Database Access
 
-    Gives access to read and write all the tables in the database
+    Gives access to read and write all the tables in the database.
+
+    Safe to share between threads: each thread that uses it gets its own
+    connection, and the in-memory buffers are protected by a lock.
+
+    This class talks to MySQL. Other backends subclass it and override
+    the handful of methods and attributes below that differ between SQL
+    dialects. All the queries use %s placeholders.
     """
 
-    def __init__(self, host, user, password, dbname):
+    # Bounds for the delay between reconnect attempts, in seconds
+    minRetryDelay = 1
+    maxRetryDelay = 300
+
+    # The DB module's base exception class
+    Error = MySQLError
+
+    # Added to SELECTs that read rows the transaction is about to change
+    forUpdate = " FOR UPDATE"
+
+    # Most nicks to look up in one query in countUnseen()
+    seenBatchSize = 500
+
+    # How long a "no tells" answer from memory is trusted, in seconds.
+    # After that, getTell() checks whether the tell table has changed.
+    tellCheckInterval = 5
+
+    def __init__(self, host, user, password, dbname, seenFlushSize=100, factoidCacheSize=1000, factoidCacheTtl=300, factoidMissTtl=60):
         self.dbHost = host
         self.dbuser = user
         self.dbpassword = password
         self.dbname = dbname
 
-        self.reconnect()
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
 
-    def reconnect(self):
+        # Reconnect backoff. While nextRetry is in the future the DB is
+        # considered down and queries fail fast with DbUnavailable.
+        self.retryDelay = 0
+        self.nextRetry = 0
+
+        # Seen updates are buffered here and written out in batches by
+        # flushSeen(). Only the latest update for each nick is kept.
+        self.pendingSeen = dict()
+        self.seenFlushSize = seenFlushSize
+
+        # Lowercased nicks that have tells waiting, so getTell() only hits
+        # the DB when there's something to deliver. None means unknown, in
+        # which case every lookup goes to the DB. tellsAdded holds nicks
+        # added since the last refresh so a refresh can't lose them, and
+        # tellVersion is the (count, max id) of the tell table at that refresh.
+        self.tellRecipients = None
+        self.tellsAdded = set()
+        self.tellVersion = None
+        self.tellCheckedAt = 0
+
+        # Factoid rows by lowercased item. Items that don't exist are cached
+        # too (as empty results) since most "foo?" lines aren't factoids.
+        # Other bots sharing the DB can change factoids, so misses expire
+        # sooner than hits.
+        self.factoidCache = TtlCache(factoidCacheSize, factoidCacheTtl)
+        self.factoidMissTtl = factoidMissTtl
+
+        # Reference counts not yet written to the DB, by table then item:
+        # [item, count, lastreferenced]. flushRefs() holds refsLock while it
+        # writes so readers never count an increment twice or not at all.
+        self.pendingRefs = dict((table, dict()) for table in REF_TABLES)
+        self.refsLock = threading.RLock()
+
+        # Factoids as the tracked bot last gave them, waiting to be
+        # reconciled with ours by flushFactoidSync(): lowercased item ->
+        # (item, [(are, value), ...], nick)
+        self.pendingSync = dict()
+
+        # It's fine to wait for the DB at startup since nothing else is
+        # running yet. Once running, reconnect() never waits.
         retries = 5
         while True:
             try:
-                self.db = MySQLdb.connect(host=self.dbHost, user=self.dbuser, passwd=self.dbpassword, db=self.dbname,charset='utf8mb4')
-                self.cur = self.db.cursor()
-                return
-            except MySQLdb.Error as e:
-                try:
-                    print("Failed to connect. MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                    retries = retries - 1
-                    if (retries > 0):
-                        print("Waiting to retry (%d)" % retries)
-                        time.sleep(30)
-                    else:
-                        raise e
-                except IndexError:
-                    print("MySQL Error: %s" % str(e))
-                    raise e
-        
+                self.reconnect()
+                break
+            except DbUnavailable:
+                retries = retries - 1
+                if (retries > 0):
+                    print("Waiting to retry (%d)" % retries)
+                    time.sleep(30)
+                    self.nextRetry = 0
+                else:
+                    raise
+
+        self.refreshTellRecipients()
+
+    @property
+    def db(self):
+        """The connection for the calling thread, opened on first use"""
+        if not hasattr(self.local, "db"):
+            self.reconnect()
+        return self.local.db
+
+    @property
+    def cur(self):
+        """The cursor for the calling thread, opened on first use"""
+        if not hasattr(self.local, "cur"):
+            self.reconnect()
+        return self.local.cur
+
+    def connect(self):
+        """Open and return a new DB connection"""
+        if not MySQLdb:
+            raise ImportError("The MySQL backend needs the mysqlclient package")
+        return MySQLdb.connect(host=self.dbHost, user=self.dbuser, passwd=self.dbpassword, db=self.dbname,charset='utf8mb4', connect_timeout=5)
+
+    def cursor(self, db):
+        return db.cursor()
+
+    def beginTransaction(self, cur):
+        # MySQL starts a transaction implicitly with the first statement
+        pass
+
+    def describeError(self, e):
+        try:
+            return "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+        except (IndexError, TypeError):
+            return "MySQL Error: %s" % str(e)
+
+    def isConnectionLost(self, e):
+        return len(e.args) > 0 and e.args[0] in CONNECTION_LOST
+
+    def upsertSql(self, table, key, columns, replace=(), add=()):
+        """INSERT a row, or if its key column already exists update it instead
+
+        Columns in replace are set to the new values, and the new values
+        of columns in add are added to the existing ones.
+        """
+        updates = ["%s=VALUES(%s)" % (column, column) for column in replace]
+        updates += ["%s=%s+VALUES(%s)" % (column, column, column) for column in add]
+        return "INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (table, ",".join(columns), ",".join(["%s"] * len(columns)), ", ".join(updates))
+
+    def likeParam(self, pattern):
+        return MySQLdb.escape_string(pattern)
+
+    def groupConcatSql(self, column, separator):
+        return "GROUP_CONCAT(%s SEPARATOR '%s')" % (column, separator)
+
+    def retryIn(self):
+        """Seconds until the next reconnect attempt is allowed, or 0 if the DB is up"""
+        return max(0, self.nextRetry - time.time())
+
+    def reconnect(self):
+        """Make one attempt to open a connection for the calling thread
+
+        If it fails, the next attempt is pushed back with exponential backoff
+        plus jitter and DbUnavailable is raised. Until then any query that
+        needs a new connection fails immediately instead of waiting.
+        """
+        delay = self.retryIn()
+        if delay > 0:
+            raise DbUnavailable("DB is down. Next reconnect attempt in %d seconds" % delay)
+        try:
+            db = self.connect()
+        except self.Error as e:
+            with self.lock:
+                self.retryDelay = min(self.maxRetryDelay, max(self.minRetryDelay, self.retryDelay * 2))
+                # Jitter keeps several bots (or threads) from retrying in lockstep
+                self.nextRetry = time.time() + random.uniform(0.5, 1.0) * self.retryDelay
+                delay = self.nextRetry - time.time()
+            print("Failed to connect. %s" % self.describeError(e))
+            print("Next reconnect attempt in %d seconds" % delay)
+            raise DbUnavailable(str(e))
+
+        with self.lock:
+            if self.retryDelay:
+                print("Reconnected to the DB")
+            self.retryDelay = 0
+            self.nextRetry = 0
+            if hasattr(self.local, "db") and self.local.db in self.connections:
+                self.connections.remove(self.local.db)
+            self.connections.append(db)
+        self.local.db = db
+        self.local.cur = self.cursor(db)
+
+
     def executeAndCommit(self, command, *args):
         retries = 3
         while retries > 0:
             try:
-                status = self.cur.execute(command, args)
+                cur = self.cur
+                cur.execute(command, args)
                 self.db.commit()
-                return status
-            except MySQLdb.Error as e:
-                try:
-                    print("executeAndCommit(): MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                except IndexError:
-                    print("executeAndCommit(): MySQL Error: %s" % str(e))
-                if (e.args[0] == 2006):
+                return cur.rowcount
+            except self.Error as e:
+                print("executeAndCommit(): %s" % self.describeError(e))
+                if self.isConnectionLost(e):
                     self.reconnect()
                 else:
                     try:
                         print("Rolling back...")
                         self.db.rollback()
-                    except MySQLdb.Error:
+                    except self.Error:
                         print("Rollback failed.")
                     
                 retries = retries - 1
@@ -92,12 +288,9 @@ class DbAccess():
                 self.cur.execute(command, args)
                 rows = self.cur.fetchall()
                 return rows
-            except MySQLdb.Error as e:
-                try:
-                    print("executeAndFetchAll(): MySQL Error [%d] on line %d: %s" % (e.args[0], sys.exc_info()[-1].tb_lineno, e.args[1]))
-                except IndexError:
-                    print("executeAndFetchAll(): MySQL Error: %s" % str(e))
-                if (e.args[0] == 2006):
+            except self.Error as e:
+                print("executeAndFetchAll(): %s" % self.describeError(e))
+                if self.isConnectionLost(e):
                     self.reconnect()
                 retries = retries - 1
                 if (retries > 0):
@@ -105,122 +298,531 @@ class DbAccess():
                 else:
                     return
 
+    def runInteraction(self, interaction, *args):
+        """Run interaction(cursor, *args) as a single transaction
+
+        Everything the interaction executes is committed together, or rolled
+        back if any statement fails. The interaction is retried from the start
+        if the connection was lost. Returns whatever the interaction returns,
+        or None if it couldn't be completed.
+        """
+        retries = 3
+        while retries > 0:
+            try:
+                cur = self.cur
+                self.beginTransaction(cur)
+                result = interaction(cur, *args)
+                self.db.commit()
+                return result
+            except self.Error as e:
+                print("runInteraction(): %s" % self.describeError(e))
+                if self.isConnectionLost(e):
+                    self.reconnect()
+                else:
+                    try:
+                        print("Rolling back...")
+                        self.db.rollback()
+                    except self.Error:
+                        print("Rollback failed.")
+
+                retries = retries - 1
+                if (retries > 0):
+                    print("Retrying...")
+                else:
+                    return None
+
+    def executeManyAndCommit(self, commands):
+        """Run several (command, rows) pairs with executemany() and a single commit
+
+        Returns True if everything was committed.
+        """
+        def executeMany(cur):
+            for command, rows in commands:
+                if rows:
+                    cur.executemany(command, rows)
+            return True
+        return self.runInteraction(executeMany) is not None
+
     def close(self):
-        self.cur.close()
-        self.db.close()
+        self.flush()
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for db in connections:
+            try:
+                db.close()
+            except self.Error as e:
+                print("Failed to close DB connection: %s" % e)
+        self.local = threading.local()
         
     def seen(self, nick):
         nick = nick.replace("*","%")
-        return self.executeAndFetchAll("SELECT * FROM seen WHERE name LIKE %s ORDER BY timestamp DESC LIMIT 3", MySQLdb.escape_string(nick))
+        rows = self.executeAndFetchAll("SELECT * FROM seen WHERE name LIKE %s ORDER BY timestamp DESC LIMIT 3", self.likeParam(nick))
+        with self.lock:
+            pending = list(self.pendingSeen.items())
+        if not pending:
+            return rows
+
+        # Overlay any updates that haven't been written to the DB yet
+        merged = dict()
+        for row in rows or ():
+            merged[row[Seen.name].lower()] = row
+        match = likeToRegex(nick)
+        for key, (name, channel, timestamp, message) in pending:
+            if match.match(name):
+                old = merged.get(key)
+                merged[key] = (old[Seen.id] if old else None, old[Seen.name] if old else name, channel, timestamp, message)
+        return tuple(sorted(merged.values(), key=lambda row: row[Seen.timestamp], reverse=True)[:3])
+
+    def countUnseen(self, nicks):
+        """How many of nicks have never been seen saying anything
+
+        Looks them all up in as few queries as it can, so a big channel is
+        one worker call rather than one per nick. Returns None if a query
+        failed.
+        """
+        with self.lock:
+            seen = set(key for key in self.pendingSeen)
+        unseen = set(nick.lower() for nick in nicks) - seen
+        names = sorted(unseen)
+        for start in range(0, len(names), self.seenBatchSize):
+            batch = names[start:start + self.seenBatchSize]
+            rows = self.executeAndFetchAll("SELECT name FROM seen WHERE name IN (%s)" % ",".join(["%s"] * len(batch)), *batch)
+            if rows is None:
+                return None
+            unseen.difference_update(row[0].lower() for row in rows)
+        return len(unseen)
 
     def updateSeen(self, nick, channel, message):
-        rows = self.executeAndFetchAll("SELECT id FROM seen WHERE name = %s", nick)
-        if rows:
-            id = int(rows[0][0])
-            self.executeAndCommit("UPDATE seen SET channel=%s, timestamp=UTC_TIMESTAMP(), message=%s where id=%s", channel, message, id)
-        else:
-            self.executeAndCommit("INSERT INTO seen (name,channel,timestamp,message) VALUES (%s,%s,UTC_TIMESTAMP(),%s)", nick, channel, message);
+        if self.bufferSeen(nick, channel, message):
+            self.flushSeen()
+
+    def bufferSeen(self, nick, channel, message):
+        """Buffer a seen update without touching the DB
+
+        Returns True if the buffer is full and should be flushed.
+        """
+        with self.lock:
+            # seen.timestamp has no fractional seconds
+            self.pendingSeen[nick.lower()] = (nick, channel, datetime.utcnow().replace(microsecond=0), message)
+            return len(self.pendingSeen) >= self.seenFlushSize
+
+    def flush(self):
+        """Write out everything that's buffered in memory"""
+        seenFlushed = self.flushSeen()
+        refsFlushed = self.flushRefs()
+        syncFlushed = self.flushFactoidSync()
+        return seenFlushed and refsFlushed and syncFlushed
+
+    def flushSeen(self):
+        """Write all buffered seen updates to the DB in a single batch"""
+        with self.lock:
+            if not self.pendingSeen:
+                return True
+            pending = self.pendingSeen
+            self.pendingSeen = dict()
+
+        # seen.name has a unique index, so this becomes one multi-row upsert
+        try:
+            success = self.executeManyAndCommit([
+                (self.upsertSql("seen", "name", ("name", "channel", "timestamp", "message"), replace=("channel", "timestamp", "message")),
+                 list(pending.values()))])
+        except DbUnavailable:
+            success = False
+
+        if not success:
+            # Keep the updates around for the next flush, unless they've
+            # been superseded in the meantime
+            print("Failed to flush %d seen updates. Will retry later." % len(pending))
+            with self.lock:
+                for key, entry in pending.items():
+                    self.pendingSeen.setdefault(key, entry)
+        return success
 
     def addFactoid(self, nick, item, are, value, replace):
-        rows = self.executeAndFetchAll("SELECT id FROM factoids WHERE item=%s AND locked=1 LIMIT 1", item)
-        if rows:
+        success = self.runInteraction(self.setFactoid, nick, item, are, value, replace)
+        self.factoidCache.invalidate(item.lower())
+        return bool(success)
+
+    def forgetFactoid(self, item, nick):
+        forgotten = self.runInteraction(self.deleteFactoid, item, nick)
+        self.factoidCache.invalidate(item.lower())
+        return bool(forgotten)
+
+    def lockFactoidRows(self, cur, item):
+        """Lock the rows for item until the transaction ends
+
+        Returns (exists, locked) so the caller can decide what to do with
+        no chance of someone else changing the item in the meantime.
+        """
+        cur.execute("SELECT locked FROM factoids WHERE item=%s" + self.forUpdate, (item,))
+        rows = cur.fetchall()
+        return len(rows) > 0, any(row[0] == 1 for row in rows)
+
+    def setFactoid(self, cur, nick, item, are, value, replace):
+        """Add a value to item, replacing the existing ones if asked, in one transaction"""
+        exists, locked = self.lockFactoidRows(cur, item)
+        if locked:
             print("Can't set factoid %s because it's locked." % item)
             return False
 
+        now = datetime.now()
+        history = []
         # If we're replacing, first delete all the existing rows
-        if replace:
-            self.forgetFactoid(item, nick)
+        if replace and exists:
+            cur.execute("DELETE FROM factoids WHERE item=%s", (item,))
+            history.append((item, None, nick, now))
+            # Make sure the new value sorts after the delete in the history
+            now = now + timedelta(microseconds=1)
+        history.append((item, value, nick, now))
 
-        self.executeAndCommit("INSERT INTO factoids (item,are,value,nick,dateset) VALUES (%s,%s,%s,%s,NOW())", item,are,value,nick)
-        self.executeAndCommit("INSERT INTO factoid_history (item,value,nick,dateset) VALUES (%s,%s,%s,NOW(6))", item,value,nick);
+        # factoids.dateset has no fractional seconds and MySQL would round
+        # rather than truncate
+        cur.execute("INSERT INTO factoids (item,are,value,nick,dateset) VALUES (%s,%s,%s,%s,%s)", (item, are, value, nick, now.replace(microsecond=0)))
+        cur.executemany("INSERT INTO factoid_history (item,value,nick,dateset) VALUES (%s,%s,%s,%s)", history)
         return True
 
-    def forgetFactoid(self, item, nick):
-        rows = self.executeAndFetchAll("SELECT id FROM factoids WHERE item=%s AND locked=1 LIMIT 1", item);
-        if rows:
+    def deleteFactoid(self, cur, item, nick):
+        """Delete all the values for item and record it in the history, in one transaction"""
+        exists, locked = self.lockFactoidRows(cur, item)
+        if locked:
             print("Can't forget factoid %s because it's locked." % item)
             return False
-
-        forgotten = False
-        itemsDeleted = self.executeAndCommit("DELETE FROM factoids WHERE item=%s", item)
-        if itemsDeleted > 0:
-            forgotten = True
-            self.executeAndCommit("INSERT INTO factoid_history (item,value,nick,dateset) VALUES (%s,Null,%s,NOW(6))", item,nick);
-        return forgotten
+        if not exists:
+            return False
+        cur.execute("DELETE FROM factoids WHERE item=%s", (item,))
+        cur.execute("INSERT INTO factoid_history (item,value,nick,dateset) VALUES (%s,Null,%s,%s)", (item, nick, datetime.now()))
+        return True
         
+    def syncFactoid(self, item, values, nick):
+        """Record that the tracked bot nick says item is values, a list of (are, value)
+
+        Buffered until flushFactoidSync().
+        """
+        with self.lock:
+            self.pendingSync[item.lower()] = (item, values, nick)
+
+    def flushFactoidSync(self):
+        """Reconcile the buffered factoids from the tracked bot in one transaction
+
+        Returns True if everything was written.
+        """
+        with self.lock:
+            if not self.pendingSync:
+                return True
+            pending = self.pendingSync
+            self.pendingSync = dict()
+
+        try:
+            success = self.runInteraction(self.reconcileFactoids, list(pending.values())) is not None
+        except DbUnavailable:
+            success = False
+
+        if not success:
+            print("Failed to sync %d factoids. Will retry later." % len(pending))
+            with self.lock:
+                for key, entry in pending.items():
+                    self.pendingSync.setdefault(key, entry)
+            return False
+        # Even unchanged items have a new lastsync
+        for key in pending:
+            self.factoidCache.invalidate(key)
+        return True
+
+    def reconcileFactoids(self, cur, factoids):
+        """Bring our factoids into line with the tracked bot's
+
+        Ones that already match just get their lastsync time set. Ones that
+        differ are replaced, as if the tracked bot had set them, unless ours
+        are locked. Returns the items that changed.
+        """
+        now = datetime.now()
+        synced = []
+        changed = []
+        for item, values, nick in factoids:
+            cur.execute("SELECT are,value,locked FROM factoids WHERE item=%s ORDER BY dateset,id" + self.forUpdate, (item,))
+            rows = cur.fetchall()
+            if [(bool(row[0]), row[1]) for row in rows] == [(bool(are), value) for are, value in values]:
+                synced.append((now.replace(microsecond=0), item))
+                continue
+            if any(row[2] == 1 for row in rows):
+                print("Not syncing factoid %s because ours is locked." % item)
+                continue
+
+            dateset = now
+            history = []
+            if rows:
+                cur.execute("DELETE FROM factoids WHERE item=%s", (item,))
+                history.append((item, None, nick, dateset))
+            inserts = []
+            for are, value in values:
+                # Keep the history in order
+                dateset = dateset + timedelta(microseconds=1)
+                inserts.append((item, are, value, nick, now.replace(microsecond=0), now.replace(microsecond=0)))
+                history.append((item, value, nick, dateset))
+            cur.executemany("INSERT INTO factoids (item,are,value,nick,dateset,lastsync) VALUES (%s,%s,%s,%s,%s,%s)", inserts)
+            cur.executemany("INSERT INTO factoid_history (item,value,nick,dateset) VALUES (%s,%s,%s,%s)", history)
+            changed.append(item)
+
+        if synced:
+            cur.executemany("UPDATE factoids SET lastsync=%s WHERE item=%s", synced)
+        if changed:
+            print("Synced %d factoids from %s: %s" % (len(changed), factoids[0][2], ", ".join(changed)))
+        return changed
+
     def getFactoid(self,item):
-        rows = self.executeAndFetchAll("SELECT * FROM factoids WHERE item=%s ORDER BY dateset", item)
+        key = item.lower()
+        rows = self.factoidCache.get(key)
+        if rows is None:
+            token = self.factoidCache.token()
+            rows = self.executeAndFetchAll("SELECT * FROM factoids WHERE item=%s ORDER BY dateset", item)
+            if rows is None:
+                return None
+            self.factoidCache.put(key, rows, None if rows else self.factoidMissTtl, token)
         if rows:
-            key = int(rows[0][0])
-            self.executeAndCommit("INSERT INTO refs (item, count, lastreferenced) VALUES(%s, 1, NOW()) ON DUPLICATE KEY UPDATE count=count+1", item);
+            self.countRef("refs", item)
         return rows
 
     def infoFactoid(self,item):
+        # Include any references that haven't been written yet
+        self.flushRefs("refs")
         return self.executeAndFetchAll("""SELECT * FROM factoid_history 
                                           LEFT JOIN refs ON factoid_history.item = refs.item
                                           WHERE factoid_history.item=%s 
                                           ORDER BY dateset DESC 
                                           LIMIT 4""", item)
 
+    def refreshTellRecipients(self):
+        """Reload the set of nicks with tells waiting
+
+        Other bots sharing the DB may add or deliver tells, so this gets
+        called periodically, and by getTell() before it trusts a negative
+        answer that's more than tellCheckInterval seconds old. The full list
+        is only re-read when the tell table has changed since the last
+        refresh.
+        """
+        checkedAt = time.time()
+        rows = self.executeAndFetchAll("SELECT COUNT(*), MAX(id) FROM tell")
+        if not rows:
+            return
+        version = tuple(rows[0])
+        if version == self.tellVersion and self.tellRecipients is not None:
+            self.tellCheckedAt = checkedAt
+            return
+        rows = self.executeAndFetchAll("SELECT DISTINCT recipient FROM tell")
+        if rows is None:
+            return
+        recipients = set(row[0].lower() for row in rows if row[0])
+        with self.lock:
+            self.tellRecipients = recipients | self.tellsAdded
+            self.tellsAdded = set()
+            self.tellVersion = version
+            self.tellCheckedAt = checkedAt
+
+    def hasTell(self, recipient):
+        """True if recipient might have tells waiting
+
+        Only as current as the last refreshTellRecipients() for tells added
+        by anything other than this DbAccess, see tellsCurrent().
+        """
+        with self.lock:
+            return self.tellRecipients is None or recipient.lower() in self.tellRecipients
+
+    def tellsCurrent(self):
+        """True if a negative hasTell() can be trusted without checking the DB"""
+        return time.time() - self.tellCheckedAt < self.tellCheckInterval
+
     def addTell(self, author, recipient, message, inTracked):
-        self.executeAndCommit("INSERT INTO tell (author, recipient, timestamp, message, inTracked) VALUES (%s,%s,UTC_TIMESTAMP(),%s,%s)", author, recipient, message, inTracked);
+        self.executeAndCommit("INSERT INTO tell (author, recipient, timestamp, message, inTracked) VALUES (%s,%s,%s,%s,%s)", author, recipient, datetime.utcnow().replace(microsecond=0), message, inTracked);
+        with self.lock:
+            if self.tellRecipients is not None:
+                self.tellRecipients.add(recipient.lower())
+            self.tellsAdded.add(recipient.lower())
         return True
 
     def getTell(self, recipient):
-        rows = self.executeAndFetchAll("SELECT * FROM tell WHERE recipient=%s ORDER BY timestamp", recipient);
+        if not self.hasTell(recipient):
+            if self.tellsCurrent():
+                return ()
+            # Another bot may have added one since we last looked
+            self.refreshTellRecipients()
+            if not self.hasTell(recipient):
+                return ()
+        rows = self.runInteraction(self.claimTells, recipient)
+        if rows is not None:
+            with self.lock:
+                if self.tellRecipients is not None:
+                    self.tellRecipients.discard(recipient.lower())
+                self.tellsAdded.discard(recipient.lower())
+        return rows
+
+    def claimTells(self, cur, recipient):
+        """Read and delete all the tells for recipient in one transaction
+
+        The rows are locked as they're read and only those ids are deleted,
+        so a tell that arrives in the meantime stays queued for next time
+        instead of being dropped undelivered.
+        """
+        cur.execute("SELECT * FROM tell WHERE recipient=%s ORDER BY timestamp" + self.forUpdate, (recipient,))
+        rows = cur.fetchall()
         if rows:
-            self.executeAndCommit("DELETE FROM tell WHERE recipient=%s", recipient);
+            ids = [row[Tell.id] for row in rows]
+            cur.execute("DELETE FROM tell WHERE id IN (%s)" % ",".join(["%s"] * len(ids)), ids)
         return rows
 
+    def refKey(self, item):
+        return item.lower() if isinstance(item, str) else item
+
+    def countRef(self, table, item):
+        """Count a reference to item. It's written to table by flushRefs()"""
+        key = self.refKey(item)
+        now = datetime.now()
+        with self.lock:
+            entry = self.pendingRefs[table].get(key)
+            if entry:
+                entry[1] = entry[1] + 1
+                entry[2] = now
+            else:
+                self.pendingRefs[table][key] = [item, 1, now]
+
+    def flushRefs(self, table=None):
+        """Write the buffered reference counts with one multi-row upsert per table
+
+        Returns True if everything was written.
+        """
+        tables = [table] if table else REF_TABLES
+        with self.refsLock:
+            with self.lock:
+                pending = dict()
+                for t in tables:
+                    if self.pendingRefs[t]:
+                        pending[t] = self.pendingRefs[t]
+                        self.pendingRefs[t] = dict()
+            if not pending:
+                return True
+
+            commands = []
+            for t, counts in pending.items():
+                commands.append((self.upsertSql(t, "item", ("item", "count", "lastreferenced"), replace=("lastreferenced",), add=("count",)),
+                                 [tuple(entry) for entry in counts.values()]))
+            try:
+                success = self.executeManyAndCommit(commands)
+            except DbUnavailable:
+                success = False
+
+            if not success:
+                print("Failed to flush reference counts. Will retry later.")
+                with self.lock:
+                    for t, counts in pending.items():
+                        for key, (item, count, lastreferenced) in counts.items():
+                            entry = self.pendingRefs[t].get(key)
+                            if entry:
+                                entry[1] = entry[1] + count
+                            else:
+                                self.pendingRefs[t][key] = [item, count, lastreferenced]
+            return success
+
+    def addRef(self, table, item):
+        """Count a reference and return ((count, title),) including unflushed counts"""
+        self.countRef(table, item)
+        with self.refsLock:
+            rows = self.executeAndFetchAll("SELECT count,title FROM " + table + " WHERE item=%s", item)
+            with self.lock:
+                pending = self.pendingRefs[table].get(self.refKey(item))
+                pendingCount = pending[1] if pending else 0
+        if rows is None:
+            return None
+        if rows:
+            return ((int(rows[0][0]) + pendingCount, rows[0][1]),)
+        return ((pendingCount, None),)
+
     def addThingiverseRef(self, item):
-        self.executeAndCommit("INSERT INTO thingiverseRefs (item, count, lastreferenced) VALUES(%s, 1, NOW()) ON DUPLICATE KEY UPDATE count=count+1", item);
-        rows = self.executeAndFetchAll("SELECT count,title FROM thingiverseRefs WHERE item=%s", item);
-        return rows
+        return self.addRef("thingiverseRefs", item)
 
     def addThingiverseTitle(self, item, title):
-        self.executeAndCommit("UPDATE thingiverseRefs SET title=%s where item=%s", title, item)
+        # The row may not exist yet if its count hasn't been flushed
+        self.executeAndCommit(self.upsertSql("thingiverseRefs", "item", ("item", "title", "count"), replace=("title",)), item, title, 0)
 
     def addYoutubeRef(self, item):
-        self.executeAndCommit("INSERT INTO youtubeRefs (item, count, lastreferenced) VALUES(%s, 1, NOW()) ON DUPLICATE KEY UPDATE count=count+1", item);
-        rows = self.executeAndFetchAll("SELECT count,title FROM youtubeRefs WHERE item=%s", item);
-        return rows
+        return self.addRef("youtubeRefs", item)
 
     def addYoutubeTitle(self, item, title):
-        self.executeAndCommit("UPDATE youtubeRefs SET title=%s where item=%s", title, item)
+        self.executeAndCommit(self.upsertSql("youtubeRefs", "item", ("item", "title", "count"), replace=("title",)), item, title, 0)
 
     def mood(self):
-        rows = self.executeAndFetchAll("""SELECT botsnack - botsmack as mood
-                                          FROM
-                                          (
-                                            SELECT IFNULL ((SELECT count FROM refs WHERE item="botsnack"), 0) as botsnack, botsmack
-                                            FROM
-                                            (
-                                              SELECT IFNULL ((SELECT count FROM refs WHERE item="botsmack"), 0) as botsmack
-                                            ) as T2
-                                          ) as T;""")
+        self.flushRefs("refs")
+        rows = self.executeAndFetchAll("""SELECT IFNULL((SELECT count FROM refs WHERE item='botsnack'), 0)
+                                               - IFNULL((SELECT count FROM refs WHERE item='botsmack'), 0)""")
         if not rows:
             return None
         else:
             return int(rows[0][0])
 
+    def stats(self, type, range, order, limit=20):
+        """The most referenced factoids, thingiverse things or YouTube videos
+
+        type is factoids, thingiverse or youtube, range is all or recent (the
+        last 30 days) and order is count or date. Returns a list of dicts,
+        one per row, or None if the query failed. Reference counts that
+        haven't been flushed yet aren't included.
+        """
+        params = []
+        if type == "factoids":
+            columns = ("item", "value", "count", "lastreferenced")
+            query = """SELECT factoids.item, %s, r.count, r.lastreferenced FROM factoids
+                       JOIN refs r ON r.item = factoids.item
+                       WHERE r.item NOT IN ('botsnack', 'botsmack') """ % self.groupConcatSql("value", " and also ")
+        else:
+            columns = ("item", "title", "count", "lastreferenced")
+            query = "SELECT item, title, count, lastreferenced FROM %s WHERE 1=1 " % STATS_TABLES[type]
+        if range == "recent":
+            query += "AND lastreferenced >= %s "
+            params.append(datetime.now() - timedelta(days=30))
+        if type == "factoids":
+            query += "GROUP BY factoids.item, r.count, r.lastreferenced "
+        if order == "date":
+            query += "ORDER BY lastreferenced DESC "
+        else:
+            query += "ORDER BY count DESC, lastreferenced DESC "
+        query += "LIMIT %s"
+        params.append(limit)
+
+        rows = self.executeAndFetchAll(query, *params)
+        if rows is None:
+            return None
+        return [dict(zip(columns, row)) for row in rows]
+
     # Test only methods    
     def deleteSeen(self, user):
+        with self.lock:
+            pending = self.pendingSeen.pop(user.lower(), None)
         itemsDeleted = self.executeAndCommit("DELETE FROM seen WHERE name=%s", user)
-        return itemsDeleted > 0
+        return itemsDeleted > 0 or pending is not None
 
     def deleteAllFactoids(self):
         self.executeAndCommit("DELETE FROM factoids")
         self.executeAndCommit("DELETE FROM factoid_history")
+        with self.lock:
+            self.pendingRefs["refs"] = dict()
         self.executeAndCommit("DELETE FROM refs")
+        self.factoidCache.clear()
                 
     def lockFactoid(self, factoid):
         self.executeAndCommit("UPDATE factoids SET locked=1 where item=%s", factoid)
+        self.factoidCache.invalidate(factoid.lower())
 
     def deleteAllTells(self):
         self.executeAndCommit("DELETE FROM tell")
+        with self.lock:
+            self.tellRecipients = set()
+            self.tellsAdded = set()
 
     def deleteAllThingiverseRefs(self):
+        with self.lock:
+            self.pendingRefs["thingiverseRefs"] = dict()
         self.executeAndCommit("DELETE FROM thingiverseRefs")
 
     def deleteAllYoutubeRefs(self):
+        with self.lock:
+            self.pendingRefs["youtubeRefs"] = dict()
         self.executeAndCommit("DELETE FROM youtubeRefs")
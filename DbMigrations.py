@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Numbered schema upgrades for the gthx database.
+#
+# The version table records every version the DB has been upgraded to.
+# migrate() reads the highest version and runs each newer step in order,
+# recording the new version as soon as the step finishes so an interrupted
+# upgrade picks up where it left off.
+#
+# Index changes use InnoDB online DDL (ALGORITHM=INPLACE, LOCK=NONE) so
+# large tables stay readable and writable while the index is built.
+
+import time
+
+# Rows to remove per transaction when cleaning up duplicates
+BATCH_SIZE = 500
+
+# How long an ALTER may wait for the metadata lock before giving up and
+# retrying. Keeps queries from piling up behind a blocked ALTER.
+LOCK_WAIT_TIMEOUT = 5
+LOCK_RETRIES = 10
+LOCK_RETRY_DELAY = 1
+
+# Times to clean up seen again if duplicates keep appearing
+DUPLICATE_RETRIES = 3
+
+ER_DUP_KEYNAME = 1061
+ER_DUP_ENTRY = 1062
+ER_CANT_DROP_FIELD_OR_KEY = 1091
+ER_LOCK_WAIT_TIMEOUT = 1205
+
+def currentVersion(db):
+    db.cur.execute("SELECT MAX(version) FROM version")
+    rows = db.cur.fetchall()
+    if not rows or rows[0][0] is None:
+        return 0
+    return int(rows[0][0])
+
+def setVersion(db, version):
+    db.cur.execute("INSERT INTO version (version, timestamp) VALUES (%s, CURRENT_TIMESTAMP)", (version,))
+    db.db.commit()
+
+def alterTable(db, table, change, skip=()):
+    """Make an online change to a table, retrying if it can't get the lock
+
+    Errors whose codes are in skip mean the change was already made and
+    are ignored. Returns False if one of those happened.
+    """
+    db.cur.execute("SET SESSION lock_wait_timeout = %s", (LOCK_WAIT_TIMEOUT,))
+    retries = LOCK_RETRIES
+    while True:
+        try:
+            db.cur.execute("ALTER TABLE %s %s, ALGORITHM=INPLACE, LOCK=NONE" % (table, change))
+            return True
+        except db.Error as e:
+            if e.args[0] in skip:
+                return False
+            retries = retries - 1
+            if e.args[0] == ER_LOCK_WAIT_TIMEOUT and retries > 0:
+                print("Timed out waiting for a lock on %s. Retrying..." % table)
+                time.sleep(LOCK_RETRY_DELAY)
+                continue
+            raise
+
+def addIndex(db, table, definition):
+    """Add an index without blocking reads and writes on the table
+
+    Does nothing if an index with the same name already exists, which
+    happens when a previous upgrade was interrupted part way through.
+    """
+    print("Adding index to %s: %s" % (table, definition))
+    if not alterTable(db, table, "ADD %s" % definition, skip=(ER_DUP_KEYNAME,)):
+        print("Index already exists on %s. Skipping." % table)
+
+def dropIndex(db, table, name):
+    print("Dropping index %s from %s" % (name, table))
+    alterTable(db, table, "DROP INDEX `%s`" % name, skip=(ER_CANT_DROP_FIELD_OR_KEY,))
+
+def hasIndex(db, table, name):
+    db.cur.execute("SHOW INDEX FROM %s WHERE Key_name = %%s" % table, (name,))
+    return bool(db.cur.fetchall())
+
+def newest(row):
+    """Sort key for (id, name, timestamp) seen rows, newest last"""
+    id, name, timestamp = row
+    return (timestamp is not None, timestamp, id)
+
+def removeDuplicateSeen(db):
+    """Keep only the newest seen row for each name
+
+    Needed before seen.name can have a unique index, and only run while
+    seen.name has an ordinary index so each batch just reads and locks
+    the rows for its names. The newest row is the one with the latest
+    timestamp, not the highest id: updateSeen() used to rewrite the first
+    row it found, so that's usually the lowest id. Ties go to the highest
+    id and a NULL timestamp counts as oldest. The others are deleted by
+    id, a batch of names per transaction.
+    """
+    db.cur.execute("SELECT name FROM seen WHERE name IS NOT NULL GROUP BY name HAVING COUNT(*) > 1")
+    names = [row[0] for row in db.cur.fetchall()]
+    if names:
+        print("Removing duplicate seen rows for %d names" % len(names))
+    for start in range(0, len(names), BATCH_SIZE):
+        batch = names[start:start + BATCH_SIZE]
+        db.cur.execute("SELECT id, name, timestamp FROM seen WHERE name IN (%s)" % ",".join(["%s"] * len(batch)), batch)
+        rowsByName = dict()
+        for row in db.cur.fetchall():
+            rowsByName.setdefault(row[1].lower(), []).append(row)
+        losers = []
+        for rows in rowsByName.values():
+            rows.sort(key=newest)
+            losers.extend(row[0] for row in rows[:-1])
+        if losers:
+            db.cur.execute("DELETE FROM seen WHERE id IN (%s)" % ",".join(["%s"] * len(losers)), losers)
+        db.db.commit()
+
+def addUniqueSeenName(db):
+    """Give seen.name its unique index, removing duplicates first
+
+    A bot still writing to seen can add a new duplicate after the cleanup,
+    which makes the ALTER fail, so clean up again and retry when it does.
+    """
+    if hasIndex(db, "seen", "name"):
+        return
+    # Lets the cleanup find each name's rows without scanning the table
+    addIndex(db, "seen", "INDEX `name_lookup` (`name`)")
+    retries = DUPLICATE_RETRIES
+    while True:
+        removeDuplicateSeen(db)
+        try:
+            addIndex(db, "seen", "UNIQUE INDEX `name` (`name`)")
+            break
+        except db.Error as e:
+            retries = retries - 1
+            if e.args[0] != ER_DUP_ENTRY or retries <= 0:
+                raise
+            print("New duplicate seen rows appeared. Cleaning up again...")
+    dropIndex(db, "seen", "name_lookup")
+
+def upgradeTo6(db):
+    addUniqueSeenName(db)
+    addIndex(db, "tell", "INDEX `recipient` (`recipient`)")
+    addIndex(db, "factoids", "INDEX `item` (`item`)")
+    addIndex(db, "factoid_history", "INDEX `item_dateset` (`item`, `dateset`)")
+
+# (version, description, upgrade function) in the order they must be applied
+MIGRATIONS = [
+    (6, "Add indexes for seen, tell and factoid lookups", upgradeTo6),
+]
+
+def migrate(db):
+    """Upgrade the DB to the latest schema version
+
+    Returns the version the DB is at afterwards.
+    """
+    version = currentVersion(db)
+    print("Database schema is at version %d" % version)
+    for target, description, upgrade in MIGRATIONS:
+        if target <= version:
+            continue
+        print("Upgrading database to version %d: %s" % (target, description))
+        upgrade(db)
+        setVersion(db, target)
+        version = target
+    return version
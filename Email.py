@@ -1,49 +1,130 @@
 #!/usr/bin/env python
 
-import sys, os, _thread
+import queue
 import smtplib
+import threading
 
 class Email():
     """Email support
 
     Provides methods to send email for notifications
+
+    send() only queues a notification, so it's safe to call from the
+    reactor. One background thread sends the queue over a single logged in
+    SMTP session, which is opened when the first email goes out and closed
+    again after idleTimeout seconds with nothing to send. If the server has
+    dropped the session in the meantime, it's reopened and the email sent
+    again. At most maxQueued emails wait to be sent; any more are dropped.
     """
 
-    def __init__(self, user, password, from_email, to_email, server):
+    def __init__(self, user, password, from_email, to_email, server, maxQueued=100, idleTimeout=60, useSsl=True):
         self.user = user
         self.password = password
         self.from_email = from_email
         self.to_email = to_email
         self.server = server
+        self.idleTimeout = idleTimeout
+        self.useSsl = useSsl
+
+        self.queue = queue.Queue(maxQueued)
+        self.worker = None
+        self.workerLock = threading.Lock()
+        # Only used from the worker thread
+        self.smtp = None
 
-    def threadsend(self, subject, message):
-        try:
-            _thread.start_new_thread(self.send, (subject, message))
-        except Exception as e:
-            print("Failed to start a thread email: %s" % e)
-        
     def send(self, subject, message):
-        if ((self.user != None) and (self.password != None) and (self.server != None)):
-            print("Sending email notification...")
+        """Queue an email to be sent. Returns False if it had to be dropped."""
+        if ((self.user == None) or (self.password == None) or (self.server == None)):
+            return False
+        self.startWorker()
+        try:
+            self.queue.put_nowait((subject, message))
+        except queue.Full:
+            print("Email queue is full. Dropping email notification: %s" % subject)
+            return False
+        return True
+
+    def startWorker(self):
+        with self.workerLock:
+            if not self.worker:
+                self.worker = threading.Thread(target=self.run, name="gthx-email", daemon=True)
+                self.worker.start()
+
+    def close(self, timeout=30):
+        """Send whatever is queued, then stop the worker and log out
+
+        Waits up to timeout seconds. Meant for shutdown, when the reactor
+        isn't running any more.
+        """
+        with self.workerLock:
+            worker = self.worker
+            self.worker = None
+        if not worker:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            print("Email queue didn't drain in time. Dropping %d email notifications." % self.queue.qsize())
+            return
+        worker.join(timeout)
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idleTimeout if self.smtp else None)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            if item is None:
+                self.disconnect()
+                return
+            self.deliver(*item)
+
+    def connect(self):
+        if self.useSsl:
+            smtp = smtplib.SMTP_SSL(self.server)
+        else:
+            smtp = smtplib.SMTP(self.server)
+        smtp.set_debuglevel(True)
+        try:
+            smtp.login(self.user, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+
+    def disconnect(self):
+        if not self.smtp:
+            return
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+        self.smtp = None
+
+    def deliver(self, subject, message):
+        print("Sending email notification...")
 
-            # Create a text/plain message
-            msg = "To: %s\n" % self.to_email
-            msg += "From: %s\n" % self.from_email
-            msg += "Subject: %s\n\n" % subject
-            msg += message
+        # Create a text/plain message
+        msg = "To: %s\n" % self.to_email
+        msg += "From: %s\n" % self.from_email
+        msg += "Subject: %s\n\n" % subject
+        msg += message
 
-            # Now send the message
+        # A session we've had open a while may have been dropped by the
+        # server, so if sending over it fails try once more on a new one
+        for retry in (self.smtp is not None, False):
             try:
-                #s = smtplib.SMTP(self.server)
-                s = smtplib.SMTP_SSL(self.server)
-                s.set_debuglevel(True)
-                # Only use starttls() with SMTP, not SMTP_SSL
-                #s.starttls()
-                s.login(self.user, self.password)
-                s.sendmail(self.from_email, [self.to_email], msg)
-                s.quit()
+                if not self.smtp:
+                    self.connect()
+                self.smtp.sendmail(self.from_email, [self.to_email], msg)
+                break
             except Exception as e:
-                print("Failed to send email notification: %s" % e)
-            
-            print("Done with email")
+                if self.smtp:
+                    self.smtp.close()
+                    self.smtp = None
+                if not retry:
+                    print("Failed to send email notification: %s" % e)
+                    break
 
+        print("Done with email")
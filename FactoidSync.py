@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import re
+
+from collections import deque
+
+# Between the values of a factoid with more than one, see Gthx.factoidString()
+ALSO = re.compile(r" and (is|are) also ")
+
+class FactoidSync():
+    """Learns factoids from the tracked bot's answers to questions
+
+    A line like "foo is bar" could be anything, so only answers to a
+    question we just saw asked are used: after someone asks "foo?" in a
+    channel, the tracked bot's next "foo is ..." or "foo are ..." line there
+    within maxWait seconds is taken as its value of foo. An answer that
+    mentions the asker or the channel is skipped, since the factoid may use
+    !who or !channel and we can't tell which. So are <reply> and <action>
+    factoids, which don't say what they're the answer to.
+
+    clock is anything with seconds(), normally the reactor.
+    """
+
+    def __init__(self, clock, maxWait=30, maxQuestions=10):
+        self.clock = clock
+        self.maxWait = maxWait
+        self.maxQuestions = maxQuestions
+        # channel -> deque of (asked at, item, asker), newest last
+        self.questions = dict()
+
+    def asked(self, channel, item, user):
+        questions = self.questions.get(channel)
+        if questions is None:
+            questions = self.questions[channel] = deque(maxlen=self.maxQuestions)
+        questions.append((self.clock.seconds(), item.strip(), user))
+
+    def answered(self, channel, line):
+        """If line answers a recent question in channel, returns (item, [(are, value), ...])"""
+        questions = self.questions.get(channel)
+        if not questions:
+            return None
+        now = self.clock.seconds()
+        while questions and now - questions[0][0] > self.maxWait:
+            questions.popleft()
+
+        lower = line.lower()
+        for question in reversed(questions):
+            askedAt, item, user = question
+            values = self.parse(lower, line, item)
+            if values is None:
+                continue
+            questions.remove(question)
+            if user.lower() in lower or channel.lower() in lower:
+                print("Not syncing '%s', the answer might be personalized." % item)
+                return None
+            return item, values
+        return None
+
+    def parse(self, lower, line, item):
+        for verb in (" is ", " are "):
+            prefix = item.lower() + verb
+            if lower.startswith(prefix):
+                start = len(prefix)
+            else:
+                # Answers can be addressed to someone: "nick, foo is bar"
+                start = lower.find(", " + prefix)
+                if start < 0:
+                    continue
+                start = start + 2 + len(prefix)
+            parts = ALSO.split(line[start:])
+            values = [(verb == " are ", parts[0])]
+            for i in range(1, len(parts), 2):
+                values.append((parts[i] == "are", parts[i + 1]))
+            if all(value.strip() for are, value in values):
+                return values
+        return None
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+from urllib.parse import urlsplit
+
+from twisted.internet.defer import Deferred, DeferredSemaphore, TimeoutError
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.http_headers import Headers
+
+def deliverBody(response, makeProtocol):
+    """Deliver response's body to the protocol makeProtocol(finished) returns
+
+    The protocol fires finished when it has what it needs, and that's what
+    this returns. Like readBody(), cancelling it (e.g. on a timeout) drops
+    the connection.
+    """
+    def cancel(finished):
+        abort = getattr(protocol.transport, "abortConnection", None)
+        if abort:
+            abort()
+    finished = Deferred(cancel)
+    protocol = makeProtocol(finished)
+    response.deliverBody(protocol)
+    return finished
+
+class HttpClient():
+    """Makes HTTP requests over a shared pool of keep-alive connections
+
+    One of these is meant to last the life of the process, so repeat
+    requests to a site reuse an open connection instead of doing a new TCP
+    and TLS handshake each time.
+
+    At most maxConcurrent requests run at once, and at most maxPerHost of
+    them to any one host. The rest wait their turn. A request that takes
+    longer than timeout seconds, reading the body included, is cancelled.
+    """
+
+    def __init__(self, reactor, maxConcurrent=8, maxPerHost=2, timeout=10, idleTimeout=60, userAgent="gthx IRC bot"):
+        self.reactor = reactor
+        self.timeout = timeout
+        self.maxPerHost = maxPerHost
+        self.headers = Headers({'User-Agent': [userAgent]})
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = maxPerHost
+        self.pool.cachedConnectionTimeout = idleTimeout
+        self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+
+        self.slots = DeferredSemaphore(maxConcurrent)
+        # Per-host semaphores, only kept while the host has requests
+        self.hostSlots = dict()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def get(self, url, receive):
+        """GET url and call receive(response) with the response
+
+        receive returns its result, or a Deferred for it if it reads the body
+        (see deliverBody()). Returns a Deferred that fires with the result.
+        """
+        host = urlsplit(url).netloc.lower()
+        hostSlots = self.hostSlots.get(host)
+        if not hostSlots:
+            hostSlots = self.hostSlots[host] = DeferredSemaphore(self.maxPerHost)
+        d = hostSlots.run(self.slots.run, self.fetch, url, receive)
+        d.addBoth(self.released, host, hostSlots)
+        return d
+
+    def fetch(self, url, receive):
+        d = self.agent.request(b'GET', url.encode("utf-8"), self.headers, None)
+        d.addCallback(receive)
+        d.addTimeout(self.timeout, self.reactor, onTimeoutCancel=self.timedOut)
+        return d
+
+    def timedOut(self, result, timeout):
+        # Whatever the cancellation turned into, report it as a timeout
+        return Failure(TimeoutError("Request took longer than %s seconds" % timeout))
+
+    def released(self, result, host, hostSlots):
+        if hostSlots.tokens == hostSlots.limit and self.hostSlots.get(host) is hostSlots:
+            del self.hostSlots[host]
+        return result
+
+    def close(self):
+        """Close the idle connections. Returns a Deferred."""
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+import time
+import threading
+
+from datetime import datetime, timedelta, timezone
+
+from DbAccess import Seen, Tell, STATS_TABLES, likeToRegex
+
+class OffsetClock():
+    """The real time, plus however far it's been moved on with advance()
+
+    Lets tests skip ahead without sleeping while timestamps still move
+    forward between calls.
+    """
+
+    def __init__(self):
+        self.offset = 0
+
+    def __call__(self):
+        return time.time() + self.offset
+
+    def advance(self, seconds):
+        self.offset = self.offset + seconds
+
+class Factoid:
+    id = 0
+    item = 1
+    are = 2
+    value = 3
+    nick = 4
+    dateset = 5
+    locked = 6
+    lastsync = 7
+
+class MemoryDbAccess():
+    """Database Access that keeps everything in memory
+
+    Has the same methods as DbAccess and returns rows in the same shape,
+    so tests and benchmarks can run without a DB. Nothing is saved.
+
+    Matches the SQL backends' behaviour: items and nicks are compared
+    ignoring case, seen() takes the same wildcards, locked factoids can't
+    be changed and every change is recorded in the factoid history.
+
+    clock is a function that returns the time in seconds since the epoch,
+    like time.time(). Every timestamp comes from it.
+    """
+
+    minRetryDelay = 1
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.nextId = 1
+        # Rows are lists in the SQL column order, keyed by lowercased
+        # name or item where the SQL table has a unique index
+        self.seenRows = dict()
+        self.factoids = []
+        self.history = []
+        self.tells = []
+        self.refs = dict(refs=dict(), thingiverseRefs=dict(), youtubeRefs=dict())
+
+    def newId(self):
+        rowId = self.nextId
+        self.nextId = rowId + 1
+        return rowId
+
+    def utcnow(self):
+        return datetime.fromtimestamp(self.clock(), timezone.utc).replace(tzinfo=None)
+
+    def now(self):
+        return datetime.fromtimestamp(self.clock())
+
+    def retryIn(self):
+        return 0
+
+    def reconnect(self):
+        pass
+
+    def flush(self):
+        return True
+
+    def flushSeen(self):
+        return True
+
+    def flushRefs(self, table=None):
+        return True
+
+    def flushFactoidSync(self):
+        return True
+
+    def refreshTellRecipients(self):
+        pass
+
+    def close(self):
+        pass
+
+    def seen(self, nick):
+        match = likeToRegex(nick.replace("*", "%"))
+        with self.lock:
+            rows = [tuple(row) for row in self.seenRows.values() if match.match(row[Seen.name])]
+        rows.sort(key=lambda row: row[Seen.timestamp], reverse=True)
+        return tuple(rows[:3])
+
+    def updateSeen(self, nick, channel, message):
+        timestamp = self.utcnow().replace(microsecond=0)
+        with self.lock:
+            row = self.seenRows.get(nick.lower())
+            if row:
+                row[Seen.channel:] = [channel, timestamp, message]
+            else:
+                self.seenRows[nick.lower()] = [self.newId(), nick, channel, timestamp, message]
+
+    def countUnseen(self, nicks):
+        """Like DbAccess.countUnseen()"""
+        with self.lock:
+            return len(set(nick.lower() for nick in nicks) - set(self.seenRows))
+
+    def bufferSeen(self, nick, channel, message):
+        # Nothing to buffer, the update is already in memory
+        self.updateSeen(nick, channel, message)
+        return False
+
+    def factoidRows(self, item):
+        key = item.lower()
+        rows = [row for row in self.factoids if row[Factoid.item].lower() == key]
+        rows.sort(key=lambda row: (row[Factoid.dateset], row[Factoid.id]))
+        return rows
+
+    def deleteFactoidRows(self, rows):
+        ids = set(row[Factoid.id] for row in rows)
+        self.factoids = [row for row in self.factoids if row[Factoid.id] not in ids]
+
+    def addFactoid(self, nick, item, are, value, replace):
+        with self.lock:
+            rows = self.factoidRows(item)
+            if any(row[Factoid.locked] == 1 for row in rows):
+                print("Can't set factoid %s because it's locked." % item)
+                return False
+
+            now = self.now()
+            if replace and rows:
+                self.deleteFactoidRows(rows)
+                self.history.append([self.newId(), item, None, nick, now])
+                # Make sure the new value sorts after the delete in the history
+                now = now + timedelta(microseconds=1)
+            self.factoids.append([self.newId(), item, are, value, nick, now.replace(microsecond=0), None, None])
+            self.history.append([self.newId(), item, value, nick, now])
+            return True
+
+    def forgetFactoid(self, item, nick):
+        with self.lock:
+            rows = self.factoidRows(item)
+            if any(row[Factoid.locked] == 1 for row in rows):
+                print("Can't forget factoid %s because it's locked." % item)
+                return False
+            if not rows:
+                return False
+            self.deleteFactoidRows(rows)
+            self.history.append([self.newId(), item, None, nick, self.now()])
+            return True
+
+    def syncFactoid(self, item, values, nick):
+        """Like DbAccess.reconcileFactoids(), straight away"""
+        with self.lock:
+            rows = self.factoidRows(item)
+            now = self.now()
+            if [(bool(row[Factoid.are]), row[Factoid.value]) for row in rows] == [(bool(are), value) for are, value in values]:
+                for row in rows:
+                    row[Factoid.lastsync] = now.replace(microsecond=0)
+                return
+            if any(row[Factoid.locked] == 1 for row in rows):
+                print("Not syncing factoid %s because ours is locked." % item)
+                return
+
+            dateset = now
+            if rows:
+                self.deleteFactoidRows(rows)
+                self.history.append([self.newId(), item, None, nick, dateset])
+            for are, value in values:
+                dateset = dateset + timedelta(microseconds=1)
+                self.factoids.append([self.newId(), item, are, value, nick, now.replace(microsecond=0), None, now.replace(microsecond=0)])
+                self.history.append([self.newId(), item, value, nick, dateset])
+
+    def getFactoid(self, item):
+        with self.lock:
+            rows = tuple(tuple(row) for row in self.factoidRows(item))
+        if rows:
+            self.countRef("refs", item)
+        return rows
+
+    def infoFactoid(self, item):
+        """Like the SQL: the last 4 history rows, each joined with the item's refs row"""
+        key = item.lower()
+        with self.lock:
+            ref = self.refs["refs"].get(key)
+            ref = (ref[0], ref[1], ref[2]) if ref else (None, None, None)
+            rows = [tuple(row) + ref for row in self.history if row[1].lower() == key]
+        rows.sort(key=lambda row: (row[4], row[0]), reverse=True)
+        return tuple(rows[:4])
+
+    def tellsCurrent(self):
+        # Nothing else can add tells
+        return True
+
+    def hasTell(self, recipient):
+        key = recipient.lower()
+        with self.lock:
+            return any(row[Tell.recipient].lower() == key for row in self.tells)
+
+    def addTell(self, author, recipient, message, inTracked):
+        with self.lock:
+            self.tells.append((self.newId(), author, recipient, self.utcnow().replace(microsecond=0), message, inTracked))
+        return True
+
+    def getTell(self, recipient):
+        key = recipient.lower()
+        with self.lock:
+            rows = [row for row in self.tells if row[Tell.recipient].lower() == key]
+            self.tells = [row for row in self.tells if row[Tell.recipient].lower() != key]
+        rows.sort(key=lambda row: (row[Tell.timestamp], row[Tell.id]))
+        return tuple(rows)
+
+    def refKey(self, item):
+        return item.lower() if isinstance(item, str) else item
+
+    def countRef(self, table, item):
+        now = self.now()
+        with self.lock:
+            # [item, count, lastreferenced, title]
+            row = self.refs[table].setdefault(self.refKey(item), [item, 0, None, None])
+            row[1] = row[1] + 1
+            row[2] = now
+
+    def addRef(self, table, item):
+        """Count a reference and return ((count, title),)"""
+        self.countRef(table, item)
+        with self.lock:
+            row = self.refs[table][self.refKey(item)]
+            return ((row[1], row[3]),)
+
+    def addThingiverseRef(self, item):
+        return self.addRef("thingiverseRefs", item)
+
+    def addThingiverseTitle(self, item, title):
+        with self.lock:
+            self.refs["thingiverseRefs"].setdefault(self.refKey(item), [item, 0, None, None])[3] = title
+
+    def addYoutubeRef(self, item):
+        return self.addRef("youtubeRefs", item)
+
+    def addYoutubeTitle(self, item, title):
+        with self.lock:
+            self.refs["youtubeRefs"].setdefault(self.refKey(item), [item, 0, None, None])[3] = title
+
+    def mood(self):
+        with self.lock:
+            refs = self.refs["refs"]
+            snacks = refs["botsnack"][1] if "botsnack" in refs else 0
+            smacks = refs["botsmack"][1] if "botsmack" in refs else 0
+        return snacks - smacks
+
+    def stats(self, type, range, order, limit=20):
+        """Like DbAccess.stats()"""
+        since = self.now() - timedelta(days=30) if range == "recent" else None
+        rows = []
+        with self.lock:
+            if type == "factoids":
+                # One pass over the factoids rather than one per ref
+                factoids = dict()
+                for row in sorted(self.factoids, key=lambda row: (row[Factoid.dateset], row[Factoid.id])):
+                    factoids.setdefault(row[Factoid.item].lower(), []).append(row)
+                for key, (item, count, lastreferenced, title) in self.refs["refs"].items():
+                    if key in ("botsnack", "botsmack"):
+                        continue
+                    values = factoids.get(key)
+                    if values:
+                        rows.append(dict(item=values[0][Factoid.item], value=" and also ".join(row[Factoid.value] for row in values), count=count, lastreferenced=lastreferenced))
+            else:
+                for item, count, lastreferenced, title in self.refs[STATS_TABLES[type]].values():
+                    rows.append(dict(item=item, title=title, count=count, lastreferenced=lastreferenced))
+        if since:
+            rows = [row for row in rows if row["lastreferenced"] and row["lastreferenced"] >= since]
+        # NULL sorts first in SQL, so last when descending
+        def lastreferenced(row):
+            return row["lastreferenced"] or datetime.min
+        if order == "date":
+            rows.sort(key=lastreferenced, reverse=True)
+        else:
+            rows.sort(key=lambda row: (row["count"], lastreferenced(row)), reverse=True)
+        return rows[:limit]
+
+    # Test only methods
+    def deleteSeen(self, user):
+        with self.lock:
+            return self.seenRows.pop(user.lower(), None) is not None
+
+    def deleteAllFactoids(self):
+        with self.lock:
+            self.factoids = []
+            self.history = []
+            self.refs["refs"] = dict()
+
+    def lockFactoid(self, factoid):
+        with self.lock:
+            for row in self.factoidRows(factoid):
+                row[Factoid.locked] = 1
+
+    def deleteAllTells(self):
+        with self.lock:
+            self.tells = []
+
+    def deleteAllThingiverseRefs(self):
+        with self.lock:
+            self.refs["thingiverseRefs"] = dict()
+
+    def deleteAllYoutubeRefs(self):
+        with self.lock:
+            self.refs["youtubeRefs"] = dict()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+
+class Notifier():
+    """Collects email notifications and sends them in digests
+
+    Has the same send() and close() as Email, which it wraps. Instead of an
+    email per notification, everything sent in a window of window seconds
+    goes out together as one digest, so a bot that flaps during a netsplit
+    means one email rather than dozens.
+
+    A subject is emailed at most once per subjectInterval seconds.
+    Notifications for it wait for the next digest after that. Repeats of a
+    notification that's already waiting are counted rather than listed,
+    and only the latest maxLines different ones for a subject are kept.
+    The digest says how many were suppressed.
+
+    clock is anything with seconds() and callLater(), normally the reactor.
+    """
+
+    def __init__(self, email, clock, window=60, subjectInterval=300, maxLines=50):
+        self.email = email
+        self.clock = clock
+        self.window = window
+        self.subjectInterval = subjectInterval
+        self.maxLines = maxLines
+        self.flushCall = None
+
+        # subject -> OrderedDict of message -> times seen, most recent last
+        self.pending = OrderedDict()
+        # subject -> notifications not listed in its next digest
+        self.suppressed = dict()
+        # subject -> when it was last emailed
+        self.lastSent = dict()
+
+    def send(self, subject, message):
+        """Add a notification to the next digest"""
+        messages = self.pending.get(subject)
+        if messages is None:
+            messages = self.pending[subject] = OrderedDict()
+            self.suppressed[subject] = 0
+        if message in messages:
+            messages[message] = messages[message] + 1
+            messages.move_to_end(message)
+            self.suppressed[subject] = self.suppressed[subject] + 1
+        else:
+            messages[message] = 1
+            if len(messages) > self.maxLines:
+                oldest, count = messages.popitem(last=False)
+                self.suppressed[subject] = self.suppressed[subject] + count
+        self.schedule(self.window)
+        return True
+
+    def schedule(self, delay):
+        if self.flushCall and self.flushCall.active():
+            return
+        self.flushCall = self.clock.callLater(delay, self.flush)
+
+    def ready(self, subject, now):
+        lastSent = self.lastSent.get(subject)
+        return lastSent is None or now - lastSent >= self.subjectInterval
+
+    def flush(self, force=False):
+        """Email a digest of the notifications whose subjects are due
+
+        With force, all of them are sent whatever their subject's interval.
+        """
+        if self.flushCall and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = None
+        now = self.clock.seconds()
+
+        subjects = [subject for subject in self.pending if force or self.ready(subject, now)]
+        if subjects:
+            self.email.send(", ".join(subjects), self.digest(subjects))
+            for subject in subjects:
+                self.lastSent[subject] = now
+
+        # Come back when the next held subject is due
+        if self.pending:
+            due = min(self.lastSent[subject] + self.subjectInterval for subject in self.pending)
+            self.schedule(max(0, due - now))
+
+    def digest(self, subjects):
+        lines = []
+        for subject in subjects:
+            messages = self.pending.pop(subject)
+            suppressed = self.suppressed.pop(subject)
+            lines.append("%s:" % subject)
+            for message, count in messages.items():
+                if count > 1:
+                    lines.append("%s (x%d)" % (message, count))
+                else:
+                    lines.append(message)
+            if suppressed:
+                lines.append("(%d repeated or older notifications suppressed)" % suppressed)
+            lines.append("")
+        return "\n".join(lines)
+
+    def close(self, timeout=30):
+        """Send everything waiting, then close the Email"""
+        self.flush(force=True)
+        self.email.close(timeout)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict, deque
+
+# Priority classes, most urgent first
+CONTROL = 0
+REPLY = 1
+TELL = 2
+TITLE = 3
+PRIORITY_NAMES = ("control", "reply", "tell", "title")
+
+class OutputQueue():
+    """Sends lines to the IRC server without tripping its flood limits
+
+    A token bucket allows a burst of burst lines and then rate lines per
+    second. Lines that can't go out straight away wait in a queue and are
+    sent as tokens come back, most urgent priority first. Within a priority
+    the targets (channels or nicks) take turns, so one long reply can't
+    hold up everyone else. Each target's lines stay in order.
+
+    clock is anything with seconds() and callLater(), normally the reactor.
+    """
+
+    def __init__(self, send, clock, rate=1.0, burst=5):
+        self.send = send
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = clock.seconds()
+        self.sendCall = None
+
+        # One OrderedDict per priority of target -> deque of (line, queued at).
+        # Targets with lines waiting rotate through it in turn.
+        self.queues = [OrderedDict() for name in PRIORITY_NAMES]
+
+        # Metrics
+        self.depth = 0
+        self.maxDepth = 0
+        self.sent = 0
+        self.delayed = 0
+        self.maxWait = 0
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def put(self, line, target=None, priority=REPLY):
+        """Send line now if the bucket allows it, otherwise queue it"""
+        now = self.refill()
+        if self.depth == 0 and self.tokens >= 1:
+            self.tokens = self.tokens - 1
+            self.sent = self.sent + 1
+            self.send(line)
+            return
+        queue = self.queues[priority]
+        if target not in queue:
+            queue[target] = deque()
+        queue[target].append((line, now))
+        self.depth = self.depth + 1
+        self.maxDepth = max(self.maxDepth, self.depth)
+        self.delayed = self.delayed + 1
+        self.schedule()
+
+    def schedule(self):
+        """Arrange for sendQueued() to run when the next token is due"""
+        if self.depth == 0 or (self.sendCall and self.sendCall.active()):
+            return
+        self.sendCall = self.clock.callLater(max(0, (1 - self.tokens) / self.rate), self.sendQueued)
+
+    def sendQueued(self):
+        self.sendCall = None
+        now = self.refill()
+        while self.depth and self.tokens >= 1:
+            line, queuedAt = self.pop()
+            self.tokens = self.tokens - 1
+            self.sent = self.sent + 1
+            self.maxWait = max(self.maxWait, now - queuedAt)
+            self.send(line)
+        self.schedule()
+
+    def pop(self):
+        """Take the next line from the most urgent queue, rotating its targets"""
+        for queue in self.queues:
+            if queue:
+                target, lines = queue.popitem(last=False)
+                entry = lines.popleft()
+                if lines:
+                    queue[target] = lines
+                self.depth = self.depth - 1
+                return entry
+
+    def depths(self):
+        """Lines waiting in each priority class, by name"""
+        return dict((PRIORITY_NAMES[i], sum(len(lines) for lines in queue.values())) for i, queue in enumerate(self.queues))
+
+    def clear(self):
+        """Drop everything waiting, e.g. when the connection is lost"""
+        if self.sendCall and self.sendCall.active():
+            self.sendCall.cancel()
+        self.sendCall = None
+        self.queues = [OrderedDict() for name in PRIORITY_NAMES]
+        self.depth = 0
+
+    def statsString(self):
+        return "Send queue: %d waiting (max %d); %d of %d lines delayed, longest wait %.1fs." % (self.depth, self.maxDepth, self.delayed, self.sent + self.depth, self.maxWait)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+from collections import deque
+
+from twisted.internet import task
+
+# Numerics for MONITOR (IRCv3), which Twisted doesn't know by name
+RPL_MONONLINE = "730"
+RPL_MONOFFLINE = "731"
+ERR_MONLISTFULL = "734"
+
+class Outage():
+    """A time the tracked nick was offline
+
+    detectedIn is how long it could have been gone before we noticed: zero
+    when the server told us straight away, up to the poll interval when we
+    only found out by polling.
+    """
+
+    def __init__(self, start, detectedIn, reason):
+        self.start = start
+        self.detectedIn = detectedIn
+        self.reason = reason
+        self.end = None
+
+class Presence():
+    """Keeps track of whether the tracked nick is on the network
+
+    If the server supports MONITOR it tells us whenever the nick comes or
+    goes. Otherwise we poll with ISON every pollInterval seconds. Joins,
+    quits and renames seen in our channels count too, via update().
+
+    Calls onChange(online, reason) when the nick comes online or goes
+    offline. The last few outages are kept in outages.
+
+    clock is anything with seconds() and callLater(), normally the reactor.
+    """
+
+    def __init__(self, nick, sendLine, clock, onChange, pollInterval=60, keepOutages=10):
+        self.nick = nick
+        self.sendLine = sendLine
+        self.clock = clock
+        self.onChange = onChange
+        self.pollInterval = pollInterval
+        self.mode = None
+        self.poller = None
+        # None until we hear one way or the other
+        self.online = None
+        # When we last heard the nick was online
+        self.confirmedAt = None
+        self.outages = deque(maxlen=keepOutages)
+        self.outageCount = 0
+
+    def start(self, monitor):
+        """Start watching the nick, with MONITOR if the server has it"""
+        self.stop()
+        if monitor:
+            self.mode = "monitor"
+            self.sendLine("MONITOR + %s" % self.nick)
+        else:
+            self.mode = "ison"
+            self.poller = task.LoopingCall(self.poll)
+            self.poller.clock = self.clock
+            self.poller.start(self.pollInterval)
+
+    def stop(self):
+        if self.poller and self.poller.running:
+            self.poller.stop()
+        self.poller = None
+        self.mode = None
+
+    def poll(self):
+        self.sendLine("ISON %s" % self.nick)
+
+    def isMe(self, target):
+        # MONITOR replies give nick!user@host, ISON just nicks
+        return target.split("!")[0].lower() == self.nick.lower()
+
+    def gotIson(self, nicks):
+        online = any(self.isMe(nick) for nick in nicks.split())
+        self.update(online, "ISON poll", polled=True)
+
+    def gotMonitor(self, command, targets):
+        if command == ERR_MONLISTFULL:
+            print("Server won't MONITOR %s. Polling with ISON instead." % self.nick)
+            self.start(False)
+            return
+        if any(self.isMe(target) for target in targets.split(",")):
+            self.update(command == RPL_MONONLINE, "MONITOR")
+
+    def update(self, online, reason, polled=False):
+        """Record whether the nick is online, and why we think so"""
+        now = self.clock.seconds()
+        if online:
+            self.confirmedAt = now
+        if online == self.online:
+            return
+        wasOnline = self.online
+        self.online = online
+        if not online and wasOnline:
+            detectedIn = 0
+            if polled and self.confirmedAt is not None:
+                detectedIn = now - self.confirmedAt
+            self.outages.append(Outage(now, detectedIn, reason))
+            self.outageCount = self.outageCount + 1
+        elif online and self.outages and self.outages[-1].end is None:
+            self.outages[-1].end = now
+        self.onChange(online, reason)
+
+    def statsString(self):
+        state = {True: "online", False: "offline", None: "unknown"}[self.online]
+        reply = "%s is %s (%s)" % (self.nick, state, self.mode or "not watching")
+        if self.outages:
+            last = self.outages[-1]
+            lasted = (last.end if last.end is not None else self.clock.seconds()) - last.start
+            reply += "; %d outages, last noticed in %.0fs via %s and lasted %.0fs" % (self.outageCount, last.detectedIn, last.reason, lasted)
+        return reply + "."
+
+class Prober():
+    """Checks that the tracked bot still answers, not just that it's connected
+
+    Every interval seconds sends query (a private message the bot always
+    answers, like a locked factoid) with send(). If no reply or other sign
+    of life arrives within timeout seconds maxMisses times running, the bot
+    is marked unresponsive. It's marked responsive again as soon as it
+    says anything.
+
+    Calls onChange(responsive, reason) when that changes. Only probe while
+    the bot is online, so start() and stop() follow Presence.
+    """
+
+    def __init__(self, query, send, clock, onChange, interval=60, timeout=10, maxMisses=2):
+        self.query = query
+        self.send = send
+        self.clock = clock
+        self.onChange = onChange
+        self.interval = interval
+        self.timeout = timeout
+        self.maxMisses = maxMisses
+        self.poller = None
+        self.deadline = None
+        self.sentAt = None
+        self.misses = 0
+        self.responsive = True
+
+        # Metrics
+        self.probes = 0
+        self.lastLatency = None
+        self.maxLatency = 0
+        self.lapses = 0
+
+    def start(self):
+        if self.poller and self.poller.running:
+            return
+        self.poller = task.LoopingCall(self.probe)
+        self.poller.clock = self.clock
+        self.poller.start(self.interval)
+
+    def stop(self):
+        if self.poller and self.poller.running:
+            self.poller.stop()
+        self.poller = None
+        self.cancelDeadline()
+        self.misses = 0
+        # Nothing to wait for once it's gone, so start afresh when it's back
+        self.responsive = True
+
+    def cancelDeadline(self):
+        if self.deadline and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
+
+    def probe(self):
+        if self.deadline:
+            # Still waiting on the last one
+            return
+        self.probes = self.probes + 1
+        self.sentAt = self.clock.seconds()
+        self.deadline = self.clock.callLater(self.timeout, self.timedOut)
+        self.send(self.query)
+
+    def timedOut(self):
+        self.deadline = None
+        self.misses = self.misses + 1
+        print("No answer to probe within %ss (%d in a row)" % (self.timeout, self.misses))
+        if self.responsive and self.misses >= self.maxMisses:
+            self.responsive = False
+            self.lapses = self.lapses + 1
+            self.onChange(False, "no answer to %d probes in a row" % self.misses)
+
+    def alive(self):
+        """The bot answered a probe or said something"""
+        if self.deadline:
+            latency = self.clock.seconds() - self.sentAt
+            self.lastLatency = latency
+            self.maxLatency = max(self.maxLatency, latency)
+            self.cancelDeadline()
+        self.misses = 0
+        if not self.responsive:
+            self.responsive = True
+            self.onChange(True, "answering again")
+
+    def statsString(self):
+        if self.lastLatency is None:
+            latency = "no answers yet"
+        else:
+            latency = "last answer in %.1fs, slowest %.1fs" % (self.lastLatency, self.maxLatency)
+        return "Probes: %d sent, %s, unresponsive %d times." % (self.probes, latency, self.lapses)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import sqlite3
+import threading
+
+from datetime import datetime
+
+from DbAccess import DbAccess
+
+# Same tables and column order as createDB.sql. Text columns that MySQL
+# compares case-insensitively (utf8mb4_unicode_ci) use NOCASE here.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS factoid_history (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  item VARCHAR(255) COLLATE NOCASE DEFAULT NULL,
+  value VARCHAR(512) DEFAULT NULL,
+  nick VARCHAR(30) DEFAULT NULL,
+  dateset DATETIME DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS factoid_history_item_dateset ON factoid_history (item, dateset);
+
+CREATE TABLE IF NOT EXISTS factoids (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  item VARCHAR(255) COLLATE NOCASE DEFAULT NULL,
+  are TINYINT DEFAULT NULL,
+  value VARCHAR(512) DEFAULT NULL,
+  nick VARCHAR(30) DEFAULT NULL,
+  dateset DATETIME DEFAULT NULL,
+  locked TINYINT DEFAULT NULL,
+  lastsync DATETIME DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS factoids_item ON factoids (item);
+
+CREATE TABLE IF NOT EXISTS seen (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name VARCHAR(30) COLLATE NOCASE DEFAULT NULL UNIQUE,
+  channel VARCHAR(30) DEFAULT NULL,
+  timestamp DATETIME DEFAULT NULL,
+  message VARCHAR(512) DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tell (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  author VARCHAR(60) DEFAULT NULL,
+  recipient VARCHAR(60) COLLATE NOCASE DEFAULT NULL,
+  timestamp DATETIME DEFAULT NULL,
+  message TEXT,
+  inTracked TINYINT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS tell_recipient ON tell (recipient);
+
+CREATE TABLE IF NOT EXISTS refs (
+  item VARCHAR(255) COLLATE NOCASE NOT NULL PRIMARY KEY,
+  count INTEGER NOT NULL,
+  lastreferenced DATETIME DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS thingiverseRefs (
+  item INTEGER NOT NULL PRIMARY KEY,
+  title VARCHAR(255) DEFAULT NULL,
+  count INTEGER NOT NULL,
+  lastreferenced DATETIME DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS youtubeRefs (
+  item VARCHAR(255) COLLATE NOCASE NOT NULL PRIMARY KEY,
+  title VARCHAR(255) DEFAULT NULL,
+  count INTEGER NOT NULL,
+  lastreferenced DATETIME DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS version (
+  version INTEGER NOT NULL,
+  timestamp DATETIME DEFAULT NULL
+);
+
+INSERT INTO version (version, timestamp) SELECT 6, CURRENT_TIMESTAMP WHERE NOT EXISTS (SELECT * FROM version);
+"""
+
+# Store datetimes as ISO 8601 text, which sorts in time order, and turn
+# DATETIME columns back into datetimes when they're read
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", "microseconds"))
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+
+class SqliteCursor():
+    """Lets the %s placeholders DbAccess uses work with sqlite3's ?"""
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, command, args=()):
+        return self.cur.execute(command.replace("%s", "?"), args)
+
+    def executemany(self, command, rows):
+        return self.cur.executemany(command.replace("%s", "?"), rows)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+class SqliteDbAccess(DbAccess):
+    """Database Access backed by an SQLite file
+
+    Needs no DB server, so it suits small channels and testing. The file
+    and tables are created on first use.
+
+    The DB is opened in WAL mode so readers don't block the writer.
+    SQLite has no row locks, so transactions that read and then change
+    rows start with BEGIN IMMEDIATE, which takes the write lock up front.
+    Each thread still gets its own connection, so the path must be a real
+    file and not ":memory:".
+    """
+
+    Error = sqlite3.Error
+    forUpdate = ""
+
+    def __init__(self, path, seenFlushSize=100, factoidCacheSize=1000, factoidCacheTtl=300, factoidMissTtl=60):
+        self.path = path
+        self.schemaLock = threading.Lock()
+        self.schemaCreated = False
+        DbAccess.__init__(self, None, None, None, path, seenFlushSize, factoidCacheSize, factoidCacheTtl, factoidMissTtl)
+
+    def connect(self):
+        # Autocommit mode, so transactions only start where we BEGIN them
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+        db.execute("PRAGMA journal_mode=WAL")
+        # Safe in WAL mode, and saves an fsync on every commit
+        db.execute("PRAGMA synchronous=NORMAL")
+        with self.schemaLock:
+            if not self.schemaCreated:
+                db.executescript(SCHEMA)
+                self.schemaCreated = True
+        return db
+
+    def cursor(self, db):
+        return SqliteCursor(db.cursor())
+
+    def beginTransaction(self, cur):
+        cur.execute("BEGIN IMMEDIATE")
+
+    def describeError(self, e):
+        return "SQLite Error: %s" % str(e)
+
+    def isConnectionLost(self, e):
+        return False
+
+    def upsertSql(self, table, key, columns, replace=(), add=()):
+        updates = ["%s=excluded.%s" % (column, column) for column in replace]
+        updates += ["%s=%s+excluded.%s" % (column, column, column) for column in add]
+        return "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT(%s) DO UPDATE SET %s" % (table, ",".join(columns), ",".join(["%s"] * len(columns)), key, ", ".join(updates))
+
+    def likeParam(self, pattern):
+        # SQLite's LIKE has no escape character, so pass the pattern as is
+        return pattern
+
+    def groupConcatSql(self, column, separator):
+        return "GROUP_CONCAT(%s, '%s')" % (column, separator)
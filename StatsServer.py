@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import json
+import time
+import datetime
+
+from twisted.internet import defer
+from twisted.web import resource, server
+
+from Cache import TtlCache, SingleFlight
+
+TYPES = ("factoids", "thingiverse", "youtube")
+RANGES = ("recent", "all")
+ORDERS = ("date", "count")
+
+def datetimeHandler(obj):
+    """JSON serializer for objects not serializable by default json code"""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError("Type not serializable")
+
+class StatsResource(resource.Resource):
+    """The JSON stats API for gthx's website
+
+    Takes the same parameters as the old stats.py CGI script and gives the
+    same replies: type (factoids, thingiverse or youtube), range (recent or
+    all), order (date or count), an id that's echoed back, and debug for
+    indented output. Any path will do.
+
+    Runs in the bot's process and queries through its AsyncDbAccess, so
+    requests share the bot's pool of DB connections instead of each
+    starting an interpreter and connecting. Results are cached for
+    cacheTtl seconds, and requests for the same stats while they're being
+    looked up wait for that query rather than starting another.
+    """
+
+    isLeaf = True
+
+    def __init__(self, db, cacheTtl=10, clock=time.time):
+        resource.Resource.__init__(self)
+        self.db = db
+        self.cacheTtl = cacheTtl
+        self.cache = TtlCache(len(TYPES) * len(RANGES) * len(ORDERS), cacheTtl, clock)
+        self.queries = SingleFlight()
+
+        # Metrics
+        self.requests = 0
+        self.dbQueries = 0
+
+    def arg(self, request, name, default=None):
+        values = request.args.get(name.encode("ascii"))
+        return values[0].decode("utf-8", "replace") if values else default
+
+    def render_GET(self, request):
+        self.requests = self.requests + 1
+        request.setHeader(b"Content-Type", b"text/json")
+        reply = {}
+        id = self.arg(request, "id")
+        if id is not None:
+            reply["id"] = id
+        debug = self.arg(request, "debug") is not None
+
+        type = self.arg(request, "type", "factoids")
+        range = self.arg(request, "range", "all")
+        order = self.arg(request, "order", "count")
+        for name, value, allowed in (("type", type, TYPES), ("range", range, RANGES), ("order", order, ORDERS)):
+            if value not in allowed:
+                reply["status"] = "failure"
+                reply["reason"] = "Invalid %s '%s'" % (name, value)
+                return self.encode(reply, debug)
+
+        def gotStats(rows):
+            if rows is None:
+                reply["status"] = "failure"
+                reply["reason"] = "Query failed"
+            else:
+                reply["data"] = rows
+                reply["status"] = "success"
+            return reply
+
+        def failed(failure):
+            print("Stats query failed: %s" % failure.getErrorMessage())
+            reply["status"] = "failure"
+            reply["reason"] = failure.getErrorMessage()
+            return reply
+
+        def finish(reply):
+            if not finished.called:
+                request.write(self.encode(reply, debug))
+                request.finish()
+
+        # Don't write to a request whose client has gone
+        finished = request.notifyFinish()
+        finished.addErrback(lambda failure: None)
+        self.getStats(type, range, order).addCallbacks(gotStats, failed).addCallback(finish)
+        return server.NOT_DONE_YET
+
+    def getStats(self, type, range, order):
+        key = (type, range, order)
+        rows = self.cache.get(key)
+        if rows is not None:
+            return defer.succeed(rows)
+        return self.queries.run(key, self.query, key)
+
+    def query(self, key):
+        def gotRows(rows):
+            if rows is not None:
+                self.cache.put(key, rows)
+            return rows
+        self.dbQueries = self.dbQueries + 1
+        return self.db.stats(*key).addCallback(gotRows)
+
+    def encode(self, reply, debug):
+        if debug:
+            text = json.dumps(reply, default=datetimeHandler, sort_keys=True, indent=4, separators=(',', ': '))
+        else:
+            text = json.dumps(reply, default=datetimeHandler, separators=(',', ':'))
+        return text.encode("utf-8")
+
+def makeSite(db, cacheTtl=10):
+    """A twisted.web Site serving the stats API, ready for listenTCP()"""
+    site = server.Site(StatsResource(db, cacheTtl))
+    # One line per request would swamp the bot's log
+    site.log = lambda request: None
+    return site
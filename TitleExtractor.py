@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import re
+import html
+import codecs
+
+from twisted.internet.protocol import Protocol
+
+from HttpClient import deliverBody
+
+# Most of a page we'll read looking for its title
+MAX_TITLE_BYTES = 256 * 1024
+
+# Once we have the title, read and discard up to this much of the rest of
+# the page, if we know how much is left, so the connection can be reused.
+# Anything bigger is cheaper to abandon.
+MAX_DRAIN_BYTES = 16 * 1024
+
+CHARSET = re.compile(rb"""charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+
+def findCharset(contentType, head):
+    """The page's charset from its Content-Type header or a <meta> tag in head"""
+    for match in (CHARSET.search(contentType or b""), META_CHARSET.search(head)):
+        if match:
+            try:
+                return codecs.lookup(match.group(1).decode("ascii")).name
+            except LookupError:
+                pass
+    return "utf-8"
+
+class TitleExtractor(Protocol):
+    """Reads a response body just far enough to find the page's <title>
+
+    Works on the raw bytes as they arrive, so the title can span lines or
+    chunks. As soon as </title> turns up, or once maxBytes have been read
+    without finding it, the download is stopped and finished fires with
+    the title, or None if there wasn't one.
+
+    Stopping a download closes the connection. If length, the size of the
+    body, says only a little is left the rest is read and thrown away
+    instead, so the connection can go back to the pool.
+
+    The title is decoded using the charset from contentType (the response's
+    Content-Type header), then a <meta> charset before the title, then
+    UTF-8. Entities are unescaped and runs of whitespace collapsed.
+    """
+
+    def __init__(self, finished, contentType=None, maxBytes=MAX_TITLE_BYTES, length=None):
+        self.finished = finished
+        self.contentType = contentType
+        self.maxBytes = maxBytes
+        self.length = length
+        self.received = 0
+        self.data = bytearray()
+        self.lower = bytearray()
+        # Where the next search starts, and where the title text begins
+        # once the opening tag has been seen
+        self.searchFrom = 0
+        self.titleStart = None
+        self.done = False
+
+    def dataReceived(self, data):
+        self.received = self.received + len(data)
+        if self.done:
+            return
+        data = data[:self.maxBytes - len(self.data)]
+        self.data += data
+        self.lower += data.lower()
+
+        if self.titleStart is None:
+            tag = self.lower.find(b"<title", self.searchFrom)
+            end = self.lower.find(b">", tag) if tag >= 0 else -1
+            if end < 0:
+                # Back up in case the tag is split across chunks
+                self.searchFrom = max(self.searchFrom, len(self.lower) - 6 if tag < 0 else tag)
+            else:
+                self.titleStart = end + 1
+                self.searchFrom = self.titleStart
+
+        if self.titleStart is not None:
+            end = self.lower.find(b"</title", self.searchFrom)
+            if end >= 0:
+                self.finish(self.decode(self.data[self.titleStart:end]))
+                return
+            self.searchFrom = max(self.searchFrom, len(self.lower) - 7)
+
+        if len(self.data) >= self.maxBytes:
+            self.finish(None)
+
+    def decode(self, raw):
+        charset = findCharset(self.contentType, bytes(self.data[:self.titleStart]))
+        title = " ".join(html.unescape(raw.decode(charset, "replace")).split())
+        return title or None
+
+    def finish(self, title):
+        self.done = True
+        self.data = self.lower = None
+        self.finished.callback(title)
+        if self.length is None or self.length - self.received > MAX_DRAIN_BYTES:
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if not self.done:
+            self.done = True
+            self.finished.callback(None)
+
+def readTitle(response, maxBytes=MAX_TITLE_BYTES):
+    """Read the title from response's body. Returns a Deferred that fires with it, or None."""
+    contentType = (response.headers.getRawHeaders(b"content-type") or [b""])[0]
+    length = response.length if isinstance(response.length, int) else None
+    return deliverBody(response, lambda finished: TitleExtractor(finished, contentType, maxBytes, length))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import re
+import time
+import ipaddress
+
+from urllib.parse import urlsplit
+
+from twisted.internet import defer
+
+from Cache import TtlCache, SingleFlight
+from TitleExtractor import readTitle
+
+def siteTitle(title):
+    """Drop the " - Site name" that sites add to the end of their page titles"""
+    return title.rsplit(" - ", 1)[0]
+
+class Site():
+    """A kind of link whose page title gthx can look up
+
+    pattern is searched for in each line, and lines without one of the
+    (lower case) hints in them are skipped without running it. The DB
+    methods named by addRef and addTitle count mentions and save titles,
+    for sites that have a table for that.
+
+    titled and untitled are the replies, formatted with user, title, id and
+    refs. untitled may be None to say nothing when there's no title.
+    """
+
+    name = "link"
+    pattern = r"https?://[^\s<>\"']+"
+    hints = ("http://", "https://")
+    addRef = None
+    addTitle = None
+    titled = '%(user)s linked to "%(title)s"'
+    untitled = None
+
+    def matches(self, url):
+        return re.search(self.pattern, url, re.IGNORECASE) is not None
+
+    def itemId(self, match):
+        return match.group(0)
+
+    def pageUrl(self, itemId):
+        return itemId
+
+    def cleanTitle(self, title):
+        return title
+
+class ThingiverseSite(Site):
+    name = "thingiverse"
+    pattern = r"http(s)?:\/\/www.thingiverse.com\/thing:(\d+)"
+    hints = ("thingiverse.com/thing:",)
+    addRef = "addThingiverseRef"
+    addTitle = "addThingiverseTitle"
+    titled = '%(user)s linked to "%(title)s" on thingiverse => %(refs)s IRC mentions'
+    untitled = '%(user)s linked to thing %(id)s on thingiverse => %(refs)s IRC mentions'
+
+    def itemId(self, match):
+        return int(match.group(2))
+
+    def pageUrl(self, thingId):
+        return 'https://www.thingiverse.com/thing:%s' % thingId
+
+    def cleanTitle(self, title):
+        return siteTitle(title)
+
+class YoutubeSite(Site):
+    name = "youtube"
+    pattern = r"http(s)?:\/\/(www\.youtube\.com\/watch\?v=|youtu\.be\/)([\w\-]*)(\S*)"
+    hints = ("youtube.com/watch?v=", "youtu.be/")
+    addRef = "addYoutubeRef"
+    addTitle = "addYoutubeTitle"
+    titled = '%(user)s linked to YouTube video "%(title)s" => %(refs)s IRC mentions'
+    untitled = '%(user)s linked to a YouTube video with an unknown title (ID: %(id)s)  => %(refs)s IRC mentions'
+
+    def itemId(self, match):
+        return match.group(3)
+
+    def pageUrl(self, youtubeId):
+        return 'https://www.youtube.com/watch?v=%s' % youtubeId
+
+    def cleanTitle(self, title):
+        return siteTitle(title)
+
+# Sites with their own handling, tried before the generic Site
+SITES = (ThingiverseSite(), YoutubeSite())
+
+def isPublicUrl(url):
+    """False for links to localhost or private addresses, which we shouldn't fetch
+
+    Only catches hosts given as names like "localhost" or as IP addresses,
+    not public names that resolve to private addresses.
+    """
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return False
+    if not host or host == "localhost" or host.endswith(".localhost") or host.endswith(".local"):
+        return False
+    try:
+        return ipaddress.ip_address(host).is_global
+    except ValueError:
+        return True
+
+class UrlResolver():
+    """Finds the titles of linked pages
+
+    Titles are cached for ttl seconds, and failed lookups for failureTtl so
+    a dead link isn't fetched on every mention. Mentions of a link whose
+    title is already being fetched wait for that fetch rather than starting
+    another. The HttpClient limits how many fetches run at once, overall
+    and per host.
+
+    Only for use from the reactor thread.
+    """
+
+    def __init__(self, httpClient, cacheSize=1000, ttl=3600, failureTtl=300, clock=time.time):
+        self.httpClient = httpClient
+        self.failureTtl = failureTtl
+        # Titles by (site name, id). "" means the lookup found no title.
+        self.cache = TtlCache(cacheSize, ttl, clock)
+        self.fetches = SingleFlight()
+
+    def resolve(self, site, itemId, saveTitle=None):
+        """Returns a Deferred that fires with the title of site's page for itemId, or None
+
+        saveTitle(title) is called once for each title that's fetched and
+        may return a Deferred.
+        """
+        key = (site.name, itemId)
+        title = self.cache.get(key)
+        if title is not None:
+            return defer.succeed(title or None)
+        return self.fetches.run(key, self.fetch, key, site, site.pageUrl(itemId), saveTitle)
+
+    def fetch(self, key, site, url, saveTitle):
+        print("Attemping to get title for %s" % url)
+        if not isPublicUrl(url):
+            print("Not fetching %s, it isn't a public address" % url)
+            self.cache.put(key, "", self.failureTtl)
+            return defer.succeed(None)
+
+        def queryResponse(response):
+            if response.code == 200:
+                return readTitle(response)
+            print("Got error response from %s: %s %s" % (url, response.code, response.phrase))
+            return None
+
+        def failed(failure):
+            print("Failed to get the title of %s: %s" % (url, failure.getErrorMessage()))
+            return None
+
+        def gotTitle(title):
+            if title:
+                title = site.cleanTitle(title)
+            if not title:
+                print("No title found for %s" % url)
+                self.cache.put(key, "", self.failureTtl)
+                return None
+            print("The title for %s is: %s" % (url, title))
+            self.cache.put(key, title)
+            if not saveTitle:
+                return title
+            return defer.maybeDeferred(saveTitle, title).addCallback(lambda ignored: title)
+
+        d = self.httpClient.get(url, queryResponse)
+        d.addErrback(failed)
+        return d.addCallback(gotTitle)
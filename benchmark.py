@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for gthx message handling
+
+Runs lines through Gthx with a fake IRC transport, so the numbers only
+measure the bot's own work and, optionally, the DB.
+
+With no log file, runs microbenchmarks of canned chatter and commands.
+
+With --replay, replays a recorded IRC log and reports events/sec, latency
+percentiles for each kind of event and DB round trips per event. The log
+can be plain text in irssi's format:
+
+    12:34 <nick> message
+    12:34  * nick does something
+    12:34 -!- nick [user@host] has joined #channel
+    12:34 -!- nick [user@host] has left #channel [reason]
+    12:34 -!- nick [user@host] has quit [reason]
+    12:34 -!- nick is now known as newnick
+    12:34 -!- nick was kicked from #channel by kicker [reason]
+
+or JSONL with one event per line:
+
+    {"type": "privmsg", "user": "nick", "channel": "#channel", "message": "hi"}
+
+where type is privmsg, action, join, part, quit, nick or kick, and the
+other keys are user, channel, message, newnick and kicker as needed.
+
+By default the DB is a stub that answers straight away, and every call
+to it counts as a round trip. --memory keeps real data in memory, so
+factoids, tells and seen answers come out as they would in production,
+and also counts every call. --mysql uses the DB in gthx.config.local
+instead, and --sqlite uses an SQLite file. Both count the statements and
+commits actually sent. They write to the DB, so only point them at a
+scratch one.
+
+With --titles, times finding the <title> in recorded HTML pages, or in
+made up ones if none are given, and reports how much of each page had to
+be read. It compares TitleExtractor with the line-by-line regex that was
+used before.
+
+With --stats, loads the website's stats API (StatsServer) on a local port
+with COUNT requests, a few at a time, and reports requests/sec and latency
+percentiles with the result cache on and off. The DB is filled with made
+up factoids and references first; it's in memory unless --mysql or
+--sqlite is given.
+
+Usage: benchmark.py [-n COUNT] [--replay LOG [--channel CHANNEL] [--memory | --mysql | --sqlite FILE]]
+       benchmark.py [-n COUNT] --titles [PAGE ...]
+       benchmark.py [-n COUNT] --stats [--concurrency N] [--mysql | --sqlite FILE]
+"""
+
+import io
+import re
+import json
+import time
+import argparse
+import contextlib
+import configparser
+
+from twisted.internet import defer, task
+from twisted.internet.testing import StringTransport
+from twisted.web.client import Agent, readBody
+
+import gthx
+import StatsServer
+from AsyncDbAccess import AsyncDbAccess
+from DbAccess import DbAccess
+from SqliteDbAccess import SqliteDbAccess
+from MemoryDbAccess import MemoryDbAccess
+from TitleExtractor import TitleExtractor
+from UrlResolver import UrlResolver
+
+NICK = "gthx"
+TRACKED = "kthx"
+CHANNEL = "#reprap"
+
+CHATTER = [
+    "anyone here printed PETG on a glass bed before",
+    "my extruder keeps clicking after about ten minutes of printing",
+    "lol",
+    "I think the hotend fan is wired backwards",
+    "brb, coffee",
+    "the new firmware fixed my layer shift problems",
+    "has anyone tried the bltouch clone from aliexpress",
+    "ok thanks, that makes sense",
+]
+
+COMMANDS = [
+    "gthx: status?",
+    "gthx: tell bob the prints are done",
+    "seen alice?",
+    "gthx: google pla temperature for bob",
+    "gthx: petg is a copolyester",
+    "petg?",
+    "prusa i3?",
+    "info petg",
+    "gthx: forget petg",
+    "look at http://www.thingiverse.com/thing:12345",
+    "check https://www.youtube.com/watch?v=dQw4w9WgXcQ it's great",
+]
+
+class StubDb():
+    """Stands in for DbAccess, answering every call straight away"""
+
+    results = {
+        "seen": (),
+        "getTell": (),
+        "getFactoid": None,
+        "infoFactoid": None,
+        "mood": 0,
+        "addTell": True,
+        "addFactoid": True,
+        "forgetFactoid": True,
+        "addThingiverseRef": ((1, "A thing"),),
+        "addYoutubeRef": ((1, "A video"),),
+    }
+
+    def __init__(self):
+        self.roundTrips = 0
+
+    def hasTell(self, recipient):
+        # Answered from memory by the real DbAccess
+        return False
+
+    def tellsCurrent(self):
+        return True
+
+    def __getattr__(self, name):
+        result = self.results.get(name)
+        def call(*args, **kwargs):
+            self.roundTrips = self.roundTrips + 1
+            return result
+        return call
+
+class CountingMemoryDb():
+    """Counts every call to a MemoryDbAccess as a round trip, like StubDb"""
+
+    def __init__(self):
+        self.db = MemoryDbAccess()
+        self.roundTrips = 0
+
+    def hasTell(self, recipient):
+        return self.db.hasTell(recipient)
+
+    def tellsCurrent(self):
+        return self.db.tellsCurrent()
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+        def call(*args, **kwargs):
+            self.roundTrips = self.roundTrips + 1
+            return method(*args, **kwargs)
+        return call
+
+class CountingProxy():
+    """Passes everything through to target, counting calls to the given methods"""
+    def __init__(self, owner, target, counted):
+        self.owner = owner
+        self.target = target
+        self.counted = counted
+
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if name not in self.counted:
+            return attr
+        def call(*args, **kwargs):
+            self.owner.roundTrips = self.owner.roundTrips + 1
+            return attr(*args, **kwargs)
+        return call
+
+class Counting():
+    """Mixed into a DbAccess to count the statements and commits it sends"""
+    roundTrips = 0
+
+    @property
+    def db(self):
+        return CountingProxy(self, DbAccess.db.fget(self), ("commit", "rollback"))
+
+    @property
+    def cur(self):
+        return CountingProxy(self, DbAccess.cur.fget(self), ("execute", "executemany"))
+
+class CountingDbAccess(Counting, DbAccess):
+    pass
+
+class CountingSqliteDbAccess(Counting, SqliteDbAccess):
+    pass
+
+class StubEmail():
+    def send(self, subject, body):
+        pass
+
+class StubHttpClient():
+    """Answers every title lookup straight away as if the page had no title"""
+
+    def get(self, url, receive):
+        return defer.succeed(None)
+
+def mysqlDb():
+    config = configparser.ConfigParser()
+    if not config.read('gthx.config.local'):
+        raise SystemExit("Failed to read config file 'gthx.config.local'")
+    return CountingDbAccess(config.get('MYSQL','GTHX_MYSQL_HOST'),
+                            config.get('MYSQL','GTHX_MYSQL_USER'),
+                            config.get('MYSQL','GTHX_MYSQL_PASSWORD'),
+                            config.get('MYSQL','GTHX_MYSQL_DATABASE'))
+
+def makeBot(db, channels=(CHANNEL,)):
+    class Factory():
+        pass
+    Factory.channels = ",".join(channels)
+    gthx.trackednick = TRACKED
+    # With no reactor every DB call runs inline. Flood control would hold
+    # replies back for a reactor that isn't running, so give it a huge bucket.
+    bot = gthx.Gthx(AsyncDbAccess(db), None, sendRate=1e9, sendBurst=1e9)
+    bot.factory = Factory()
+    bot.nickname = NICK
+    bot.emailClient = StubEmail()
+    bot.urlResolver = UrlResolver(StubHttpClient())
+    transport = StringTransport()
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.makeConnection(transport)
+        bot.signedOn()
+    # Pretend kthx went away so we answer everything
+    for channel in channels:
+        bot.trackedpresent[channel] = False
+    return bot, transport
+
+def run(bot, transport, lines, count):
+    """Send count messages, cycling through lines. Returns messages/sec."""
+    users = ["user%d!~user@example.com" % i for i in range(20)]
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        start = time.perf_counter()
+        for i in range(count):
+            bot.privmsg(users[i % len(users)], CHANNEL, lines[i % len(lines)])
+            if i % 1000 == 0:
+                transport.clear()
+                out.seek(0)
+                out.truncate()
+        elapsed = time.perf_counter() - start
+    transport.clear()
+    return count / elapsed
+
+def runRouting(bot, lines, count):
+    """Time only working out which commands each line contains"""
+    # Nobody can be answered, so every handler returns straight away
+    message = gthx.Message("user", CHANNEL, CHANNEL, False, False, False)
+    start = time.perf_counter()
+    for i in range(count):
+        bot.router.route(lines[i % len(lines)], message)
+    return count / (time.perf_counter() - start)
+
+def microbenchmarks(count):
+    bot, transport = makeBot(StubDb())
+    for name, lines in (("chatter", CHATTER), ("commands", COMMANDS), ("mixed", CHATTER * 9 + COMMANDS)):
+        # Best of 3 to smooth out noise
+        rate = max(run(bot, transport, lines, count) for i in range(3))
+        print("%-10s %10.0f messages/sec" % (name, rate))
+        rate = max(runRouting(bot, lines, count) for i in range(3))
+        print("%-10s %10.0f messages/sec (routing only)" % (name, rate))
+        print("%-10s %s" % ("", bot.routedString()))
+        bot.linesReceived = bot.linesRouted = 0
+
+# The line-by-line regex that title fetches used before TitleExtractor
+oldTitleRegex = re.compile(rb"<title>(.*) - .*</title>", re.IGNORECASE)
+
+def syntheticPages():
+    """Pages shaped like the ones we fetch, for when no recorded pages are given"""
+    script = b"<script>var ytInitialData = {" + b'"key": "value", ' * 4000 + b"};</script>\n"
+    return [
+        ("title first", b"<html><head><title>A thing - Thingiverse</title></head><body>" + script * 40 + b"</body></html>"),
+        ("title after 200KB", b"<html><head>" + script * 3 + b"<title>Some video - YouTube</title></head><body>" + script * 40 + b"</body></html>"),
+        ("no title", b"<html><head></head><body>" + script * 40 + b"</body></html>"),
+    ]
+
+def extractTitle(page, chunkSize):
+    """Feed page to a TitleExtractor a chunk at a time. Returns (title, bytes read)."""
+    class Transport():
+        stopped = False
+        def stopProducing(self):
+            self.stopped = True
+    results = []
+    extractor = TitleExtractor(defer.Deferred().addCallback(results.append))
+    transport = Transport()
+    extractor.makeConnection(transport)
+    read = 0
+    while read < len(page) and not transport.stopped:
+        extractor.dataReceived(page[read:read + chunkSize])
+        read = read + chunkSize
+    extractor.connectionLost(None)
+    return results[0], min(read, len(page))
+
+def oldExtractTitle(page):
+    """What TitleParser did: search each line until the title turns up"""
+    read = 0
+    for line in io.BytesIO(page):
+        read = read + len(line)
+        match = oldTitleRegex.search(line)
+        if match:
+            return match.group(1), read
+    return None, len(page)
+
+def titleBenchmarks(paths, count, chunkSize=16 * 1024):
+    pages = [(path, open(path, "rb").read()) for path in paths] or syntheticPages()
+    print("%-20s %9s %12s %12s %10s %10s" % ("page", "KB", "old KB read", "new KB read", "old us", "new us"))
+    for name, page in pages:
+        start = time.perf_counter()
+        for i in range(count):
+            oldTitle, oldRead = oldExtractTitle(page)
+        oldTime = (time.perf_counter() - start) / count
+        start = time.perf_counter()
+        for i in range(count):
+            title, read = extractTitle(page, chunkSize)
+        newTime = (time.perf_counter() - start) / count
+        print("%-20s %9.0f %12.0f %12.0f %10.1f %10.1f  %s" % (name[-20:], len(page) / 1024.0, oldRead / 1024.0, read / 1024.0, oldTime * 1e6, newTime * 1e6, title))
+
+textFormats = [
+    ("privmsg", re.compile(r"<[@+%~&]?([^>\s]+)> ?(.*)")),
+    ("action", re.compile(r" ?\* (\S+) (.*)")),
+    ("join", re.compile(r"-!- (\S+) \[[^\]]*\] has joined (\S+)")),
+    ("part", re.compile(r"-!- (\S+) \[[^\]]*\] has left (\S+)")),
+    ("quit", re.compile(r"-!- (\S+) \[[^\]]*\] has quit \[(.*)\]")),
+    ("nick", re.compile(r"-!- (\S+) is now known as (\S+)")),
+    ("kick", re.compile(r"-!- (\S+) was kicked from (\S+) by (\S+) \[(.*)\]")),
+]
+timestamp = re.compile(r"\[?\d\d:\d\d(:\d\d)?\]? ")
+
+def parseText(line, channel):
+    """Turn an irssi-style log line into an event, or None if it isn't one we replay"""
+    line = timestamp.sub("", line.rstrip("\r\n"), count=1)
+    for kind, regex in textFormats:
+        m = regex.match(line)
+        if not m:
+            continue
+        if kind in ("privmsg", "action"):
+            return {"type": kind, "user": m.group(1), "channel": channel, "message": m.group(2)}
+        if kind in ("join", "part"):
+            return {"type": kind, "user": m.group(1), "channel": m.group(2)}
+        if kind == "quit":
+            return {"type": kind, "user": m.group(1), "message": m.group(2)}
+        if kind == "nick":
+            return {"type": kind, "user": m.group(1), "newnick": m.group(2)}
+        return {"type": kind, "user": m.group(1), "channel": m.group(2), "kicker": m.group(3), "message": m.group(4)}
+    return None
+
+def readLog(path, channel):
+    events = []
+    with open(path, encoding="utf-8", errors="replace") as log:
+        for line in log:
+            if not line.strip():
+                continue
+            if line.lstrip().startswith("{"):
+                event = json.loads(line)
+                event.setdefault("channel", channel)
+            else:
+                event = parseText(line, channel)
+            if event:
+                events.append(event)
+    return events
+
+def eventName(bot, event):
+    """What to file an event's latency under
+
+    The event type, or for messages the first command the line matches.
+    """
+    if event["type"] != "privmsg":
+        return event["type"]
+    text = event["message"]
+    if not bot.mightBeCommand(text):
+        return "chatter"
+    m = bot.matchNick.match(text)
+    if m:
+        text = m.group(3)
+    for command in bot.router.classify(text):
+        if not command.regex or command.match(text):
+            return command.name
+    return "other"
+
+def dispatch(bot, event):
+    kind = event["type"]
+    user = event.get("user")
+    if kind == "privmsg":
+        bot.privmsg("%s!~%s@example.com" % (user, user), event["channel"], event["message"])
+    elif kind == "action":
+        bot.action("%s!~%s@example.com" % (user, user), event["channel"], event["message"])
+    elif kind == "join":
+        bot.userJoined(user, event["channel"])
+    elif kind == "part":
+        bot.userLeft(user, event["channel"])
+    elif kind == "quit":
+        bot.userQuit(user, event.get("message", ""))
+    elif kind == "nick":
+        bot.userRenamed(user, event["newnick"])
+    elif kind == "kick":
+        bot.userKicked(user, event["channel"], event["kicker"], event.get("message", ""))
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def replay(path, channel, db):
+    events = readLog(path, channel)
+    if not events:
+        raise SystemExit("No events found in %s" % path)
+    channels = sorted(set(event["channel"] for event in events if event.get("channel")))
+    bot, transport = makeBot(db, channels)
+    names = [eventName(bot, event) for event in events]
+
+    latencies = {}
+    roundTrips = {}
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        start = time.perf_counter()
+        for i, event in enumerate(events):
+            before = db.roundTrips
+            eventStart = time.perf_counter()
+            dispatch(bot, event)
+            latencies.setdefault(names[i], []).append(time.perf_counter() - eventStart)
+            roundTrips[names[i]] = roundTrips.get(names[i], 0) + db.roundTrips - before
+            if i % 1000 == 0:
+                transport.clear()
+                out.seek(0)
+                out.truncate()
+        elapsed = time.perf_counter() - start
+        # Buffered writes are part of the cost too
+        before = db.roundTrips
+        bot.db.flush()
+        flushed = db.roundTrips - before
+
+    total = db.roundTrips - flushed
+    print("Replayed %d events in %.2f seconds: %.0f events/sec" % (len(events), elapsed, len(events) / elapsed))
+    print("DB round trips: %.3f per event (%d, plus %d to flush at the end)" % (total / float(len(events)), total, flushed))
+    print(bot.routedString())
+    print()
+    print("%-14s %8s %10s %10s %10s %10s %9s" % ("event", "count", "p50 us", "p90 us", "p99 us", "max us", "DB/event"))
+    for name in sorted(latencies, key=lambda name: -len(latencies[name])):
+        values = sorted(latencies[name])
+        print("%-14s %8d %10.1f %10.1f %10.1f %10.1f %9.2f" % (name, len(values),
+              percentile(values, 50) * 1e6, percentile(values, 90) * 1e6,
+              percentile(values, 99) * 1e6, values[-1] * 1e6, roundTrips[name] / float(len(values))))
+
+def fillStatsDb(db, factoids=2000, refs=500):
+    for i in range(factoids):
+        db.addFactoid("someuser", "factoid%d" % i, False, "value number %d" % i, False)
+        if i % 10 == 0:
+            db.addFactoid("someuser", "factoid%d" % i, True, "another value", False)
+        for j in range(i % 7):
+            db.getFactoid("factoid%d" % i)
+    for i in range(refs):
+        for j in range(i % 5 + 1):
+            db.addThingiverseRef(i)
+            db.addYoutubeRef("video%d" % i)
+        db.addThingiverseTitle(i, "Thing %d" % i)
+    db.flush()
+
+def statsLoad(reactor, port, count, concurrency):
+    """Make count requests to the stats API, concurrency at a time
+
+    Returns a Deferred that fires with the elapsed time and a sorted list of latencies.
+    """
+    agent = Agent(reactor)
+    queries = ["type=%s&range=%s&order=%s" % (type, range, order)
+               for type in StatsServer.TYPES for range in StatsServer.RANGES for order in StatsServer.ORDERS]
+    latencies = []
+
+    def one(i):
+        url = "http://127.0.0.1:%d/?%s" % (port, queries[i % len(queries)])
+        start = time.perf_counter()
+        def done(body):
+            if json.loads(body)["status"] != "success":
+                raise RuntimeError("Stats request failed: %s" % body)
+            latencies.append(time.perf_counter() - start)
+        return agent.request(b"GET", url.encode("ascii")).addCallback(readBody).addCallback(done)
+
+    work = (one(i) for i in range(count))
+    cooperator = task.Cooperator()
+    start = time.perf_counter()
+    d = defer.gatherResults([cooperator.coiterate(work) for i in range(concurrency)], consumeErrors=True)
+    d.addCallback(lambda result: (time.perf_counter() - start, sorted(latencies)))
+    return d
+
+@defer.inlineCallbacks
+def statsBenchmarks(reactor, db, count, concurrency):
+    asyncDb = AsyncDbAccess(db, reactor)
+    print("%-10s %8s %10s %10s %10s %10s %10s" % ("cache", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "queries"))
+    for name, ttl in (("10s", 10), ("off", 0)):
+        site = StatsServer.makeSite(asyncDb, ttl)
+        listener = reactor.listenTCP(0, site, interface="127.0.0.1")
+        elapsed, latencies = yield statsLoad(reactor, listener.getHost().port, count, concurrency)
+        yield listener.stopListening()
+        print("%-10s %8.0f %10.2f %10.2f %10.2f %10.2f %10d" % (name, count / elapsed,
+              percentile(latencies, 50) * 1e3, percentile(latencies, 90) * 1e3,
+              percentile(latencies, 99) * 1e3, latencies[-1] * 1e3, site.resource.dbQueries))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gthx message handling")
+    parser.add_argument("-n", "--count", type=int, default=20000, help="messages per microbenchmark run")
+    parser.add_argument("--replay", metavar="LOG", help="replay a plain text or JSONL IRC log")
+    parser.add_argument("--titles", metavar="PAGE", nargs="*", help="benchmark title extraction on recorded HTML pages, or made up ones if none are given")
+    parser.add_argument("--channel", default=CHANNEL, help="channel for log lines that don't name one")
+    parser.add_argument("--memory", action="store_true", help="use an in-memory DB instead of a stub")
+    parser.add_argument("--mysql", action="store_true", help="use the DB in gthx.config.local instead of a stub")
+    parser.add_argument("--sqlite", metavar="FILE", help="use an SQLite DB instead of a stub")
+    parser.add_argument("--stats", action="store_true", help="load test the website's stats API")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight at once for --stats")
+    args = parser.parse_args()
+
+    if args.stats:
+        if args.mysql or args.sqlite:
+            db = SqliteDbAccess(args.sqlite) if args.sqlite else mysqlDb()
+        else:
+            db = MemoryDbAccess()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fillStatsDb(db)
+        task.react(statsBenchmarks, (db, args.count, args.concurrency))
+    elif args.titles is not None:
+        titleBenchmarks(args.titles, max(1, args.count // 1000))
+    elif not args.replay:
+        microbenchmarks(args.count)
+    elif args.memory:
+        replay(args.replay, args.channel, CountingMemoryDb())
+    elif args.mysql or args.sqlite:
+        db = CountingSqliteDbAccess(args.sqlite) if args.sqlite else mysqlDb()
+        replay(args.replay, args.channel, db)
+        db.close()
+    else:
+        replay(args.replay, args.channel, StubDb())
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,8 @@ CREATE TABLE `factoid_history` (
   `value` varchar(512) DEFAULT NULL,
   `nick` varchar(30) DEFAULT NULL,
   `dateset` datetime(6) DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `item_dateset` (`item`, `dateset`)
 );
 
 CREATE TABLE `factoids` (
@@ -22,7 +23,8 @@ CREATE TABLE `factoids` (
   `dateset` datetime DEFAULT NULL,
   `locked` tinyint(1) DEFAULT NULL,
   `lastsync` datetime DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `item` (`item`)
 );
 
 # Add locked botsnack and botsmack factoids?
@@ -33,7 +35,8 @@ CREATE TABLE `seen` (
   `channel` varchar(30) DEFAULT NULL,
   `timestamp` datetime DEFAULT NULL,
   `message` varchar(512) DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name` (`name`)
 );
 
 CREATE TABLE `tell` (
@@ -43,7 +46,8 @@ CREATE TABLE `tell` (
   `timestamp` datetime DEFAULT NULL,
   `message` text,
   `inTracked` tinyint(1) DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `recipient` (`recipient`)
 );
 
 CREATE TABLE `refs` (
@@ -74,4 +78,4 @@ CREATE TABLE `version` (
   `timestamp` datetime DEFAULT NULL
 );
 
-INSERT INTO version (version, timestamp) VALUES (5, CURRENT_TIMESTAMP);
+INSERT INTO version (version, timestamp) VALUES (6, CURRENT_TIMESTAMP);
@@ -9,28 +9,37 @@ Responds for "seen", "tell", factoids
 
 # twisted imports
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol, error
+from twisted.internet import reactor, protocol, error, task
 from twisted.python import log
-from twisted.web.client import Agent
-from twisted.web.http_headers import Headers
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet import defer
 from twisted.internet.defer import Deferred
 
 # system imports
 import time, sys, re, os
 import traceback
+import functools
 import urllib.request, urllib.parse, urllib.error
 import configparser
 
-from html.parser import HTMLParser
 
 from datetime import datetime
 
 from DbAccess import DbAccess
 from DbAccess import Seen
 from DbAccess import Tell
+from SqliteDbAccess import SqliteDbAccess
+from AsyncDbAccess import AsyncDbAccess
+from CommandRouter import CommandRouter
+from OutputQueue import OutputQueue, CONTROL, REPLY, TELL, TITLE
+from HttpClient import HttpClient
+from UrlResolver import UrlResolver, Site, SITES
+import DbMigrations
 
 from Email import Email
+from Notifier import Notifier
+from Presence import Presence, Prober
+from FactoidSync import FactoidSync
+import StatsServer
 
 from pprint import pprint
 
@@ -40,29 +49,16 @@ channel = ""
 mynick = ""
 
 
-def unescape(htmlString):
-    h = HTMLParser()
-    return h.unescape(htmlString).encode("utf-8")
-
-class TitleParser(LineOnlyReceiver):
-    def __init__(self, finished):
-        self.title = None
-        self.finished = finished
-        self.delimiter='\n'
-        self.titleQuery = re.compile("<title>(.*) - .*<\/title>", re.IGNORECASE | re.MULTILINE)
-
-    def lineReceived(self, line):
-        if not line: return
-        match = self.titleQuery.search(line)
-        if match:
-            self.title = match.group(1)
-            print("Got title of: ", self.title)
-            self.loseConnection()
-                
-    def connectionLost(self, reason):
-        print('Finished receiving body:', reason.getErrorMessage())
-        self.finished.callback(self.title)
-            
+class Message():
+    """An incoming line, as seen by the command handlers"""
+    def __init__(self, user, channel, replyChannel, canReply, directAddress, private):
+        self.user = user
+        self.channel = channel
+        self.replyChannel = replyChannel
+        self.canReply = canReply
+        self.directAddress = directAddress
+        self.private = private
+
 def timesincestring(firsttime):
         since = datetime.now() - firsttime
         years = since.days / 365
@@ -107,25 +103,44 @@ class Gthx(irc.IRCClient):
     
     restring = ""
 
-    def __init__(self, dbHost, dbUser, dbPassword, dbDatabase, nickservPassword):
-        self.db = DbAccess(dbHost, dbUser, dbPassword, dbDatabase)
+    def __init__(self, db, nickservPassword, sendRate=1.0, sendBurst=5, titleAllLinks=False, presencePollInterval=60, probeQuery=None, probeInterval=60, probeTimeout=10, probeMaxMisses=2, factoidSync=True):
+        # An AsyncDbAccess, shared by every connection the factory makes
+        self.db = db
+        # Everything we send goes through this to stay under the server's
+        # flood limits. msg() sets the target and priority for its lines.
+        self.sendQueue = OutputQueue(self.reallySendLine, reactor, sendRate, sendBurst)
+        self.sendTarget = None
+        self.sendPriority = CONTROL
         # Just setting this variable sets the nickserv login password
         # (Maybe? We still do our own procesing later)
         self.password = nickservPassword
         
-        print("Connected to MySQL server")
-        
         self.trackedpresent = dict()
         self.gotwhoischannel = False
-        self.seenQuery = re.compile("\s*seen\s+([a-zA-Z\*_\\\[\]\{\}^`|\*][a-zA-Z0-9\*_\\\[\]\{\}^`|-]*)[\s\?]*$")
-        self.tellQuery = re.compile("\s*tell\s+([a-zA-Z\*_\\\[\]\{\}^`|\*][a-zA-Z0-9\*_\\\[\]\{\}^`|-]*)\s*(.+)")
-        self.factoidQuery = re.compile("(.+)[?!](\s*$|\s*\|\s*([a-zA-Z\*_\\\[\]\{\}^`|\*][a-zA-Z0-9\*_\\\[\]\{\}^`|-]*)$)")
-        self.factoidSet = re.compile("(.+?)\s(is|are)(\salso)?\s(.+)")
-        self.googleQuery = re.compile("\s*google\s+(.*?)\s+for\s+([a-zA-Z\*_\\\[\]\{\}^`|\*][a-zA-Z0-9\*_\\\[\]\{\}^`|-]*)")
-        self.thingMention = re.compile("http(s)?:\/\/www.thingiverse.com\/thing:(\d+)", re.IGNORECASE)
-        self.youtubeMention = re.compile("http(s)?:\/\/(www\.youtube\.com\/watch\?v=|youtu\.be\/)([\w\-]*)(\S*)", re.IGNORECASE)
+        # Whether the tracked nick is on the network at all. Started once
+        # we know if the server has MONITOR.
+        self.presence = None
+        if trackednick:
+            self.presence = Presence(trackednick, self.sendLine, reactor, self.trackedPresenceChanged, presencePollInterval)
+        # Optionally, whether it still answers while it's online
+        self.prober = None
+        if trackednick and probeQuery:
+            self.prober = Prober(probeQuery, self.sendProbe, reactor, self.trackedResponsivenessChanged, probeInterval, probeTimeout, probeMaxMisses)
+        # Learns factoids from the tracked bot's answers
+        self.factoidSync = None
+        if trackednick and factoidSync:
+            self.factoidSync = FactoidSync(reactor)
+        self.invalidWords = re.compile('(here|how|it|something|that|this|what|when|where|which|who|why|you)', re.IGNORECASE)
+        # Whether to look up titles for links to any site, not just the
+        # ones in SITES
+        self.titleAllLinks = titleAllLinks
+        self.router = self.makeRouter()
         self.uptimeStart = datetime.now()
+        # How many lines we've had and how many got past mightBeCommand
+        self.linesReceived = 0
+        self.linesRouted = 0
         self.lurkerReplyChannel = ""
+        self.lurkerNicks = []
 
     def connectionMade(self):
         if self.password:
@@ -154,14 +169,40 @@ class Gthx(irc.IRCClient):
 
     def connectionLost(self, reason):
         irc.IRCClient.connectionLost(self, reason)
+        self.sendQueue.clear()
+        if self.presence:
+            self.presence.stop()
+        if self.prober:
+            self.prober.stop()
+        self.db.flush().addErrback(self.dbError, "flush")
         self.log("[disconnected at %s]" % time.asctime(time.localtime(time.time())))
         self.emailClient.send("%s disconnected" % self.nickname, "%s is disconnected from the server.\n\n%s" % (self.nickname, reason))
 
+    def sendLine(self, line):
+        self.sendQueue.put(line, self.sendTarget, self.sendPriority)
+
+    def reallySendLine(self, line):
+        irc.IRCClient.sendLine(self, line)
+
+    def msg(self, user, message, length=None, priority=REPLY):
+        """Queue a message with the given priority: REPLY, TELL or TITLE"""
+        self.sendTarget = user
+        self.sendPriority = priority
+        try:
+            irc.IRCClient.msg(self, user, message, length)
+        finally:
+            self.sendTarget = None
+            self.sendPriority = CONTROL
+
     def log(self, message):
         """Write a message to the screen."""
         timestamp = time.strftime("[%H:%M:%S]", time.localtime(time.time()))
         print('%s %s' % (timestamp, message))
 
+    def dbError(self, failure, what):
+        """Errback for DB calls so a failed query doesn't go unnoticed"""
+        self.log("DB call %s failed: %s" % (what, failure.getErrorMessage()))
+
     # callbacks for events
 
     def signedOn(self):
@@ -177,18 +218,91 @@ class Gthx(irc.IRCClient):
         self.gotwhoischannel = False
         # kthx uses: "\s*(${names})[:;,-]?\s*" to match nicks
         if (trackednick):
-            self.matchNick = "(%s|%s)(:|;|,|-|\s)+(.+)" % (self.nickname, trackednick)
-            print("Querying WHOIS %s at startup" % trackednick)
-            self.whois(trackednick)
+            self.matchNick = re.compile("(%s|%s)(:|;|,|-|\s)+(.+)" % (self.nickname, trackednick))
+            self.addressPrefixes = (self.nickname, trackednick)
         else:
-            self.matchNick = "(%s)(:|;|,|-|\s)+(.+)" % (self.nickname)
+            self.matchNick = re.compile("(%s)(:|;|,|-|\s)+(.+)" % (self.nickname))
+            self.addressPrefixes = (self.nickname,)
             print("Running in standalone mode.")
 
+    def receivedMOTD(self, motd):
+        # The server has told us what it supports by now
+        self.startPresence()
+
+    def irc_ERR_NOMOTD(self, prefix, params):
+        self.startPresence()
+
+    def startPresence(self):
+        if self.presence:
+            monitor = self.supported.hasFeature("MONITOR")
+            print("Watching %s with %s" % (trackednick, "MONITOR" if monitor else "ISON"))
+            self.presence.start(monitor)
+
+    def trackedPresenceChanged(self, online, reason):
+        """Called when the tracked nick comes onto or leaves the network"""
+        if online:
+            # Find out which of our channels it's in
+            print("%s is online (%s). Querying WHOIS." % (trackednick, reason))
+            self.gotwhoischannel = False
+            self.whois(trackednick)
+            self.emailClient.send("%s status" % self.nickname, "%s is online: %s" % (trackednick, reason))
+            if self.prober:
+                self.prober.start()
+        else:
+            for channel in self.channelList:
+                self.trackedpresent[channel] = False
+            print("%s is gone (%s)." % (trackednick, reason))
+            self.emailClient.send("%s status" % self.nickname, "%s is offline: %s" % (trackednick, reason))
+            if self.prober:
+                self.prober.stop()
+
+    def sendProbe(self, query):
+        self.msg(trackednick, query, priority=CONTROL)
+
+    def trackedResponsivenessChanged(self, responsive, reason):
+        """Called when the tracked bot stops or starts answering probes"""
+        if responsive:
+            print("%s is answering again." % trackednick)
+            self.emailClient.send("%s status" % self.nickname, "%s is answering again" % trackednick)
+        else:
+            print("%s is present but unresponsive (%s). Taking over." % (trackednick, reason))
+            self.emailClient.send("%s status" % self.nickname, "%s is present but unresponsive: %s" % (trackednick, reason))
+
+    def trackedAnswering(self, channel):
+        """Whether the tracked bot is in channel and answering"""
+        return self.trackedpresent[channel] and (not self.prober or self.prober.responsive)
+
+    def trackedState(self, channel):
+        if not self.trackedpresent[channel]:
+            return "GONE"
+        return "PRESENT" if self.trackedAnswering(channel) else "UNRESPONSIVE"
+
+    def noticed(self, user, channel, message):
+        # Some bots answer private messages with a notice
+        if self.prober and channel == self.nickname and user.split('!', 1)[0] == trackednick:
+            self.prober.alive()
+
+    def irc_730(self, prefix, params):
+        # RPL_MONONLINE
+        self.presence.gotMonitor("730", params[1])
+
+    def irc_731(self, prefix, params):
+        # RPL_MONOFFLINE
+        self.presence.gotMonitor("731", params[1])
+
+    def irc_734(self, prefix, params):
+        # ERR_MONLISTFULL
+        self.presence.gotMonitor("734", params[2])
+
+    def irc_RPL_ISON(self, prefix, params):
+        if self.presence:
+            self.presence.gotIson(params[1])
+
     def joined(self, channel):
         """Called when the bot joins the channel."""
         self.log("[I have joined %s as '%s']" % (channel, self.nickname))
         message = "I have joined channel %s as '%s'\n" % (channel, self.nickname)
-        self.emailClient.threadsend("%s connected" % self.nickname, message)
+        self.emailClient.send("%s connected" % self.nickname, message)
         
     def userJoined(self, user, channel):
         """
@@ -199,7 +313,8 @@ class Gthx(irc.IRCClient):
         if trackednick and (user == trackednick) and (self.trackedpresent[channel] == False):
             self.trackedpresent[channel] = True
             print("%s is here!" % trackednick)
-            self.emailClient.threadsend("%s status" % self.nickname, "%s has joined channel %s" % (user, channel))
+            self.emailClient.send("%s status" % self.nickname, "%s has joined channel %s" % (user, channel))
+            self.presence.update(True, "joined %s" % channel)
                 
             
     def userLeft(self, user, channel):
@@ -210,7 +325,7 @@ class Gthx(irc.IRCClient):
         if trackednick and (user == trackednick) and (self.trackedpresent[channel]):
             self.trackedpresent[channel] = False
             print("%s is gone." % trackednick)
-            self.emailClient.threadsend("%s status" % self.nickname, "%s has left channel %s" % (user, channel))
+            self.emailClient.send("%s status" % self.nickname, "%s has left channel %s" % (user, channel))
 
     def userQuit(self, user, quitMessage):
         """
@@ -219,10 +334,7 @@ class Gthx(irc.IRCClient):
         safeQuitMessage = quitMessage
         print("%s disconnected : %s" % (user, safeQuitMessage))
         if trackednick and (user == trackednick):
-            for channel in self.channelList:
-                self.trackedpresent[channel] = False
-            print("%s is gone." % trackednick)
-            self.emailClient.threadsend("%s status" % self.nickname, "%s has quit: %s" % (user, quitMessage))
+            self.presence.update(False, "quit: %s" % quitMessage)
 
     def userKicked(self, kickee, channel, kicker, message):
         """
@@ -232,7 +344,7 @@ class Gthx(irc.IRCClient):
         if trackednick and (kickee == trackednick) and (self.trackedpresent[channel]):
             self.trackedpresent[channel] = False
             print("%s is gone." % trackednick)
-            self.emailClient.threadsend("%s status" % self.nickname, "%s has been kicked from %s by %s: %s" % (kickee, channel, kicker, message))
+            self.emailClient.send("%s status" % self.nickname, "%s has been kicked from %s by %s: %s" % (kickee, channel, kicker, message))
 
     def userRenamed(self, oldname, newname):
         """
@@ -242,32 +354,36 @@ class Gthx(irc.IRCClient):
         if (trackednick == None):
             return
         if oldname == trackednick:
-            for channel in self.channelList:
-                self.trackedpresent[channel] = False
-            print("%s is gone." % trackednick)
-            self.emailClient.threadsend("%s status" % self.nickname, "%s has been renamed to %s" % (oldname, newname))
+            self.presence.update(False, "renamed to %s" % newname)
         if newname == trackednick:
-            self.whois(trackednick)
-            print("%s is here!" % trackednick)
-            self.emailClient.threadsend("%s status" % self.nickname, "%s has been renamed to %s--checking WHOIS" % (oldname, newname))
+            self.presence.update(True, "renamed from %s" % oldname)
 
     def irc_unknown(self, prefix, command, params):
         print("Unknown command '%s' '%s' '%s'" % (prefix, command, params))
         if (command == 'RPL_NAMREPLY'):
             if (self.lurkerReplyChannel == ""):
                 return
-            users = params[3].split()
-            for user in users:
-                self.channelCount = self.channelCount + 1
-                rows = self.db.seen(user)
-                if len(rows) == 0:
-                       self.lurkerCount = self.lurkerCount + 1
+            # Drop channel mode prefixes like @ and +
+            self.lurkerNicks.extend(user.lstrip("@+%&~") for user in params[3].split())
         elif (command == 'RPL_ENDOFNAMES'):
             if (self.lurkerReplyChannel == ""):
                 return
             print("Got RPL_ENDOFNAMES")
-            self.msg(self.lurkerReplyChannel,"%d of the %d users in %s right now have never said anything." % (self.lurkerCount, self.channelCount, params[1]))
+            replyChannel = self.lurkerReplyChannel
+            nicks = self.lurkerNicks
             self.lurkerReplyChannel = ""
+            self.lurkerNicks = []
+            # One DB call for the whole channel, however big it is
+            def reply(lurkers):
+                if lurkers is None:
+                    failed(None)
+                    return
+                self.msg(replyChannel,"%d of the %d users in %s right now have never said anything." % (lurkers, len(nicks), params[1]))
+            def failed(failure):
+                if failure:
+                    self.dbError(failure, "countUnseen")
+                self.msg(replyChannel, "Sorry, I can't count the lurkers in %s right now." % params[1])
+            self.db.countUnseen(nicks).addCallbacks(reply, failed)
 
     def irc_RPL_WHOISCHANNELS(self, prefix, params):
         """This method is called when the client recieves a reply for whois.
@@ -278,12 +394,12 @@ class Gthx(irc.IRCClient):
         print("Got WHOISCHANNELS with prefix '%s' and params '%s'" % (prefix, params))
         print("%s is in channels %s" % (params[1], params[2]))
         self.gotwhoischannel = True
-        trackedchannels = params[2].translate(None, '@').split(" ")
+        trackedchannels = [channel.lstrip("@+") for channel in params[2].split()]
         for channel in self.channelList:
             if channel in trackedchannels:
                 self.trackedpresent[channel] = True
                 print("%s is in %s!!" %  (params[1], channel))
-                self.emailClient.threadsend("%s status" % self.nickname, "%s is in channel %s" % (params[1], params[2]))
+                self.emailClient.send("%s status" % self.nickname, "%s is in channel %s" % (params[1], params[2]))
             else:
                 self.trackedpresent[channel] = False
                 print("%s is NOT in %s!!" %  (params[1], channel))
@@ -307,10 +423,13 @@ class Gthx(irc.IRCClient):
                 print("No response from %s. Must not be present." % trackednick)
                 for channel in self.channelList:
                     self.trackedpresent[channel] = False
-                    self.emailClient.threadsend("%s status" % self.nickname, "%s is not in channel %s" % (trackednick, channel))
+                    self.emailClient.send("%s status" % self.nickname, "%s is not in channel %s" % (trackednick, channel))
 
     def getFactoidString(self, query):
-        answer = self.db.getFactoid(query)
+        """Look up a factoid and return a Deferred that fires with the reply text"""
+        return self.db.getFactoid(query).addCallback(self.factoidString, query)
+
+    def factoidString(self, answer, query):
         if answer:
             for i, factoid in enumerate(answer):
                 if i == 0:
@@ -368,6 +487,11 @@ class Gthx(irc.IRCClient):
             self.log("Private message from %s: %s" % (user, msg))
             if str.lower(user) == "nickserv":
                 self.log("Nickserv says: %s" % msg)
+            if user == trackednick and self.prober:
+                # An answer to a probe. Don't treat it as a command, or the
+                # two bots could end up talking to each other.
+                self.prober.alive()
+                return
             if parseMsg.startswith("whois "):
                 whoisnick = parseMsg.split(" ",1)[1]
                 print("Doing a whois '%s'" % whoisnick)
@@ -375,49 +499,40 @@ class Gthx(irc.IRCClient):
 
         # Update the seen database, but only if it's not a private message
         if channel in self.channelList and not private:
-            self.db.updateSeen(user,channel,msg)
+            self.db.updateSeen(user,channel,msg).addErrback(self.dbError, "updateSeen")
 
         # If kthx said something, mark him as here and ignore everything he says
         if user == trackednick and not private:
+            if self.prober:
+                self.prober.alive()
+            if self.factoidSync:
+                learned = self.factoidSync.answered(channel, msg)
+                if learned:
+                    self.db.syncFactoid(learned[0], learned[1], user).addErrback(self.dbError, "syncFactoid")
             if (self.trackedpresent[channel] == False):
                 self.trackedpresent[channel] = True
-                self.emailClient.threadsend("%s status" % self.nickname, "%s spoke in %s unexpectedly and got marked as present: %s" % (user, channel,msg))
+                self.emailClient.send("%s status" % self.nickname, "%s spoke in %s unexpectedly and got marked as present: %s" % (user, channel,msg))
+                self.presence.update(True, "spoke in %s" % channel)
             return
         
         # If kthx is gone, then we can always reply
-        if not private and not self.trackedpresent[channel]:
+        if not private and not self.trackedAnswering(channel):
             canReply = True
 
         # Check to see if we have a tell waiting for this user
-        tells = self.db.getTell(user)
-        if tells:
-            for message in tells:
-                print("Found tell for '%s' from '%s'" % (user, message[Tell.author]))
-                author = message[Tell.author]
-                timestring = timesincestring(message[Tell.timestamp])
-                text = message[Tell.message]
-                inTracked = message[Tell.inTracked]
-                # We have 3 cases:
-                # 1) kthx was around when this tell happened and is still around now.
-                #    In this case, we assume kthx will relay the message and just delete it
-                # 2) kthx was around when this tell happened and is not here now.
-                #    In this case, we want to send the message and mention that kthx may repeat it
-                # 3) kthx was not around when this tell happened and may or may not be here now
-                #    Whether or not kthx is now here, we need to say the message
-                # 4) gthx was specifically addressed for this tell
-                #    Whether or not kthx is now here, we need to say the message
-                #
-                # If we can't reply, it means that kthx is present. In that
-                # case, the tell has already been erased, so in both cases,
-                # we're good.
-                if canReply or not inTracked:
-                    if inTracked:
-                        self.msg(replyChannel,"%s: %s ago <%s> tell %s %s (%s may repeat this)" % (user, timestring, author, user, text, trackednick))
-                    else:
-                        self.msg(replyChannel,"%s: %s ago <%s> tell %s %s" % (user, timestring, author, user, text))
+        d = self.db.getTell(user)
+        d.addCallback(self.deliverTells, user, replyChannel, canReply)
+        d.addErrback(self.dbError, "getTell")
+
+        # Most lines are just chatter, so don't bother with the commands
+        # unless a quick look says the line could be one
+        self.linesReceived = self.linesReceived + 1
+        if not self.mightBeCommand(parseMsg):
+            return
+        self.linesRouted = self.linesRouted + 1
 
         # Check for specifically addressed messages
-        m = re.match(self.matchNick, parseMsg)
+        m = self.matchNick.match(parseMsg)
         if m:
             print("Found message addressed to '%s'. My nick is '%s'." % (m.group(1), self.nickname))
             parseMsg = m.group(3)
@@ -426,123 +541,180 @@ class Gthx(irc.IRCClient):
             # If it's addressed directly to me, we can reply
             if m.group(1) == self.nickname:
                 canReply = True
-            
-        # Check for status query
-        if canReply and parseMsg == "status?":
-            if (trackednick):
-                if (private):
-                    reply = "%s: OK; Up for %s; " % (VERSION, timesincestring(self.uptimeStart))
-                    for channel in self.channelList:
-                        reply += "%s %s; " % (channel, "PRESENT" if self.trackedpresent[channel] else "GONE")
-                else:
-                    reply = "%s: OK; Up for %s; %s is %s" % (VERSION, timesincestring(self.uptimeStart), trackednick, "PRESENT" if self.trackedpresent[channel] else "GONE")
+
+        self.router.route(parseMsg, Message(user, channel, replyChannel, canReply, directAddress, private))
+
+    def mightBeCommand(self, msg):
+        """Cheap checks that rule out lines that can't contain a command
+
+        Every command needs the line to be addressed to us or the tracked
+        nick, to end in ? or ! (possibly followed by "| nick"), to
+        contain a link or to start with a command keyword.
+        """
+        if msg.startswith(self.addressPrefixes):
+            return True
+        if msg.rstrip().endswith(("?", "!")) or "|" in msg:
+            return True
+        if "://" in msg:
+            return True
+        words = msg.split(None, 1)
+        return bool(words) and words[0] in self.router.keywords
+
+    def routedString(self):
+        if not self.linesReceived:
+            return "No lines checked for commands yet."
+        return "Checked %d of %d lines (%d%%) for commands." % (self.linesRouted, self.linesReceived, 100 * self.linesRouted / self.linesReceived)
+
+    def makeRouter(self):
+        """Register the commands in the order privmsg should try them"""
+        nick = "([a-zA-Z\*_\\\[\]\{\}^`|\*][a-zA-Z0-9\*_\\\[\]\{\}^`|-]*)"
+        router = CommandRouter()
+        router.addExact("status?", self.statusCommand)
+        router.addExact("lurkers?", self.lurkersCommand)
+        router.addKeyword("tell", "\s*tell\s+%s\s*(.+)" % nick, self.tellCommand)
+        router.addKeyword("seen", "\s*seen\s+%s[\s\?]*$" % nick, self.seenCommand)
+        router.addKeyword("google", "\s*google\s+(.*?)\s+for\s+%s" % nick, self.googleCommand)
+        router.addPattern("factoidSet", "(.+?)\s(is|are)(\salso)?\s(.+)", self.factoidSetCommand, hints=("is", "are"))
+        router.addPattern("factoidQuery", "(.+)[?!](\s*$|\s*\|\s*%s$)" % nick, self.factoidQueryCommand, hints=("?", "!"))
+        router.addKeyword("info", "info (.*)", self.infoCommand)
+        router.addKeyword("forget", "forget (.*)", self.forgetCommand)
+        sites = SITES + (Site(),) if self.titleAllLinks else SITES
+        for site in sites:
+            router.addPattern(site.name, site.pattern, functools.partial(self.linkCommand, site), search=True, flags=re.IGNORECASE, hints=site.hints)
+        return router
+
+    # Command handlers. Each gets the command's match and the Message and
+    # returns True if nothing else should be done with the line.
+
+    def statusCommand(self, m, message):
+        if not message.canReply:
+            return False
+        if (trackednick):
+            if (message.private):
+                reply = "%s: OK; Up for %s; " % (VERSION, timesincestring(self.uptimeStart))
+                for channel in self.channelList:
+                    reply += "%s %s; " % (channel, self.trackedState(channel))
+                reply += self.presence.statsString() + " "
+                if self.prober:
+                    reply += self.prober.statsString() + " "
             else:
-                reply = "%s: OK; Up for %s; standalone mode" % (VERSION, timesincestring(self.uptimeStart))
-            mood = self.db.mood()
-            reply += " mood: %s" % self.moodToString(mood)
-            self.msg(replyChannel, reply)
-            return
-        
-        # Check for lurker query
-        if canReply and parseMsg == "lurkers?":
-            self.msg(replyChannel, "Looking for lurkers...")
-            self.lurkerReplyChannel = replyChannel
-            self.lurkerCount = 0
-            self.channelCount = 0
-            print("Sending request 'NAMES %s'" % channel)
-            self.sendLine("NAMES %s" % channel)
-            return
-        
-        # Check for tell query
-        m = self.tellQuery.match(parseMsg)
-        if m and directAddress:
-            print("Got tell from '%s' for  '%s' message '%s'." % (user, m.group(1), m.group(2)))
-            # The is in the tracked bot if the tracked bot is present and it was not a message 
-            # specifically directed to us. This is a little tricky since the only way to know
-            # that a message was specifically directed to us is to see if it was a direct address
-            # and we can reply
-            success = self.db.addTell(user, m.group(1), m.group(2), not (directAddress and canReply) and self.trackedpresent[channel])
-            if success and canReply:
-                self.msg(replyChannel, "%s: I'll pass that on when %s is around." % (user, m.group(1)))
-            return
-        
-        # Check for seen query
-        if canReply:
-            m = self.seenQuery.match(parseMsg)
-            if m:
-                queryname = m.group(1)
-                print("%s asked about '%s'" % (user, queryname))
-                rows = self.db.seen(queryname)
-                if len(rows) == 0:
-                    reply = "Sorry, I haven't seen %s." % queryname
-                    self.msg(replyChannel, reply)
-                for i,row in enumerate(rows):
-                    reply = "%s was last seen in %s %s ago saying '%s'." % (row[Seen.name], row[Seen.channel], timesincestring(row[Seen.timestamp]), row[Seen.message])
-                    self.msg(replyChannel, reply)
-                    if i >= 2:
-                        # Don't reply more than 3 times to a seen query
-                        break
+                reply = "%s: OK; Up for %s; %s is %s" % (VERSION, timesincestring(self.uptimeStart), trackednick, self.trackedState(message.channel))
+        else:
+            reply = "%s: OK; Up for %s; standalone mode" % (VERSION, timesincestring(self.uptimeStart))
+        def moodReply(mood):
+            self.msg(message.replyChannel, reply + " mood: %s %s %s" % (self.moodToString(mood), self.routedString(), self.sendQueue.statsString()))
+        self.db.mood().addCallback(moodReply).addErrback(self.dbError, "mood")
+        return True
+
+    def lurkersCommand(self, m, message):
+        if not message.canReply:
+            return False
+        self.msg(message.replyChannel, "Looking for lurkers...")
+        self.lurkerReplyChannel = message.replyChannel
+        self.lurkerNicks = []
+        print("Sending request 'NAMES %s'" % message.channel)
+        self.sendLine("NAMES %s" % message.channel)
+        return True
+
+    def tellCommand(self, m, message):
+        if not message.directAddress:
+            return False
+        user = message.user
+        print("Got tell from '%s' for  '%s' message '%s'." % (user, m.group(1), m.group(2)))
+        # The is in the tracked bot if the tracked bot is present and it was not a message 
+        # specifically directed to us. This is a little tricky since the only way to know
+        # that a message was specifically directed to us is to see if it was a direct address
+        # and we can reply
+        recipient = m.group(1)
+        def tellAdded(success):
+            if success and message.canReply:
+                self.msg(message.replyChannel, "%s: I'll pass that on when %s is around." % (user, recipient))
+        d = self.db.addTell(user, recipient, m.group(2), not (message.directAddress and message.canReply) and self.trackedAnswering(message.channel))
+        d.addCallback(tellAdded).addErrback(self.dbError, "addTell")
+        return True
+
+    def seenCommand(self, m, message):
+        if not message.canReply:
+            return False
+        queryname = m.group(1)
+        print("%s asked about '%s'" % (message.user, queryname))
+        def seenReply(rows):
+            if not rows:
+                reply = "Sorry, I haven't seen %s." % queryname
+                self.msg(message.replyChannel, reply)
                 return
-        
-        # Check for google query
-        if directAddress:
-            if canReply:
-                m = self.googleQuery.match(parseMsg)
-                if m:
-                    queryname = urllib.parse.quote_plus(m.group(1))
-                    foruser = m.group(2)
-                    print("%s asked to google '%s' for %s" % (user, queryname, foruser))
-                    reply = "%s: http://lmgtfy.com/?q=%s" % (foruser, queryname)
-                    self.msg(replyChannel, reply)
-                    return
-        
-        # Check for setting a factoid
-        factoid = None
-        if directAddress:
-            factoid = self.factoidSet.match(parseMsg)
-            if factoid:
-                invalidwords = re.match('(here|how|it|something|that|this|what|when|where|which|who|why|you)', factoid.group(1), re.IGNORECASE)
-                if not invalidwords:
-                    safeFactoid = factoid.group(1)
-                    print("%s tried to set factoid '%s'." % (user, safeFactoid))
-                    success = self.db.addFactoid(user, factoid.group(1), True if factoid.group(2) == 'are' else False, factoid.group(4), True if not factoid.group(3) else False)
-                    if canReply:
-                        if success:
-                            self.msg(replyChannel, "%s: Okay." % user)
-                        else:
-                            self.msg(replyChannel, "I'm sorry, %s. I'm afraid I can't do that." % user)
-
-        # Check for getting a factoid
-        if canReply:
-            f = self.factoidQuery.match(parseMsg)
-            if f:
-                safeFactoid = f.group(1)
-                print("factoid query from %s:%s for '%s'" % (user, channel, safeFactoid))
-                answer = self.getFactoidString(f.group(1))
-                if answer:
-                    # Replace !who and !channel in the reply
-                    answer = re.sub("!who", user, answer)
-                    answer = re.sub("!channel", channel, answer)
-                
-                    if answer.startswith("<reply>"):
-                        answer = answer[7:]
+            for i,row in enumerate(rows):
+                reply = "%s was last seen in %s %s ago saying '%s'." % (row[Seen.name], row[Seen.channel], timesincestring(row[Seen.timestamp]), row[Seen.message])
+                self.msg(message.replyChannel, reply)
+                if i >= 2:
+                    # Don't reply more than 3 times to a seen query
+                    break
+        self.db.seen(queryname).addCallback(seenReply).addErrback(self.dbError, "seen")
+        return True
+
+    def googleCommand(self, m, message):
+        if not (message.directAddress and message.canReply):
+            return False
+        queryname = urllib.parse.quote_plus(m.group(1))
+        foruser = m.group(2)
+        print("%s asked to google '%s' for %s" % (message.user, queryname, foruser))
+        reply = "%s: http://lmgtfy.com/?q=%s" % (foruser, queryname)
+        self.msg(message.replyChannel, reply)
+        return True
+
+    def factoidSetCommand(self, factoid, message):
+        if not message.directAddress:
+            return False
+        if self.invalidWords.match(factoid.group(1)):
+            return False
+        user = message.user
+        safeFactoid = factoid.group(1)
+        print("%s tried to set factoid '%s'." % (user, safeFactoid))
+        def factoidAdded(success):
+            if message.canReply:
+                if success:
+                    self.msg(message.replyChannel, "%s: Okay." % user)
+                else:
+                    self.msg(message.replyChannel, "I'm sorry, %s. I'm afraid I can't do that." % user)
+        d = self.db.addFactoid(user, factoid.group(1), True if factoid.group(2) == 'are' else False, factoid.group(4), True if not factoid.group(3) else False)
+        d.addCallback(factoidAdded).addErrback(self.dbError, "addFactoid")
+        return False
+
+    def factoidQueryCommand(self, f, message):
+        if self.factoidSync and not message.private:
+            self.factoidSync.asked(message.channel, f.group(1), message.user)
+        if not message.canReply:
+            return False
+        safeFactoid = f.group(1)
+        print("factoid query from %s:%s for '%s'" % (message.user, message.channel, safeFactoid))
+        def factoidReply(answer):
+            if answer:
+                # Replace !who and !channel in the reply
+                answer = re.sub("!who", message.user, answer)
+                answer = re.sub("!channel", message.channel, answer)
+            
+                if answer.startswith("<reply>"):
+                    answer = answer[7:]
 
-                    if answer.startswith("<action>"):
-                        self.describe(replyChannel, answer[8:])
-                    else:
-                        if (f.group(3)):
-                            answer = "%s, %s" % (f.group(3), answer)
-                        self.msg(replyChannel, answer)
-
-        # Check for info request
-        if canReply and parseMsg.startswith("info "):
-            query = parseMsg[5:]
-            if query[-1:] == "?":
-                query = query[:-1]
-            safeFactoid = query
-            print("info request for '%s' ReplyChannel is '%s'" % (safeFactoid, replyChannel))
-            refcount = 0
-            answer = self.db.infoFactoid(query)
+                if answer.startswith("<action>"):
+                    self.describe(message.replyChannel, answer[8:])
+                else:
+                    if (f.group(3)):
+                        answer = "%s, %s" % (f.group(3), answer)
+                    self.msg(message.replyChannel, answer)
+        self.getFactoidString(f.group(1)).addCallback(factoidReply).addErrback(self.dbError, "getFactoid")
+        return False
+
+    def infoCommand(self, m, message):
+        if not message.canReply:
+            return False
+        replyChannel = message.replyChannel
+        query = m.group(1)
+        if query[-1:] == "?":
+            query = query[:-1]
+        safeFactoid = query
+        print("info request for '%s' ReplyChannel is '%s'" % (safeFactoid, replyChannel))
+        def infoReply(answer):
             if answer:
                 count = answer[0][6]
                 if not count:
@@ -563,118 +735,97 @@ class Gthx(irc.IRCClient):
             else:
                 print("No info for factoid '%s'" % safeFactoid)
                 self.msg(replyChannel, "Sorry, I couldn't find an entry for %s" % query)
-
-        # Check for forget request
-        if directAddress and parseMsg.startswith("forget "):
-            query = parseMsg[7:]
-            print("forget request for '%s'" % query)
-            forgotten = self.db.forgetFactoid(query, user)
-            if canReply:
+        self.db.infoFactoid(query).addCallback(infoReply).addErrback(self.dbError, "infoFactoid")
+        return False
+
+    def forgetCommand(self, m, message):
+        if not message.directAddress:
+            return False
+        user = message.user
+        query = m.group(1)
+        print("forget request for '%s'" % query)
+        def forgetReply(forgotten):
+            if message.canReply:
                 if forgotten:
-                    self.msg(replyChannel, "%s: I've forgotten about %s" % (user, query))
-                else:
-                    self.msg(replyChannel, "%s: Okay, but %s didn't exist anyway" % (user, query))
-
-        # Check for thingiverse mention
-        if canReply:
-            match = self.thingMention.search(parseMsg)
-            if match:
-                thingId = int(match.group(2))
-                print("Match for thingiverse query item %s" % thingId)
-                rows = self.db.addThingiverseRef(thingId)
-                refs = int(rows[0][0])
-                title = rows[0][1]
-                if title is None:
-                    print("Attemping to get title for thingiverse ID %s" % thingId)
-                    agent = Agent(reactor)
-                    titleQuery = agent.request(
-                        'GET',
-                        'https://www.thingiverse.com/thing:%s' % thingId,
-                        Headers({'User-Agent': ['gthx IRC bot']}),
-                        None)
-                    def titleResponse(title):
-                        if title:
-                            title = unescape(title)
-                            self.db.addThingiverseTitle(thingId, title)
-                            print("The title for thing %s is: %s " % (thingId, title))
-                            reply = '%s linked to "%s" on thingiverse => %s IRC mentions' % (user, title, refs)
-                            self.msg(replyChannel, reply)
-                        else:
-                            print("No title found for thing %s" % (thingId))
-                            reply = '%s linked to thing %s on thingiverse => %s IRC mentions' % (user, thingId, refs)
-                            self.msg(replyChannel, reply)
-                    
-                    def queryResponse(response):
-                        if response.code == 200:
-                            finished = Deferred()
-                            finished.addCallback(titleResponse)
-                            response.deliverBody(TitleParser(finished))
-                            return finished
-                        print("Got error response from thingiverse query: %s" % (response))
-                        titleResponse(None)
-                        return None
-            
-                    titleQuery.addCallback(queryResponse)
-                else:
-                    print("Already have a title for thing %s: %s" % (thingId, title))
-                    reply = '%s linked to "%s" on thingiverse => %s IRC mentions' % (user, title, refs)
-                    self.msg(replyChannel, reply)
-
-        # Check for youtube mention
-        if canReply:
-            match = self.youtubeMention.search(parseMsg)
-            if match:
-                youtubeId = match.group(3)
-                # fullLink = match.group(0) 
-                print("Match for youtube query item %s" % youtubeId)
-                rows = self.db.addYoutubeRef(youtubeId)
-                refs = int(rows[0][0])
-                title = rows[0][1]
-                if title is None:
-                    print("Attemping to get title for youtubeId %s" % youtubeId)
-                    agent = Agent(reactor)
-                    titleQuery = agent.request(
-                        'GET',
-                        'https://www.youtube.com/watch?v=%s' % youtubeId,
-                        Headers({'User-Agent': ['gthx IRC bot']}),
-                        None)
-                    def titleResponse(title):
-                        if title:
-                            title = unescape(title)
-                            self.db.addYoutubeTitle(youtubeId, title)
-                            print("The title for video %s is: %s " % (youtubeId, title))
-                            reply = '%s linked to YouTube video "%s" => %s IRC mentions' % (user, title, refs)
-                            print("Reply is: %s" % reply)
-                            self.msg(replyChannel, reply)
-                            print("Message sent.")
-                        else:
-                            print("No title found for youtube video %s" % (youtubeId))
-                            reply = '%s linked to a YouTube video with an unknown title (ID: %s)  => %s IRC mentions' % (user, youtubeId, refs)
-                            self.msg(replyChannel, reply)
-                    
-                    def queryResponse(response):
-                        if response.code == 200:
-                            finished = Deferred()
-                            finished.addCallback(titleResponse)
-                            response.deliverBody(TitleParser(finished))
-                            return finished
-                        print("Got error response from youtube query: %s:%s" % (response.code, response.phrase))
-                        pprint(list(response.headers.getAllRawHeaders()))
-                        titleResponse(None)
-                        return None
-            
-                    titleQuery.addCallback(queryResponse)
+                    self.msg(message.replyChannel, "%s: I've forgotten about %s" % (user, query))
                 else:
-                    print("Already have a title for item %s: %s" % (youtubeId, title))
-                    reply = '%s linked to YouTube video "%s" => %s IRC mentions' % (user, title, refs)
-                    self.msg(replyChannel, reply)
-                
+                    self.msg(message.replyChannel, "%s: Okay, but %s didn't exist anyway" % (user, query))
+        self.db.forgetFactoid(query, user).addCallback(forgetReply).addErrback(self.dbError, "forgetFactoid")
+        return False
+
+    def linkCommand(self, site, match, message):
+        if not message.canReply:
+            return False
+        itemId = site.itemId(match)
+        # The generic site leaves links with their own site alone
+        if not site.addRef and any(other.matches(itemId) for other in SITES):
+            return False
+        print("Match for %s item %s" % (site.name, itemId))
+        if site.addRef:
+            d = getattr(self.db, site.addRef)(itemId)
+            d.addCallback(self.linkRef, site, itemId, message.user, message.replyChannel)
+            d.addErrback(self.dbError, site.addRef)
+        else:
+            self.linkRef(None, site, itemId, message.user, message.replyChannel)
+        return False
+
+    def deliverTells(self, tells, user, replyChannel, canReply):
+        if tells:
+            for message in tells:
+                print("Found tell for '%s' from '%s'" % (user, message[Tell.author]))
+                author = message[Tell.author]
+                timestring = timesincestring(message[Tell.timestamp])
+                text = message[Tell.message]
+                inTracked = message[Tell.inTracked]
+                # We have 3 cases:
+                # 1) kthx was around when this tell happened and is still around now.
+                #    In this case, we assume kthx will relay the message and just delete it
+                # 2) kthx was around when this tell happened and is not here now.
+                #    In this case, we want to send the message and mention that kthx may repeat it
+                # 3) kthx was not around when this tell happened and may or may not be here now
+                #    Whether or not kthx is now here, we need to say the message
+                # 4) gthx was specifically addressed for this tell
+                #    Whether or not kthx is now here, we need to say the message
+                #
+                # If we can't reply, it means that kthx is present. In that
+                # case, the tell has already been erased, so in both cases,
+                # we're good.
+                if canReply or not inTracked:
+                    if inTracked:
+                        self.msg(replyChannel,"%s: %s ago <%s> tell %s %s (%s may repeat this)" % (user, timestring, author, user, text, trackednick), priority=TELL)
+                    else:
+                        self.msg(replyChannel,"%s: %s ago <%s> tell %s %s" % (user, timestring, author, user, text), priority=TELL)
+
+    def linkRef(self, rows, site, itemId, user, replyChannel):
+        """Reply to a link, with its title if we have it or can get it
+
+        rows is what the site's addRef returned: ((count, title),), or None
+        for sites that don't count references.
+        """
+        refs = int(rows[0][0]) if rows else None
+        title = rows[0][1] if rows else None
+        def titleReply(title):
+            reply = site.titled if title else site.untitled
+            if reply:
+                self.msg(replyChannel, reply % dict(user=user, title=title, id=itemId, refs=refs), priority=TITLE)
+
+        if title is not None:
+            print("Already have a title for %s %s: %s" % (site.name, itemId, title))
+            titleReply(title)
+            return
+
+        saveTitle = None
+        if site.addTitle:
+            def saveTitle(title):
+                return getattr(self.db, site.addTitle)(itemId, title).addErrback(self.dbError, site.addTitle)
+        self.urlResolver.resolve(site, itemId, saveTitle).addCallback(titleReply)
+
     def action(self, sender, channel, message):
         m = re.match("([a-zA-Z\*_\\\[\]\{\}^`|\*][a-zA-Z0-9\*_\\\[\]\{\}^`|-]*)", sender)
         if m:
             sender = m.group(1)
             print("* %s %s" % (sender, message))
-            self.db.updateSeen(sender, channel, "* %s %s" % (sender, message))
+            self.db.updateSeen(sender, channel, "* %s %s" % (sender, message)).addErrback(self.dbError, "updateSeen")
             
 class GthxFactory(protocol.ClientFactory):
     """A factory for Gthx.
@@ -682,23 +833,64 @@ class GthxFactory(protocol.ClientFactory):
     A new protocol instance will be created each time we connect to the server.
     """
 
-    def __init__(self, channels, nick, emailClient, dbHost, dbUser, dbPassword, dbDatabase, nickservPassword):
+    def __init__(self, channels, nick, emailClient, db, nickservPassword, seenFlushInterval=10, tellRefreshInterval=60, refsFlushInterval=30, sendRate=1.0, sendBurst=5, urlResolver=None, titleAllLinks=False, presencePollInterval=60, probeQuery=None, probeInterval=60, probeTimeout=10, probeMaxMisses=2, factoidSync=True, factoidSyncInterval=60):
         self.channels = channels
+        # Shared by every connection so its cache and keep-alive
+        # connections outlive them
+        self.urlResolver = urlResolver
+        self.titleAllLinks = titleAllLinks
+        self.presencePollInterval = presencePollInterval
+        self.probeQuery = probeQuery
+        self.probeInterval = probeInterval
+        self.probeTimeout = probeTimeout
+        self.probeMaxMisses = probeMaxMisses
+        self.factoidSync = factoidSync
+        self.sendRate = sendRate
+        self.sendBurst = sendBurst
         self.emailClient = emailClient
         self.nick = nick
-        self.dbHost = dbHost
-        self.dbUser = dbUser
-        self.dbPassword = dbPassword
-        self.dbDatabase = dbDatabase
+        self.db = db
         self.nickservPassword = nickservPassword
+        # Buffered seen updates and reference counts get written out
+        # periodically. The DB also flushes them when the reactor shuts down.
+        self.seenFlusher = task.LoopingCall(self.flushSeen)
+        self.seenFlusher.start(seenFlushInterval, now=False)
+        self.refsFlusher = task.LoopingCall(self.flushRefs)
+        self.refsFlusher.start(refsFlushInterval, now=False)
+        self.syncFlusher = task.LoopingCall(self.flushFactoidSync)
+        self.syncFlusher.start(factoidSyncInterval, now=False)
+        # Pick up tells added or delivered by other bots sharing the DB
+        self.tellRefresher = task.LoopingCall(self.refreshTellRecipients)
+        self.tellRefresher.start(tellRefreshInterval, now=False)
         print("GthxFactory init")
+
+    def flushSeen(self):
+        def flushFailed(failure):
+            print("Failed to flush seen updates: %s" % failure.getErrorMessage())
+        return self.db.flushSeen().addErrback(flushFailed)
+
+    def flushRefs(self):
+        def flushFailed(failure):
+            print("Failed to flush reference counts: %s" % failure.getErrorMessage())
+        return self.db.flushRefs().addErrback(flushFailed)
+
+    def flushFactoidSync(self):
+        def flushFailed(failure):
+            print("Failed to sync factoids: %s" % failure.getErrorMessage())
+        return self.db.flushFactoidSync().addErrback(flushFailed)
+
+    def refreshTellRecipients(self):
+        def refreshFailed(failure):
+            print("Failed to refresh tell recipients: %s" % failure.getErrorMessage())
+        return self.db.refreshTellRecipients().addErrback(refreshFailed)
         
     def buildProtocol(self, addr):
         print("GthxFactory build protocol")
         try:
-            p = Gthx(dbHost, dbUser, dbPassword, dbDatabase, nickservPassword)
+            p = Gthx(self.db, self.nickservPassword, self.sendRate, self.sendBurst, self.titleAllLinks, self.presencePollInterval, self.probeQuery, self.probeInterval, self.probeTimeout, self.probeMaxMisses, self.factoidSync)
             p.factory = self
             p.emailClient = self.emailClient
+            p.urlResolver = self.urlResolver
             p.nickname = self.nick
             return p
         except Exception as e:
@@ -761,30 +953,93 @@ if __name__ == '__main__':
             from_email = config.get("EMAIL", "GTHX_EMAIL_FROM")
             to_email = config.get("EMAIL", "GTHX_EMAIL_TO")
             email_server = config.get("EMAIL", "GTHX_EMAIL_SMTP_SERVER")
-            dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
-            dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
-            dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
-            dbDatabase = config.get('MYSQL','GTHX_MYSQL_DATABASE')
+            dbBackend = config.get('DATABASE', 'GTHX_DB_BACKEND', fallback='mysql')
+            seenFlushInterval = config.getfloat('DATABASE', 'GTHX_SEEN_FLUSH_INTERVAL', fallback=10)
+            seenFlushSize = config.getint('DATABASE', 'GTHX_SEEN_FLUSH_SIZE', fallback=100)
+            dbPoolSize = config.getint('DATABASE', 'GTHX_DB_POOL_SIZE', fallback=4)
+            dbMaxPending = config.getint('DATABASE', 'GTHX_DB_MAX_PENDING', fallback=100)
+            tellRefreshInterval = config.getfloat('DATABASE', 'GTHX_TELL_REFRESH_INTERVAL', fallback=60)
+            refsFlushInterval = config.getfloat('DATABASE', 'GTHX_REFS_FLUSH_INTERVAL', fallback=30)
+            factoidCacheSize = config.getint('DATABASE', 'GTHX_FACTOID_CACHE_SIZE', fallback=1000)
+            factoidCacheTtl = config.getfloat('DATABASE', 'GTHX_FACTOID_CACHE_TTL', fallback=300)
+            factoidMissTtl = config.getfloat('DATABASE', 'GTHX_FACTOID_MISS_TTL', fallback=60)
+            sendRate = config.getfloat('IRC', 'GTHX_SEND_RATE', fallback=1.0)
+            sendBurst = config.getint('IRC', 'GTHX_SEND_BURST', fallback=5)
+            presencePollInterval = config.getfloat('IRC', 'GTHX_PRESENCE_POLL_INTERVAL', fallback=60)
+            probeQuery = config.get('IRC', 'GTHX_PROBE_QUERY', fallback=None)
+            probeInterval = config.getfloat('IRC', 'GTHX_PROBE_INTERVAL', fallback=60)
+            probeTimeout = config.getfloat('IRC', 'GTHX_PROBE_TIMEOUT', fallback=10)
+            probeMaxMisses = config.getint('IRC', 'GTHX_PROBE_MAX_MISSES', fallback=2)
+            factoidSync = config.getboolean('DATABASE', 'GTHX_FACTOID_SYNC', fallback=True)
+            factoidSyncInterval = config.getfloat('DATABASE', 'GTHX_FACTOID_SYNC_INTERVAL', fallback=60)
+            statsPort = config.getint('STATS', 'GTHX_STATS_PORT', fallback=0)
+            statsInterface = config.get('STATS', 'GTHX_STATS_INTERFACE', fallback='127.0.0.1')
+            statsCacheTtl = config.getfloat('STATS', 'GTHX_STATS_CACHE_TTL', fallback=10)
+            httpMaxConcurrent = config.getint('HTTP', 'GTHX_HTTP_MAX_CONCURRENT', fallback=8)
+            httpMaxPerHost = config.getint('HTTP', 'GTHX_HTTP_MAX_PER_HOST', fallback=2)
+            httpTimeout = config.getfloat('HTTP', 'GTHX_HTTP_TIMEOUT', fallback=10)
+            httpIdleTimeout = config.getfloat('HTTP', 'GTHX_HTTP_IDLE_TIMEOUT', fallback=60)
+            titleCacheSize = config.getint('HTTP', 'GTHX_TITLE_CACHE_SIZE', fallback=1000)
+            titleCacheTtl = config.getfloat('HTTP', 'GTHX_TITLE_CACHE_TTL', fallback=3600)
+            titleFailureTtl = config.getfloat('HTTP', 'GTHX_TITLE_FAILURE_TTL', fallback=300)
+            titleAllLinks = config.getboolean('HTTP', 'GTHX_TITLE_ALL_LINKS', fallback=False)
+            emailMaxQueued = config.getint('EMAIL', 'GTHX_EMAIL_MAX_QUEUED', fallback=100)
+            emailIdleTimeout = config.getfloat('EMAIL', 'GTHX_EMAIL_IDLE_TIMEOUT', fallback=60)
+            emailSsl = config.getboolean('EMAIL', 'GTHX_EMAIL_SSL', fallback=True)
+            emailDigestWindow = config.getfloat('EMAIL', 'GTHX_EMAIL_DIGEST_WINDOW', fallback=60)
+            emailSubjectInterval = config.getfloat('EMAIL', 'GTHX_EMAIL_SUBJECT_INTERVAL', fallback=300)
     
-            # Setup email notification
-            emailClient = Email(email_user, email_password, from_email, to_email, email_server)
+            if dbBackend == 'sqlite':
+                # The SQLite schema is created up to date on first use
+                sqlitePath = config.get('DATABASE', 'GTHX_SQLITE_PATH')
+                db = SqliteDbAccess(sqlitePath, seenFlushSize, factoidCacheSize, factoidCacheTtl, factoidMissTtl)
+            elif dbBackend == 'mysql':
+                dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
+                dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
+                dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
+                dbDatabase = config.get('MYSQL','GTHX_MYSQL_DATABASE')
+                # Bring the DB schema up to date before anything uses it
+                db = DbAccess(dbHost, dbUser, dbPassword, dbDatabase, seenFlushSize, factoidCacheSize, factoidCacheTtl, factoidMissTtl)
+                DbMigrations.migrate(db)
+            else:
+                raise ValueError("Unknown GTHX_DB_BACKEND '%s'. Use mysql or sqlite." % dbBackend)
+
+            # From here on the DB is only used from a pool of worker threads
+            # so slow queries can't hold up the IRC connection
+            asyncDb = AsyncDbAccess(db, reactor, maxThreads=dbPoolSize, maxPending=dbMaxPending)
+
+            # Serve the website's stats from the same DB pool
+            if statsPort:
+                print("Serving stats on %s:%d" % (statsInterface, statsPort))
+                reactor.listenTCP(statsPort, StatsServer.makeSite(asyncDb, statsCacheTtl), interface=statsInterface)
+
+            # One pool of keep-alive connections and one cache for every title lookup
+            httpClient = HttpClient(reactor, httpMaxConcurrent, httpMaxPerHost, httpTimeout, httpIdleTimeout)
+            urlResolver = UrlResolver(httpClient, titleCacheSize, titleCacheTtl, titleFailureTtl)
+
+            # Setup email notification. Notifications are collected into
+            # digests so a burst of them means one email.
+            email = Email(email_user, email_password, from_email, to_email, email_server, emailMaxQueued, emailIdleTimeout, emailSsl)
+            emailClient = Notifier(email, reactor, emailDigestWindow, emailSubjectInterval)
 
             # initialize logging
             log.startLogging(open(logfile, 'a'))
 
             # create factory protocol and application
-            f = GthxFactory(channels, mynick, emailClient, dbHost, dbUser, dbPassword, dbDatabase, nickservPassword)
+            f = GthxFactory(channels, mynick, emailClient, asyncDb, nickservPassword, seenFlushInterval, tellRefreshInterval, refsFlushInterval, sendRate, sendBurst, urlResolver, titleAllLinks, presencePollInterval, probeQuery, probeInterval, probeTimeout, probeMaxMisses, factoidSync, factoidSyncInterval)
 
             # connect factory to this host and port
             reactor.connectTCP("chat.freenode.net", 6667, f)
 
             # run bot
             reactor.run()
+            emailClient.close()
         except ValueError as e:
             print("Failed to start: %s" % e)
         except error.ReactorNotRestartable as e:
             print("Got severe failure--probably ^C. Exiting")
             emailClient.send("%s exiting" % mynick, "%s is exiting due to a user requested shutdown." % mynick)
+            emailClient.close()
             # TODO: Figure out a way to gracefully shutdown and close the DB connection
         except Exception as e:
             print("Overall failure: %s" % str(e))
@@ -793,5 +1048,6 @@ if __name__ == '__main__':
             message += traceback.format_exc()
             if emailClient:
                 emailClient.send("%s exception" % mynick, message)
+                emailClient.close()
             print("Waiting 5 minutes to retry...")
             # TODO: Add logging here
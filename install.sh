@@ -12,7 +12,20 @@ sudo systemctl daemon-reload
 sudo mkdir -p /usr/sbin/gthx
 sudo cp gthx.py /usr/sbin/gthx/
 sudo cp DbAccess.py /usr/sbin/gthx/
+sudo cp AsyncDbAccess.py /usr/sbin/gthx/
+sudo cp Cache.py /usr/sbin/gthx/
+sudo cp CommandRouter.py /usr/sbin/gthx/
+sudo cp OutputQueue.py /usr/sbin/gthx/
+sudo cp HttpClient.py /usr/sbin/gthx/
+sudo cp TitleExtractor.py /usr/sbin/gthx/
+sudo cp UrlResolver.py /usr/sbin/gthx/
+sudo cp DbMigrations.py /usr/sbin/gthx/
+sudo cp SqliteDbAccess.py /usr/sbin/gthx/
 sudo cp Email.py /usr/sbin/gthx/
+sudo cp Notifier.py /usr/sbin/gthx/
+sudo cp Presence.py /usr/sbin/gthx/
+sudo cp FactoidSync.py /usr/sbin/gthx/
+sudo cp StatsServer.py /usr/sbin/gthx/
 echo -n Starting gthx service...
 sudo systemctl start gthx
 echo Done.
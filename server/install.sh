@@ -1,5 +0,0 @@
-#!/bin/bash
-
-sudo cp stats.py /usr/lib/cgi-bin/stats.py
-sudo chown www-data /usr/lib/cgi-bin/stats.py
-sudo chgrp www-data /usr/lib/cgi-bin/stats.py
@@ -6,32 +6,106 @@
 #   Test maximum length of username (maybe not a problem since they can't actually contain unicode according to IRC spec?)
 #   Test that UpdateSeen doesn't have SQL injection problem with message (currently it does)
 
+import re
+import json
 import unittest
 import os
 import time
 import configparser
-
-from DbAccess import DbAccess, Seen, Tell
+import tempfile
+import socket
+import socketserver
+import threading
+import io
+import contextlib
+
+import benchmark
+from DbAccess import DbAccess, DbUnavailable, Seen, Tell
+import DbMigrations
+from SqliteDbAccess import SqliteDbAccess
+from MemoryDbAccess import MemoryDbAccess, OffsetClock
+from CommandRouter import CommandRouter
+from OutputQueue import OutputQueue, CONTROL, REPLY, TELL, TITLE
+from HttpClient import HttpClient
+from Cache import SingleFlight
+from Email import Email
+from Notifier import Notifier
+from Presence import Presence, Prober
+from FactoidSync import FactoidSync
+from StatsServer import StatsResource
+from AsyncDbAccess import AsyncDbAccess
+from UrlResolver import UrlResolver, Site, SITES, isPublicUrl
+from TitleExtractor import TitleExtractor, readTitle, MAX_TITLE_BYTES
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest as trial
+from twisted.python.failure import Failure
+from twisted.web import resource, server
+from twisted.web.client import readBody
+from twisted.web.test.requesthelper import DummyRequest
 from datetime import datetime, timezone
 
-class DbAccessSeenTest(unittest.TestCase):
+def makeDb(test):
+    """Open a DB on the test's backend
+
+    MySQL uses the DB in gthx.config.local and the tests are skipped if
+    there isn't one. SQLite uses a new file that's deleted afterwards.
+    The memory backend gets a clock the test can move forward.
+    """
+    if test.backend == "memory":
+        test.clock = OffsetClock()
+        return MemoryDbAccess(test.clock)
+
+    if test.backend == "sqlite":
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        db = SqliteDbAccess(path)
+        def cleanup():
+            db.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        test.addCleanup(cleanup)
+        return db
+
+    config = configparser.ConfigParser()
+    results = config.read('gthx.config.local')
+    if not results or not config.has_section('MYSQL'):
+        raise unittest.SkipTest("No MySQL DB configured in 'gthx.config.local'")
+    dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
+    dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
+    dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
+    dbName = config.get('MYSQL','GTHX_MYSQL_DATABASE')
+
+    try:
+        return DbAccess(dbHost, dbUser, dbPassword, dbName)
+    except ImportError as e:
+        raise unittest.SkipTest(str(e))
+
+class DbTestCase(unittest.TestCase):
+    backend = "mysql"
+    clock = None
+
+    def setUp(self):
+        self.db = makeDb(self)
+
+    def now(self):
+        """The current UTC time as the DB sees it"""
+        if self.clock:
+            return datetime.fromtimestamp(self.clock(), timezone.utc)
+        return datetime.now(timezone.utc)
+
+    def sleep(self, seconds):
+        if self.clock:
+            self.clock.advance(seconds)
+        else:
+            time.sleep(seconds)
+
+class DbAccessSeenTest(DbTestCase):
     missinguser = "somerandomuser"
     seenuser = "seenuser"
     seenuser2 = "seenuser2"
     unicodeuser = "🐰Lover"
     unicodemessage = "I love 🌮s"
-    
-    def setUp(self):
-        config = configparser.ConfigParser()
-        results = config.read('gthx.config.local')
-        if not results:
-            raise SystemExit("Failed to read config file 'gthx.config.local'")
-        dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
-        dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
-        dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
-        dbName = config.get('MYSQL','GTHX_MYSQL_DATABASE')
-
-        self.db = DbAccess(dbHost, dbUser, dbPassword, dbName)
 
     def test_missing_seen(self):
         data = self.db.seen(DbAccessSeenTest.missinguser)
@@ -51,7 +125,7 @@ class DbAccessSeenTest(unittest.TestCase):
         self.assertEqual(data[Seen.name], user, "Wrong username returned for seen user")
         self.assertEqual(data[Seen.channel], channel, "Wrong channel returned for a seen user")
 
-        delta = datetime.now(timezone.utc) - data[Seen.timestamp].replace(tzinfo=timezone.utc)
+        delta = self.now() - data[Seen.timestamp].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a seen user: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a seen user: delta is %d" % delta.total_seconds())
         self.assertEqual(data[Seen.message], message, "Wrong message returned for a seen user")
@@ -71,19 +145,19 @@ class DbAccessSeenTest(unittest.TestCase):
 
         data=rows[0]
         
-        delta = datetime.now(timezone.utc) - data[Seen.timestamp].replace(tzinfo=timezone.utc)
+        delta = self.now() - data[Seen.timestamp].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a seen user: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, 'Wrong time returned for a seen user: delta is %d' % (delta.total_seconds(), ))
 
         # Now wait a couple seconds and verify that the delta has changed
-        time.sleep(2)
+        self.sleep(2)
 
         rows = self.db.seen(user)
         self.assertEqual(len(rows), 1, "Returned incorrect data for a user that has been seen")
 
         data=rows[0]
         
-        delta = datetime.now(timezone.utc) - data[Seen.timestamp].replace(tzinfo=timezone.utc)
+        delta = self.now() - data[Seen.timestamp].replace(tzinfo=timezone.utc)
         self.assertGreater(delta.total_seconds(), 1, 'Wrong time returned for a seen user: delta is %d' % delta.total_seconds())
 
         # Now update the same user again, then verify that the time has been updated.
@@ -94,7 +168,7 @@ class DbAccessSeenTest(unittest.TestCase):
 
         data=rows[0]
         
-        delta = datetime.now(timezone.utc) - data[Seen.timestamp].replace(tzinfo=timezone.utc)
+        delta = self.now() - data[Seen.timestamp].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a seen user: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, 'Wrong time returned for a seen user: delta is %d' % delta.total_seconds())
 
@@ -147,7 +221,22 @@ class DbAccessSeenTest(unittest.TestCase):
 
         rows = self.db.seen(user)
         self.assertEqual(len(rows), 1, "Returned incorrect data for a user that has been seen: %d" % len(rows))
-        
+
+    def test_wildcard_seen(self):
+        channel = "#test_channel"
+        message = "Running unit tests..."
+        self.db.updateSeen(DbAccessSeenTest.seenuser, channel, message)
+        self.db.updateSeen(DbAccessSeenTest.seenuser2, channel, message)
+
+        rows = self.db.seen("SeenUser*")
+        self.assertEqual(sorted(row[Seen.name] for row in rows), [DbAccessSeenTest.seenuser, DbAccessSeenTest.seenuser2], "Wildcard seen returned the wrong users")
+
+        rows = self.db.seen("seenuser_")
+        self.assertEqual([row[Seen.name] for row in rows], [DbAccessSeenTest.seenuser2], "Single character wildcard matched the wrong users")
+
+        rows = self.db.seen("seen")
+        self.assertEqual(len(rows), 0, "Seen without a wildcard matched a longer nick")
+
     def test_unicode_seen(self):
         user = DbAccessSeenTest.unicodeuser
         channel = "#test_channel"
@@ -163,7 +252,7 @@ class DbAccessSeenTest(unittest.TestCase):
         self.assertEqual(data[Seen.name], user, "Wrong username returned for a unicode seen user")
         self.assertEqual(data[Seen.channel], channel, "Wrong channel returned for a unicode seen user")
 
-        delta = datetime.now(timezone.utc) - data[Seen.timestamp].replace(tzinfo=timezone.utc)
+        delta = self.now() - data[Seen.timestamp].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a unicode seen user: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a unicode seen user: delta is %d" % delta.total_seconds())
         self.assertEqual(data[Seen.message], message, "Wrong message returned for a unicode seen message")
@@ -175,24 +264,103 @@ class DbAccessSeenTest(unittest.TestCase):
         self.db.deleteSeen(DbAccessSeenTest.seenuser)
         self.db.deleteSeen(DbAccessSeenTest.seenuser2)
 
-class DbAccessFactoidTest(unittest.TestCase):
-    def setUp(self):
-        config = configparser.ConfigParser()
-        results = config.read('gthx.config.local')
-        if not results:
-            raise SystemExit("Failed to read config file 'gthx.config.local'")
-        dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
-        dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
-        dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
-        dbName = config.get('MYSQL','GTHX_MYSQL_DATABASE')
+class DbAccessCountUnseenTest(DbTestCase):
+    users = ("unseenuser1", "unseenuser2", "unseenuser3")
+
+    def test_count_unseen(self):
+        self.db.updateSeen("unseenuser1", "#reprap", "hello")
+        self.db.flush()
+        self.db.updateSeen("UnseenUser2", "#reprap", "not written yet")
+        nicks = ["unseenuser1", "unseenuser2", "lurker1", "Lurker2"]
+        self.assertEqual(self.db.countUnseen(nicks), 2)
+        self.db.seenBatchSize = 1
+        self.assertEqual(self.db.countUnseen(nicks + ["unseenuser3"]), 3)
+        self.assertEqual(self.db.countUnseen([]), 0)
 
-        self.db = DbAccess(dbHost, dbUser, dbPassword, dbName)
+    def tearDown(self):
+        for user in self.users:
+            self.db.deleteSeen(user)
+
+class DbAccessSeenBufferTest(DbTestCase):
+    """Seen updates are held in memory and written in batches
+
+    Not for the memory backend, which has nothing to buffer.
+    """
+    users = ("bufferuser1", "bufferuser2", "bufferuser3")
+
+    def stored(self, user):
+        """The user's message as written to the DB, ignoring the buffer"""
+        rows = self.db.executeAndFetchAll("SELECT message FROM seen WHERE name=%s", user)
+        return rows[0][0] if rows else None
+
+    def test_seen_before_flush(self):
+        self.db.updateSeen("bufferuser1", "#reprap", "not written yet")
+        self.assertIsNone(self.stored("bufferuser1"))
+        rows = self.db.seen("bufferuser1")
+        self.assertEqual([(row[Seen.name], row[Seen.message]) for row in rows], [("bufferuser1", "not written yet")])
+        self.assertEqual(self.db.seen("bufferuser*")[0][Seen.message], "not written yet")
+
+        self.assertTrue(self.db.flushSeen())
+        self.assertEqual(self.stored("bufferuser1"), "not written yet")
+        self.assertFalse(self.db.pendingSeen)
+
+    def test_flush_when_full(self):
+        self.db.seenFlushSize = 3
+        self.db.updateSeen("bufferuser1", "#reprap", "one")
+        self.db.updateSeen("bufferuser2", "#reprap", "two")
+        # Updates for the same user take one slot
+        self.db.updateSeen("bufferuser2", "#reprap", "two again")
+        self.assertEqual(len(self.db.pendingSeen), 2)
+        self.assertIsNone(self.stored("bufferuser1"))
+
+        self.db.updateSeen("bufferuser3", "#reprap", "three")
+        self.assertFalse(self.db.pendingSeen)
+        self.assertEqual([self.stored(user) for user in self.users], ["one", "two again", "three"])
+
+    def test_failed_flush_keeps_updates(self):
+        self.db.updateSeen("bufferuser1", "#reprap", "old")
+        self.db.updateSeen("bufferuser2", "#reprap", "kept")
+        def failingWrite(commands):
+            # A newer update arrives while the write is in progress
+            self.db.updateSeen("bufferuser1", "#reprap", "new")
+            return False
+        self.db.executeManyAndCommit = failingWrite
+        self.assertFalse(self.db.flushSeen())
+        del self.db.executeManyAndCommit
+
+        self.assertEqual(self.db.pendingSeen["bufferuser1"][3], "new")
+        self.assertEqual(self.db.pendingSeen["bufferuser2"][3], "kept")
+        self.assertTrue(self.db.flushSeen())
+        self.assertEqual([self.stored(user) for user in self.users[:2]], ["new", "kept"])
+
+    def tearDown(self):
+        for user in self.users:
+            self.db.deleteSeen(user)
 
+class DbAccessFactoidTest(DbTestCase):
     def test_get_missing_factoid(self):
         missingFactoid = "missingfactoid"
         data = self.db.getFactoid(missingFactoid)
         self.assertFalse(data, "Got a valid return from a factoid that shouldn't exist")
 
+    def test_add_factoid_after_missing_lookup(self):
+        # Make sure a cached miss doesn't hide a factoid that gets added later
+        user="someuser"
+        item="laterfactoid"
+
+        data = self.db.getFactoid(item)
+        self.assertFalse(data, "Got a valid return from a factoid that shouldn't exist")
+
+        success = self.db.addFactoid(user, item, False, "added after a lookup", False)
+        self.assertTrue(success, "Failed to add a new factoid")
+
+        data = self.db.getFactoid(item)
+        self.assertEqual(len(data), 1, "Returned wrong number of results for a factoid that was just added: %d" % (len(data),) )
+
+        self.db.forgetFactoid(item, user)
+        data = self.db.getFactoid(item)
+        self.assertFalse(data, "Got a valid return from a factoid that was forgotten")
+
     def test_add_factoid(self):
         user="someuser"
         item="somefactoid"
@@ -215,7 +383,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(factoid[3], definition, "Factoid failed to retrieve the defintion correctly")
         self.assertEqual(factoid[4], user, "Factoid failed to retrieve the user correctly")
 
-        delta = datetime.now(timezone.utc) - factoid[5].replace(tzinfo=timezone.utc)
+        delta = self.now() - factoid[5].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a factoid date set: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a factoid date set: delta is %d" % delta.total_seconds())
 
@@ -242,7 +410,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(factoid[3], definition, "Factoid failed to retrieve the defintion correctly")
         self.assertEqual(factoid[4], user, "Factoid failed to retrieve the user correctly")
 
-        delta = datetime.now(timezone.utc) - factoid[5].replace(tzinfo=timezone.utc)
+        delta = self.now() - factoid[5].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a factoid date set: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a factoid date set: delta is %d" % delta.total_seconds())
 
@@ -274,7 +442,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(factoid[3], definition, "Factoid failed to retrieve the defintion correctly")
         self.assertEqual(factoid[4], user, "Factoid failed to retrieve the user correctly")
 
-        delta = datetime.now(timezone.utc) - factoid[5].replace(tzinfo=timezone.utc)
+        delta = self.now() - factoid[5].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a factoid date set: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a factoid date set: delta is %d" % delta.total_seconds())
 
@@ -287,7 +455,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(factoid[3], definition2, "Factoid failed to retrieve the defintion correctly")
         self.assertEqual(factoid[4], user2, "Factoid failed to retrieve the user correctly")
 
-        delta = datetime.now(timezone.utc) - factoid[5].replace(tzinfo=timezone.utc)
+        delta = self.now() - factoid[5].replace(tzinfo=timezone.utc)
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a factoid date set: delta is %d" % delta.total_seconds())
 
         self.assertFalse(factoid[6], "Factoid failed to retrieve the locked flag correctly")
@@ -306,7 +474,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(factoid[3], replacement, "Factoid failed to retrieve the defintion correctly")
         self.assertEqual(factoid[4], user3, "Factoid failed to retrieve the user correctly")
 
-        delta = datetime.now(timezone.utc) - factoid[5].replace(tzinfo=timezone.utc)
+        delta = self.now() - factoid[5].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a factoid date set: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a factoid date set: delta is %d" % delta.total_seconds())
 
@@ -365,6 +533,101 @@ class DbAccessFactoidTest(unittest.TestCase):
         success = self.db.addFactoid(user, item, isAre, definition, True)
         self.assertFalse(success, "Was incorrectly able to replace a locked factoid")
         
+    def test_sync_factoid_from_tracked_bot(self):
+        item="syncedfactoid"
+
+        self.assertTrue(self.db.addFactoid("someuser", item, False, "out of date", False))
+        self.db.syncFactoid(item, [(False, "up to date"), (True, "also this")], "kthx")
+        self.assertTrue(self.db.flushFactoidSync())
+
+        data = self.db.getFactoid(item)
+        self.assertEqual([(bool(row[2]), row[3], row[4]) for row in data], [(False, "up to date", "kthx"), (True, "also this", "kthx")])
+        self.assertTrue(data[0][7], "Synced factoid has no lastsync time")
+        history = self.db.infoFactoid(item)
+        self.assertEqual([row[2] for row in history[:3]], ["also this", "up to date", None])
+
+        # Syncing the same values only updates lastsync
+        self.sleep(2)
+        self.db.syncFactoid(item, [(False, "up to date"), (True, "also this")], "kthx")
+        self.assertTrue(self.db.flushFactoidSync())
+        again = self.db.getFactoid(item)
+        self.assertEqual([row[0] for row in again], [row[0] for row in data])
+        self.assertGreater(again[0][7], data[0][7])
+        self.assertEqual(len(self.db.infoFactoid(item)), 4)
+
+    def test_sync_leaves_locked_factoid_alone(self):
+        item="lockedsyncfactoid"
+        self.assertTrue(self.db.addFactoid("someuser", item, False, "ours", False))
+        self.db.lockFactoid(item)
+        self.db.syncFactoid(item, [(False, "theirs")], "kthx")
+        self.assertTrue(self.db.flushFactoidSync())
+        self.assertEqual(self.db.getFactoid(item)[0][3], "ours")
+
+    def test_stats(self):
+        user="someuser"
+        self.assertTrue(self.db.addFactoid(user, "statsalpha", False, "first", False))
+        self.assertTrue(self.db.addFactoid(user, "statsalpha", True, "second", False))
+        self.assertTrue(self.db.addFactoid(user, "statsbeta", False, "only", False))
+        self.assertTrue(self.db.addFactoid(user, "statsunused", False, "never asked", False))
+        for i in range(3):
+            self.db.getFactoid("statsbeta")
+        self.db.getFactoid("statsalpha")
+        self.db.flushRefs()
+        self.sleep(2)
+        self.db.getFactoid("statsalpha")
+        self.db.flushRefs()
+
+        rows = self.db.stats("factoids", "all", "count")
+        self.assertEqual([(row["item"], row["count"]) for row in rows], [("statsbeta", 3), ("statsalpha", 2)])
+        self.assertEqual(sorted(rows[1]["value"].split(" and also ")), ["first", "second"])
+        rows = self.db.stats("factoids", "recent", "date")
+        self.assertEqual([row["item"] for row in rows], ["statsalpha", "statsbeta"])
+        self.assertEqual(len(self.db.stats("factoids", "all", "count", limit=1)), 1)
+
+    def test_replace_locked_factoid_leaves_history_alone(self):
+        user="someuser"
+        user2="vandal"
+        item="lockedhistoryfactoid"
+        definition="the one true definition"
+
+        success = self.db.addFactoid(user, item, False, definition, False)
+        self.assertTrue(success, "Failed to add a new factoid")
+        self.db.lockFactoid(item)
+
+        success = self.db.addFactoid(user2, item, False, "something else", True)
+        self.assertFalse(success, "Was incorrectly able to replace a locked factoid")
+        forgotten = self.db.forgetFactoid(item, user2)
+        self.assertFalse(forgotten, "Was incorrectly able to forget a locked factoid")
+
+        data = self.db.getFactoid(item)
+        self.assertEqual(len(data), 1, "Locked factoid has the wrong number of values: %d" % (len(data),) )
+        self.assertEqual(data[0][3], definition, "Locked factoid value was changed")
+
+        info = self.db.infoFactoid(item)
+        self.assertEqual(len(info), 1, "Failed changes to a locked factoid were recorded in the history")
+
+    def test_factoid_write_latency(self):
+        # Each set or replace is a single transaction, so even a busy
+        # channel's worth of them should finish quickly
+        user="someuser"
+        item="busyfactoid"
+        count = 20
+
+        start = time.time()
+        for i in range(count):
+            success = self.db.addFactoid(user, item, False, "definition %d" % i, i % 2 == 0)
+            self.assertTrue(success, "Failed to set factoid")
+        elapsed = time.time() - start
+
+        self.assertLess(elapsed / count, 0.1, "Setting a factoid took %.3f seconds on average" % (elapsed / count))
+
+        data = self.db.getFactoid(item)
+        self.assertEqual(len(data), 2, "Returned wrong number of results after replacing a factoid: %d" % (len(data),) )
+        info = self.db.infoFactoid(item)
+        self.assertEqual(info[0][2], "definition %d" % (count - 1), "Factoid history doesn't end with the latest value")
+        self.assertEqual(info[1][2], "definition %d" % (count - 2), "Factoid history is out of order")
+        self.assertIsNone(info[2][2], "Replace wasn't recorded in the history")
+
     def test_factoid_info(self):
         user="someguy"
         counteditem="countedfactoid"
@@ -392,7 +655,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], counteditem, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition, "Factoid history has the wrong definition")
         self.assertEqual(history[3], user, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history has the wrong item name the second place: %s" % history[5])
@@ -414,12 +677,12 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], counteditem, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition, "Factoid history has the wrong definition")
         self.assertEqual(history[3], user, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertEqual(history[5], counteditem, "Factoid history has the wrong item name the second place: %s" % history[5])
         self.assertEqual(history[6], 1, "Factoid history has the wrong count: %s" % history[6])
-        delta = datetime.now(timezone.utc) - history[7].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[7].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         
@@ -441,12 +704,12 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], counteditem, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition, "Factoid history has the wrong definition")
         self.assertEqual(history[3], user, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertEqual(history[5], counteditem, "Factoid history has the wrong item name the second place: %s" % history[5])
         self.assertEqual(history[6], 5, "Factoid history has the wrong count: %s" % history[6])
-        delta = datetime.now(timezone.utc) - history[7].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[7].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         
@@ -499,7 +762,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition, "Factoid history has the wrong definition: '%s'" % history[2])
         self.assertEqual(history[3], user, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -511,7 +774,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertIsNone(history[2], "Factoid history for forgotten entry has a definition when it shouldn't")
         self.assertEqual(history[3], userWhoDeletes, "Factoid history for forgotten entry has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -609,7 +872,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertIsNone(history[2], "Factoid history has the wrong definition: '%s'" % history[2])
         self.assertEqual(history[3], userWhoDeletes, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -621,7 +884,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition2, "Factoid history has the wrong definition: '%s'" % history[2])
         self.assertEqual(history[3], user2, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -633,7 +896,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition, "Factoid history for forgotten entry has a definition when it shouldn't")
         self.assertEqual(history[3], user, "Factoid history for forgotten entry has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -672,7 +935,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition3, "Factoid history has wrong definition: '%s'" % history[2])
         self.assertEqual(history[3], user3, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -684,7 +947,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertIsNone(history[2], "Factoid history has the definition when it shouldn't: '%s'" % history[2])
         self.assertEqual(history[3], user3, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -696,7 +959,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition2, "Factoid history has a definition: %s" % history[2])
         self.assertEqual(history[3], user2, "Factoid history for forgotten entry has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -708,7 +971,7 @@ class DbAccessFactoidTest(unittest.TestCase):
         self.assertEqual(history[1], item, "Factoid history has the wrong item name")
         self.assertEqual(history[2], definition, "Factoid history has the wrong definition: '%s'" % history[2])
         self.assertEqual(history[3], user, "Factoid history has the wrong username")
-        delta = datetime.now(timezone.utc) - history[4].replace(tzinfo=timezone.utc)
+        delta = self.now() - history[4].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for factoid history: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Factoid history has the wrong time. delta is %d" % delta.total_seconds())
         self.assertIsNone(history[5], "Factoid history ref count has an item name when it shouldn't.")
@@ -765,20 +1028,9 @@ class DbAccessFactoidTest(unittest.TestCase):
         #print("Skipping factoid teardown")
 
 
-class DbAccessTellTest(unittest.TestCase):
+class DbAccessTellTest(DbTestCase):
     missinguser = "somerandomuser"
     
-    def setUp(self):
-        config = configparser.ConfigParser()
-        results = config.read('gthx.config.local')
-        if not results:
-            raise SystemExit("Failed to read config file 'gthx.config.local'")
-        dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
-        dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
-        dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
-        dbName = config.get('MYSQL','GTHX_MYSQL_DATABASE')
-
-        self.db = DbAccess(dbHost, dbUser, dbPassword, dbName)
 
     def test_user_with_no_tells(self):
         user="someuser"
@@ -809,7 +1061,7 @@ class DbAccessTellTest(unittest.TestCase):
         self.assertEqual(tell[4], message, "Got wrong message for a tell")
         self.assertEqual(tell[5], kthxKnows, "Got wrong inTracked for a tell")
 
-        delta = datetime.now(timezone.utc) - tell[3].replace(tzinfo=timezone.utc)
+        delta = self.now() - tell[3].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a tell: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a tell date set: delta is %d" % delta.total_seconds())
 
@@ -836,7 +1088,7 @@ class DbAccessTellTest(unittest.TestCase):
         self.assertEqual(tell[4], message, "Got wrong message for a tell")
         self.assertEqual(tell[5], kthxKnows, "Got wrong inTracked for a tell")
 
-        delta = datetime.now(timezone.utc) - tell[3].replace(tzinfo=timezone.utc)
+        delta = self.now() - tell[3].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for tell: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a tell date set: delta is %d" % delta.total_seconds())
 
@@ -873,7 +1125,7 @@ class DbAccessTellTest(unittest.TestCase):
         self.assertEqual(tell[4], message, "Got wrong message for a tell")
         self.assertEqual(tell[5], kthxKnows, "Got wrong inTracked for a tell")
 
-        delta = datetime.now(timezone.utc) - tell[3].replace(tzinfo=timezone.utc)
+        delta = self.now() - tell[3].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for tell: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a tell date set: delta is %d" % delta.total_seconds())
 
@@ -883,7 +1135,7 @@ class DbAccessTellTest(unittest.TestCase):
         self.assertEqual(tell[4], message2, "Got wrong message for a tell")
         self.assertEqual(tell[5], kthxKnows2, "Got wrong inTracked for a tell")
 
-        delta = datetime.now(timezone.utc) - tell[3].replace(tzinfo=timezone.utc)
+        delta = self.now() - tell[3].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a tell: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a tell date set: delta is %d" % delta.total_seconds())
 
@@ -893,7 +1145,7 @@ class DbAccessTellTest(unittest.TestCase):
         self.assertEqual(tell[4], message3, "Got wrong message for a tell")
         self.assertEqual(tell[5], kthxKnows3, "Got wrong inTracked for a tell")
 
-        delta = datetime.now(timezone.utc) - tell[3].replace(tzinfo=timezone.utc)
+        delta = self.now() - tell[3].replace(tzinfo=timezone.utc)
         self.assertGreaterEqual(delta.total_seconds(),0,'Wrong time returned for a tell: delta is %d' % delta.total_seconds())
         self.assertLess(delta.total_seconds(), 2, "Wrong time returned for a tell date set: delta is %d" % delta.total_seconds())
 
@@ -904,20 +1156,40 @@ class DbAccessTellTest(unittest.TestCase):
     def tearDown(self):
         self.db.deleteAllTells()
     
-class DbAccessThingiverseTest(unittest.TestCase):
-    
-    def setUp(self):
-        config = configparser.ConfigParser()
-        results = config.read('gthx.config.local')
-        if not results:
-            raise SystemExit("Failed to read config file 'gthx.config.local'")
-        dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
-        dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
-        dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
-        dbName = config.get('MYSQL','GTHX_MYSQL_DATABASE')
+class SharedTellTest(DbTestCase):
+    """Tells added by another bot sharing the DB
+
+    Not for the memory backend, which can't be shared.
+    """
+
+    def openOther(self):
+        if self.backend == "sqlite":
+            other = SqliteDbAccess(self.db.path)
+        else:
+            other = DbAccess(self.db.dbHost, self.db.dbuser, self.db.dbpassword, self.db.dbname)
+        self.addCleanup(other.close)
+        return other
+
+    def test_tell_from_other_bot_delivered(self):
+        other = self.openOther()
+        self.db.refreshTellRecipients()
+        self.assertFalse(self.db.getTell("shareduser"))
+
+        other.addTell("talker", "shareduser", "from the other bot", False)
+        # Within tellCheckInterval the answer from memory is trusted...
+        self.assertFalse(self.db.hasTell("shareduser"))
+        # ...and after it the DB is checked, with no periodic refresh needed
+        self.db.tellCheckedAt = time.time() - self.db.tellCheckInterval
+        data = AsyncDbAccess(self.db).getTell("shareduser")
+        rows = []
+        data.addCallback(rows.extend)
+        self.assertEqual([row[4] for row in rows], ["from the other bot"])
+        self.assertTrue(self.db.tellsCurrent())
 
-        self.db = DbAccess(dbHost, dbUser, dbPassword, dbName)
+    def tearDown(self):
+        self.db.deleteAllTells()
 
+class DbAccessThingiverseTest(DbTestCase):
     def test_thingiverse_refs(self):
         testItem = 1234
         testTitle = "The most wonderful thing in the world"
@@ -948,23 +1220,21 @@ class DbAccessThingiverseTest(unittest.TestCase):
         self.assertEqual(data[0], 4, "Fourth thingiverse ref returned wrong number of references.")
         self.assertEqual(data[1], testTitle, "Fourth thingiverse ref returned the wrong title.")
         
-    def tearDown(self):
-        self.db.deleteAllThingiverseRefs()
+    def test_thingiverse_stats(self):
+        self.db.addThingiverseRef(1234)
+        self.db.addThingiverseRef(1234)
+        self.db.addThingiverseTitle(1234, "A thing")
+        self.db.addThingiverseRef(5678)
+        self.db.flushRefs()
 
-class DbAccessYoutubeRefTest(unittest.TestCase):
-    
-    def setUp(self):
-        config = configparser.ConfigParser()
-        results = config.read('gthx.config.local')
-        if not results:
-            raise SystemExit("Failed to read config file 'gthx.config.local'")
-        dbHost = config.get('MYSQL','GTHX_MYSQL_HOST')
-        dbUser = config.get('MYSQL','GTHX_MYSQL_USER')
-        dbPassword = config.get('MYSQL','GTHX_MYSQL_PASSWORD')
-        dbName = config.get('MYSQL','GTHX_MYSQL_DATABASE')
+        rows = self.db.stats("thingiverse", "all", "count")
+        self.assertEqual([(str(row["item"]), row["title"], row["count"]) for row in rows], [("1234", "A thing", 2), ("5678", None, 1)])
+        self.assertFalse(self.db.stats("youtube", "recent", "count"))
 
-        self.db = DbAccess(dbHost, dbUser, dbPassword, dbName)
+    def tearDown(self):
+        self.db.deleteAllThingiverseRefs()
 
+class DbAccessYoutubeRefTest(DbTestCase):
     def test_youtube_refs(self):
         testItem = "I7nVrT00ST4"
         testTitle = "Pro Riders Laughing"
@@ -995,6 +1265,1077 @@ class DbAccessYoutubeRefTest(unittest.TestCase):
         self.db.deleteAllYoutubeRefs()
         #print "Skipping youtubeRefs teardown"
 
+# The same tests again on SQLite
+
+class SqliteSeenTest(DbAccessSeenTest):
+    backend = "sqlite"
+
+class SqliteCountUnseenTest(DbAccessCountUnseenTest):
+    backend = "sqlite"
+
+class SqliteSeenBufferTest(DbAccessSeenBufferTest):
+    backend = "sqlite"
+
+class SqliteFactoidTest(DbAccessFactoidTest):
+    backend = "sqlite"
+
+class SqliteTellTest(DbAccessTellTest):
+    backend = "sqlite"
+
+class SqliteSharedTellTest(SharedTellTest):
+    backend = "sqlite"
+
+class SqliteThingiverseTest(DbAccessThingiverseTest):
+    backend = "sqlite"
+
+class SqliteYoutubeRefTest(DbAccessYoutubeRefTest):
+    backend = "sqlite"
+
+# And in memory
+
+class MemorySeenTest(DbAccessSeenTest):
+    backend = "memory"
+
+class MemoryCountUnseenTest(DbAccessCountUnseenTest):
+    backend = "memory"
+
+class MemoryFactoidTest(DbAccessFactoidTest):
+    backend = "memory"
+
+class MemoryTellTest(DbAccessTellTest):
+    backend = "memory"
+
+class MemoryThingiverseTest(DbAccessThingiverseTest):
+    backend = "memory"
+
+class MemoryYoutubeRefTest(DbAccessYoutubeRefTest):
+    backend = "memory"
+
+class DbMigrationsTest(DbTestCase):
+    """Runs on MySQL only; SQLite's schema is created up to date"""
+
+    def execute(self, query, *args):
+        self.db.cur.execute(query, args)
+        self.db.db.commit()
+        return self.db.cur.fetchall()
+
+    def undoUpgradeTo6(self):
+        self.execute("DELETE FROM version WHERE version >= 6")
+        for index in ("name", "name_lookup"):
+            try:
+                self.execute("ALTER TABLE seen DROP INDEX `%s`" % index)
+            except self.db.Error:
+                pass
+        # Put the DB back the way the other tests expect it
+        self.addCleanup(DbMigrations.migrate, self.db)
+
+    def versions(self):
+        return [row[0] for row in self.execute("SELECT version FROM version ORDER BY version")]
+
+    def test_migrate_is_idempotent(self):
+        self.undoUpgradeTo6()
+        latest = DbMigrations.MIGRATIONS[-1][0]
+        self.assertEqual(DbMigrations.migrate(self.db), latest)
+        versions = self.versions()
+        self.assertEqual(versions[-1], latest)
+
+        # Nothing left to do, so nothing is run or recorded again
+        self.assertEqual(DbMigrations.migrate(self.db), latest)
+        self.assertEqual(self.versions(), versions)
+        self.assertTrue(self.execute("SHOW INDEX FROM seen WHERE Key_name = 'name' AND Non_unique = 0"))
+        self.assertFalse(self.execute("SHOW INDEX FROM seen WHERE Key_name = 'name_lookup'"))
+
+    def test_interrupted_upgrade_resumes(self):
+        # The index was added but the version wasn't recorded
+        self.execute("DELETE FROM version WHERE version >= 6")
+        self.addCleanup(DbMigrations.migrate, self.db)
+        self.assertEqual(DbMigrations.migrate(self.db), DbMigrations.MIGRATIONS[-1][0])
+
+    def test_duplicate_seen_keeps_newest(self):
+        self.undoUpgradeTo6()
+        self.addCleanup(self.execute, "DELETE FROM seen WHERE name IN ('dupuser', 'tieuser')")
+        # updateSeen() kept rewriting the first row, so the newest data has the lowest id
+        for timestamp, message in (("2020-03-01 12:00:00", "newest"), ("2020-01-01 12:00:00", "stale"), (None, "no time")):
+            self.execute("INSERT INTO seen (name, channel, timestamp, message) VALUES ('dupuser', '#reprap', %s, %s)", timestamp, message)
+        for message in ("first", "second"):
+            self.execute("INSERT INTO seen (name, channel, timestamp, message) VALUES ('tieuser', '#reprap', '2020-01-01 12:00:00', %s)", message)
+
+        DbMigrations.migrate(self.db)
+
+        self.assertEqual(self.execute("SELECT message FROM seen WHERE name='dupuser'"), (("newest",),))
+        self.assertEqual(self.execute("SELECT message FROM seen WHERE name='tieuser'"), (("second",),))
+
+class FakeMigrationCursor():
+    """Fails the first few ALTERs with the given MySQL error codes, or None for success"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.executed = []
+
+    def execute(self, query, args=None):
+        self.executed.append(query)
+        if query.startswith("ALTER") and self.errors:
+            error = self.errors.pop(0)
+            if error:
+                raise DbAccess.Error(error, "fake error")
+
+    def fetchall(self):
+        return ()
+
+class FakeMigrationDb():
+    Error = DbAccess.Error
+
+    def __init__(self, errors=()):
+        self.cur = FakeMigrationCursor(errors)
+
+class AddIndexTest(unittest.TestCase):
+    def setUp(self):
+        delay = DbMigrations.LOCK_RETRY_DELAY
+        DbMigrations.LOCK_RETRY_DELAY = 0
+        self.addCleanup(setattr, DbMigrations, "LOCK_RETRY_DELAY", delay)
+
+    def alters(self, db):
+        return [query for query in db.cur.executed if query.startswith("ALTER")]
+
+    def test_retries_lock_wait_timeout(self):
+        db = FakeMigrationDb([DbMigrations.ER_LOCK_WAIT_TIMEOUT] * 2)
+        DbMigrations.addIndex(db, "tell", "INDEX `recipient` (`recipient`)")
+        self.assertEqual(len(self.alters(db)), 3)
+
+    def test_gives_up_after_retries(self):
+        db = FakeMigrationDb([DbMigrations.ER_LOCK_WAIT_TIMEOUT] * DbMigrations.LOCK_RETRIES)
+        with self.assertRaises(DbAccess.Error):
+            DbMigrations.addIndex(db, "tell", "INDEX `recipient` (`recipient`)")
+        self.assertEqual(len(self.alters(db)), DbMigrations.LOCK_RETRIES)
+
+    def test_existing_index_skipped(self):
+        db = FakeMigrationDb([DbMigrations.ER_DUP_KEYNAME])
+        DbMigrations.addIndex(db, "tell", "INDEX `recipient` (`recipient`)")
+        self.assertEqual(len(self.alters(db)), 1)
+
+    def test_unique_seen_index_retries_new_duplicates(self):
+        # Another bot adds a duplicate between the cleanup and the ALTER
+        db = FakeMigrationDb([None, DbMigrations.ER_DUP_ENTRY])
+        DbMigrations.addUniqueSeenName(db)
+        alters = self.alters(db)
+        self.assertEqual(len(alters), 4)
+        self.assertIn("UNIQUE", alters[2])
+        self.assertIn("DROP INDEX `name_lookup`", alters[3])
+        cleanups = [query for query in db.cur.executed if "HAVING COUNT(*) > 1" in query]
+        self.assertEqual(len(cleanups), 2)
+
+class CommandRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.called = []
+        self.router = CommandRouter()
+        self.router.addExact("status?", self.handler("status", True))
+        self.router.addKeyword("seen", "\\s*seen\\s+(\\w+)", self.handler("seen", True))
+        self.router.addPattern("query", "(.+)[?!]$", self.handler("query", False))
+        self.router.addKeyword("info", "info (.*)", self.handler("info", False))
+        self.router.addPattern("link", "http://(\\S+)", self.handler("link", False), search=True)
+
+    def handler(self, name, handled):
+        def call(m, context):
+            self.called.append((name, m.group(1) if m else None, context))
+            return handled
+        return call
+
+    def test_exact_command(self):
+        self.assertTrue(self.router.route("status?", "ctx"))
+        self.assertEqual(self.called, [("status", None, "ctx")])
+
+    def test_handled_command_stops_routing(self):
+        # "status?" also matches the query pattern, but status handled it
+        self.router.route("status?", None)
+        self.assertEqual([call[0] for call in self.called], ["status"])
+
+    def test_keyword_needs_pattern_match(self):
+        self.assertFalse(self.router.route("seen", None))
+        self.assertFalse(self.router.route("seenbob", None))
+        self.assertTrue(self.router.route("  seen bob", None))
+        self.assertEqual(self.called, [("seen", "bob", None)])
+
+    def test_unhandled_commands_fall_through_in_order(self):
+        self.assertFalse(self.router.route("info http://example.com!", None))
+        self.assertEqual([call[0] for call in self.called], ["query", "info", "link"])
+        self.assertEqual(self.called[2][1], "example.com!")
+
+    def test_no_commands(self):
+        self.assertFalse(self.router.route("just chatting", None))
+        self.assertEqual(self.called, [])
+
+class OutputQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.queue = OutputQueue(self.sent.append, self.clock, rate=2.0, burst=3)
+
+    def test_burst_then_rate(self):
+        for i in range(6):
+            self.queue.put("line %d" % i, "#chan")
+        self.assertEqual(len(self.sent), 3, "The burst wasn't sent straight away")
+        self.assertEqual(self.queue.depth, 3)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.sent), 4)
+        self.clock.advance(1.0)
+        self.assertEqual(self.sent, ["line %d" % i for i in range(6)])
+        self.assertEqual(self.queue.depth, 0)
+        self.assertEqual(self.queue.maxDepth, 3)
+
+    def test_priorities(self):
+        for i in range(3):
+            self.queue.put("filler", "#chan")
+        self.queue.put("title", "#chan", TITLE)
+        self.queue.put("tell", "#chan", TELL)
+        self.queue.put("reply", "#chan", REPLY)
+        self.queue.put("PONG", None, CONTROL)
+        self.assertEqual(self.queue.depths(), {"control": 1, "reply": 1, "tell": 1, "title": 1})
+        self.clock.pump([0.5] * 4)
+        self.assertEqual(self.sent[3:], ["PONG", "reply", "tell", "title"])
+
+    def test_targets_take_turns(self):
+        for i in range(3):
+            self.queue.put("filler", "#chan")
+        for i in range(3):
+            self.queue.put("long %d" % i, "#busy")
+        self.queue.put("short", "#quiet")
+        self.clock.pump([0.5] * 4)
+        self.assertEqual(self.sent[3:], ["long 0", "short", "long 1", "long 2"])
+
+    def test_clear(self):
+        for i in range(5):
+            self.queue.put("line %d" % i, "#chan")
+        self.queue.clear()
+        self.clock.advance(10)
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class FakeReactor(task.Clock):
+    """A Clock that AsyncDbAccess can use as its reactor"""
+
+    def callWhenRunning(self, f, *args, **kwargs):
+        pass
+
+    def addSystemEventTrigger(self, phase, event, f, *args, **kwargs):
+        pass
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+class FakeThreadPool():
+    """Holds calls until the test runs them with runAll()"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.jobs.append((onResult, f, args, kwargs))
+
+    def runAll(self):
+        while self.jobs:
+            onResult, f, args, kwargs = self.jobs.pop(0)
+            try:
+                result = f(*args, **kwargs)
+            except Exception:
+                onResult(False, Failure())
+            else:
+                onResult(True, result)
+
+    def stop(self):
+        pass
+
+class FakeDb():
+    """Records the calls AsyncDbAccess makes, and can be taken down"""
+    minRetryDelay = 5
+
+    def __init__(self, seenFlushSize=3):
+        self.seenFlushSize = seenFlushSize
+        self.pendingSeen = []
+        self.calls = []
+        self.up = True
+
+    def call(self, name):
+        self.calls.append(name)
+        if not self.up:
+            raise DbUnavailable("The DB is down")
+
+    def bufferSeen(self, nick, channel, message):
+        self.pendingSeen.append(nick)
+        return len(self.pendingSeen) >= self.seenFlushSize
+
+    def flushSeen(self):
+        self.call("flushSeen")
+        self.pendingSeen = []
+        return True
+
+    def seen(self, nick):
+        self.call("seen")
+        return ()
+
+    def reconnect(self):
+        self.call("reconnect")
+
+    def flush(self):
+        self.call("flush")
+        return True
+
+    def retryIn(self):
+        return 0
+
+    def close(self):
+        pass
+
+class AsyncDbAccessTest(trial.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.db = FakeDb()
+        self.asyncDb = AsyncDbAccess(self.db, self.reactor, maxPending=2)
+        self.pool = self.asyncDb.threadPool = FakeThreadPool()
+
+    def test_seen_updates_buffered_inline(self):
+        for i in range(2):
+            self.assertTrue(self.asyncDb.updateSeen("user%d" % i, "#reprap", "hi").called)
+        self.assertEqual(self.pool.jobs, [])
+
+        # Once the buffer's full, one flush goes to a worker however many
+        # more updates arrive before it runs
+        self.asyncDb.updateSeen("user2", "#reprap", "hi")
+        self.asyncDb.updateSeen("user3", "#reprap", "hi")
+        self.assertEqual(len(self.pool.jobs), 1)
+        self.pool.runAll()
+        self.assertEqual(self.db.calls, ["flushSeen"])
+        self.assertEqual(self.asyncDb.pending, 0)
+
+        for i in range(3):
+            self.asyncDb.updateSeen("user%d" % i, "#reprap", "hi")
+        self.assertEqual(len(self.pool.jobs), 1)
+
+    def test_seen_updates_not_limited_by_max_pending(self):
+        self.asyncDb.seen("someone")
+        self.asyncDb.seen("someone")
+        for i in range(2):
+            self.assertTrue(self.asyncDb.updateSeen("user%d" % i, "#reprap", "hi").called)
+        self.assertEqual(self.db.pendingSeen, ["user0", "user1"])
+
+    def test_overflow_rejected(self):
+        self.asyncDb.seen("one")
+        self.asyncDb.seen("two")
+        d = self.asyncDb.seen("three")
+        self.failureResultOf(d, DbUnavailable)
+        self.assertEqual(len(self.pool.jobs), 2)
+
+        # Room again once the workers catch up
+        self.pool.runAll()
+        self.assertEqual(self.asyncDb.pending, 0)
+        d = self.asyncDb.seen("four")
+        self.pool.runAll()
+        self.assertEqual(self.successResultOf(d), ())
+
+    def test_unavailable_schedules_one_reconnect(self):
+        self.db.up = False
+        first = self.asyncDb.seen("one")
+        second = self.asyncDb.seen("two")
+        self.pool.runAll()
+        self.failureResultOf(first, DbUnavailable)
+        self.failureResultOf(second, DbUnavailable)
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+        # Still down, so the failed attempt schedules the next one
+        self.reactor.advance(self.db.minRetryDelay)
+        self.pool.runAll()
+        self.assertEqual(self.db.calls, ["seen", "seen", "reconnect"])
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+    def test_reconnect_retried_when_pool_full(self):
+        self.db.up = False
+        d = self.asyncDb.seen("one")
+        self.pool.runAll()
+        self.failureResultOf(d, DbUnavailable)
+
+        # The workers are all busy when the retry comes round
+        self.asyncDb.pending = self.asyncDb.maxPending
+        self.reactor.advance(self.db.minRetryDelay)
+        self.assertEqual(self.db.calls, ["seen"])
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+        self.asyncDb.pending = 0
+        self.db.up = True
+        self.reactor.advance(self.db.minRetryDelay)
+        self.pool.runAll()
+        self.assertEqual(self.db.calls, ["seen", "reconnect", "flush"])
+
+    def test_reconnect_flushes(self):
+        self.db.up = False
+        d = self.asyncDb.seen("one")
+        self.pool.runAll()
+        self.failureResultOf(d, DbUnavailable)
+
+        self.db.up = True
+        self.reactor.advance(self.db.minRetryDelay)
+        self.pool.runAll()
+        self.assertEqual(self.db.calls, ["seen", "reconnect", "flush"])
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+class LurkersTest(unittest.TestCase):
+    def setUp(self):
+        self.db = MemoryDbAccess()
+        self.bot, self.transport = benchmark.makeBot(self.db)
+        self.asyncDb = AsyncDbAccess(self.db, FakeReactor(), maxPending=100)
+        self.pool = self.asyncDb.threadPool = FakeThreadPool()
+        self.bot.db = self.asyncDb
+
+    def askForLurkers(self, nicks):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.bot.privmsg("asker!~asker@example.com", benchmark.CHANNEL, "lurkers?")
+            self.transport.clear()
+            for start in range(0, len(nicks), 50):
+                self.bot.irc_unknown("server", "RPL_NAMREPLY", ["gthx", "=", benchmark.CHANNEL, " ".join(nicks[start:start + 50])])
+            self.bot.irc_unknown("server", "RPL_ENDOFNAMES", ["gthx", benchmark.CHANNEL, "End of /NAMES list."])
+            self.pool.runAll()
+        return self.transport.value().decode("utf-8")
+
+    def test_more_nicks_than_max_pending(self):
+        for i in range(30):
+            self.db.updateSeen("user%d" % i, benchmark.CHANNEL, "hi")
+        nicks = ["@user0", "+user1"] + ["user%d" % i for i in range(2, 150)]
+        reply = self.askForLurkers(nicks)
+        self.assertIn("120 of the 150 users in %s right now have never said anything." % benchmark.CHANNEL, reply)
+        self.assertEqual(self.asyncDb.pending, 0)
+
+    def test_count_unavailable(self):
+        self.asyncDb.pending = self.asyncDb.maxPending
+        reply = self.askForLurkers(["user1", "user2"])
+        self.assertIn("can't count the lurkers", reply)
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+
+    def fetch(self, key):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+    def test_concurrent_callers_share_one_call(self):
+        results = []
+        for i in range(3):
+            self.flights.run("key", self.fetch, "key").addCallback(results.append)
+        self.assertEqual(len(self.calls), 1)
+        self.calls[0].callback("title")
+        self.assertEqual(results, ["title"] * 3)
+
+        # Once it's finished, the next caller starts a new call
+        self.flights.run("key", self.fetch, "key")
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failure_goes_to_every_caller(self):
+        failures = []
+        for i in range(2):
+            self.flights.run("key", self.fetch, "key").addErrback(failures.append)
+        self.calls[0].errback(ValueError("boom"))
+        self.assertEqual([failure.check(ValueError) for failure in failures], [ValueError, ValueError])
+
+    def test_synchronous_result(self):
+        results = []
+        self.flights.run("key", lambda: "now").addCallback(results.append)
+        self.assertEqual(results, ["now"])
+        self.assertEqual(self.flights.pending, {})
+
+class StubHttpClient():
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, receive):
+        d = defer.Deferred()
+        self.requests.append((url, d))
+        return d
+
+class UrlResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.http = StubHttpClient()
+        self.resolver = UrlResolver(self.http, ttl=3600, failureTtl=300, clock=lambda: self.now)
+        self.thingiverse, self.youtube = SITES
+        self.saved = []
+
+    def resolve(self, site, itemId):
+        results = []
+        self.resolver.resolve(site, itemId, self.saved.append).addCallback(results.append)
+        return results
+
+    def test_site_ids(self):
+        match = re.search(self.youtube.pattern, "see https://youtu.be/dQw4w9WgXcQ?t=3", re.IGNORECASE)
+        self.assertEqual(self.youtube.itemId(match), "dQw4w9WgXcQ")
+        self.assertEqual(self.youtube.pageUrl("dQw4w9WgXcQ"), "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+        match = re.search(self.thingiverse.pattern, "http://www.thingiverse.com/thing:1234")
+        self.assertEqual(self.thingiverse.itemId(match), 1234)
+        self.assertTrue(self.youtube.matches("https://www.youtube.com/watch?v=abc"))
+        self.assertFalse(self.youtube.matches("https://example.com/"))
+        self.assertEqual(self.youtube.cleanTitle("Some video - YouTube"), "Some video")
+        self.assertEqual(Site().cleanTitle("A - B"), "A - B")
+
+    def test_public_urls(self):
+        self.assertTrue(isPublicUrl("https://example.com/page"))
+        self.assertTrue(isPublicUrl("http://8.8.8.8/"))
+        for url in ("http://localhost:8080/", "http://printer.local/", "http://127.0.0.1/",
+                    "http://10.1.2.3/", "http://192.168.0.1/", "http://[::1]/", "http://169.254.169.254/"):
+            self.assertFalse(isPublicUrl(url), url)
+
+    def test_title_is_cached(self):
+        results = self.resolve(self.youtube, "abc")
+        self.assertEqual(len(self.http.requests), 1)
+        self.http.requests[0][1].callback("A video - YouTube")
+        self.assertEqual(results, ["A video"])
+        self.assertEqual(self.saved, ["A video"])
+
+        self.now = self.now + 3599
+        self.assertEqual(self.resolve(self.youtube, "abc"), ["A video"])
+        self.assertEqual(len(self.http.requests), 1)
+
+        self.now = self.now + 2
+        self.resolve(self.youtube, "abc")
+        self.assertEqual(len(self.http.requests), 2)
+
+    def test_failure_is_cached_briefly(self):
+        results = self.resolve(self.youtube, "abc")
+        self.http.requests[0][1].errback(ValueError("connection refused"))
+        self.assertEqual(results, [None])
+        self.assertEqual(self.saved, [])
+
+        self.now = self.now + 299
+        self.assertEqual(self.resolve(self.youtube, "abc"), [None])
+        self.assertEqual(len(self.http.requests), 1)
+
+        self.now = self.now + 2
+        self.resolve(self.youtube, "abc")
+        self.assertEqual(len(self.http.requests), 2)
+
+    def test_concurrent_lookups_fetch_once(self):
+        results = [self.resolve(self.thingiverse, 77) for i in range(3)]
+        self.assertEqual(len(self.http.requests), 1)
+        self.http.requests[0][1].callback("Bracket - Thingiverse")
+        self.assertEqual(results, [["Bracket"]] * 3)
+        self.assertEqual(self.saved, ["Bracket"])
+
+    def test_private_links_are_not_fetched(self):
+        self.assertEqual(self.resolve(Site(), "http://10.0.0.1/admin"), [None])
+        self.assertEqual(self.http.requests, [])
+
+class StandInSmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections = server.connections + 1
+            server.open.append(self.connection)
+        self.reply("220 stand-in ESMTP")
+        for line in self.rfile:
+            command = line.decode("ascii").strip().upper()
+            if command.startswith("EHLO"):
+                self.reply("250-stand-in")
+                self.reply("250 AUTH PLAIN")
+            elif command.startswith("AUTH"):
+                with server.lock:
+                    server.logins = server.logins + 1
+                self.reply("235 Authenticated")
+            elif command == "DATA":
+                self.reply("354 Go ahead")
+                message = b""
+                for line in self.rfile:
+                    if line == b".\r\n":
+                        break
+                    message = message + line
+                with server.lock:
+                    server.messages.append(message.decode("utf-8"))
+                self.reply("250 Queued")
+            elif command == "QUIT":
+                with server.lock:
+                    server.quits = server.quits + 1
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply("250 OK")
+
+class StandInSmtpServer(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server to count sessions, logins and messages"""
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), StandInSmtpHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.logins = 0
+        self.quits = 0
+        self.messages = []
+        self.open = []
+
+    def dropSessions(self):
+        with self.lock:
+            for connection in self.open:
+                connection.shutdown(socket.SHUT_RDWR)
+            self.open = []
+
+class EmailTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInSmtpServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def makeEmail(self, **kwargs):
+        address = "127.0.0.1:%d" % self.server.server_address[1]
+        email = Email("user", "password", "bot@example.com", "owner@example.com", address, useSsl=False, **kwargs)
+        self.addCleanup(email.close, 5)
+        return email
+
+    def waitFor(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline, "Timed out waiting for the SMTP stand-in")
+            time.sleep(0.01)
+
+    def test_emails_share_one_session(self):
+        email = self.makeEmail()
+        for i in range(3):
+            self.assertTrue(email.send("status", "message %d" % i))
+        email.close(5)
+        self.assertEqual((self.server.connections, self.server.logins, self.server.quits), (1, 1, 1))
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertIn("Subject: status", self.server.messages[0])
+        self.assertIn("message 2", self.server.messages[2])
+
+    def test_reconnects_after_server_drops_session(self):
+        email = self.makeEmail()
+        email.send("first", "one")
+        self.waitFor(lambda: len(self.server.messages) == 1)
+        self.server.dropSessions()
+        email.send("second", "two")
+        email.close(5)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertIn("Subject: second", self.server.messages[1])
+
+    def test_idle_session_is_closed(self):
+        email = self.makeEmail(idleTimeout=0.05)
+        email.send("status", "message")
+        self.waitFor(lambda: self.server.quits == 1)
+        email.send("status", "another")
+        email.close(5)
+        self.assertEqual((self.server.connections, len(self.server.messages)), (2, 2))
+
+    def test_full_queue_drops_emails(self):
+        email = self.makeEmail(maxQueued=2)
+        # Hold the worker back so the queue fills up
+        email.startWorker = lambda: None
+        self.assertEqual([email.send("status", str(i)) for i in range(3)], [True, True, False])
+
+    def test_unconfigured_email_is_not_sent(self):
+        email = Email(None, None, None, None, None)
+        self.assertFalse(email.send("status", "message"))
+        self.assertIsNone(email.worker)
+
+class RecordingEmail():
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, subject, message):
+        self.sent.append((subject, message))
+        return True
+
+    def close(self, timeout=30):
+        self.closed = True
+
+class NotifierTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.email = RecordingEmail()
+        self.notifier = Notifier(self.email, self.clock, window=60, subjectInterval=300, maxLines=3)
+
+    def test_window_is_sent_as_one_digest(self):
+        self.notifier.send("gthx status", "gthx2 has left channel #a")
+        self.notifier.send("gthx status", "gthx2 has left channel #b")
+        self.notifier.send("gthx disconnected", "gthx is disconnected")
+        self.clock.advance(59)
+        self.assertEqual(self.email.sent, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.email.sent), 1)
+        subject, body = self.email.sent[0]
+        self.assertEqual(subject, "gthx status, gthx disconnected")
+        self.assertEqual(body.splitlines(), ["gthx status:", "gthx2 has left channel #a", "gthx2 has left channel #b", "",
+                                             "gthx disconnected:", "gthx is disconnected"])
+
+    def test_repeats_are_counted(self):
+        for i in range(3):
+            self.notifier.send("gthx status", "gthx2 has joined channel #a")
+            self.notifier.send("gthx status", "gthx2 has left channel #a")
+        self.clock.advance(60)
+        lines = self.email.sent[0][1].splitlines()
+        self.assertEqual(lines[1:4], ["gthx2 has joined channel #a (x3)", "gthx2 has left channel #a (x3)",
+                                      "(4 repeated or older notifications suppressed)"])
+
+    def test_only_latest_lines_are_kept(self):
+        for i in range(5):
+            self.notifier.send("gthx status", "event %d" % i)
+        self.clock.advance(60)
+        lines = self.email.sent[0][1].splitlines()
+        self.assertEqual(lines[1:5], ["event 2", "event 3", "event 4", "(2 repeated or older notifications suppressed)"])
+
+    def test_subject_is_rate_limited(self):
+        self.notifier.send("gthx status", "first")
+        self.clock.advance(60)
+        self.notifier.send("gthx status", "second")
+        self.notifier.send("gthx connected", "joined #a")
+        self.clock.advance(60)
+        # The other subject goes out in the next window, this one waits
+        self.assertEqual([subject for subject, body in self.email.sent], ["gthx status", "gthx connected"])
+        self.clock.advance(239)
+        self.assertEqual(len(self.email.sent), 2)
+        self.clock.advance(1)
+        self.assertEqual(self.email.sent[2], ("gthx status", "gthx status:\nsecond\n"))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_close_sends_everything(self):
+        self.notifier.send("gthx status", "first")
+        self.clock.advance(60)
+        self.notifier.send("gthx status", "second")
+        self.notifier.close()
+        self.assertEqual(len(self.email.sent), 2)
+        self.assertTrue(self.email.closed)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class PresenceTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.lines = []
+        self.changes = []
+        self.presence = Presence("kthx", self.lines.append, self.clock, lambda online, reason: self.changes.append((online, reason)), pollInterval=60)
+
+    def test_monitor(self):
+        self.presence.start(True)
+        self.assertEqual(self.lines, ["MONITOR + kthx"])
+        self.presence.gotMonitor("730", "other!o@host,KTHX!k@host")
+        self.clock.advance(500)
+        self.presence.gotMonitor("731", "kthx")
+        self.presence.gotMonitor("731", "kthx")
+        self.assertEqual(self.changes, [(True, "MONITOR"), (False, "MONITOR")])
+        # Pushed, so noticed straight away
+        self.assertEqual(self.presence.outages[-1].detectedIn, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_ison_polling(self):
+        self.presence.start(False)
+        self.assertEqual(self.lines, ["ISON kthx"])
+        self.presence.gotIson("someone kthx")
+        self.clock.advance(60)
+        self.presence.gotIson("kthx")
+        self.clock.advance(30)
+        self.presence.update(True, "spoke in #a")
+        self.clock.advance(30)
+        self.assertEqual(self.lines, ["ISON kthx"] * 3)
+        self.presence.gotIson("")
+        self.assertEqual(self.changes, [(True, "ISON poll"), (False, "ISON poll")])
+        # It could have gone any time since it last spoke
+        self.assertEqual(self.presence.outages[-1].detectedIn, 30)
+        self.presence.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_full_monitor_list_falls_back_to_ison(self):
+        self.presence.start(True)
+        self.presence.gotMonitor("734", "kthx")
+        self.assertEqual(self.presence.mode, "ison")
+        self.assertEqual(self.lines, ["MONITOR + kthx", "ISON kthx"])
+        self.presence.stop()
+
+    def test_outages(self):
+        self.presence.update(True, "joined #a")
+        self.clock.advance(10)
+        self.presence.update(False, "quit: Ping timeout")
+        self.clock.advance(90)
+        self.presence.update(True, "renamed from kthx_")
+        outage = self.presence.outages[-1]
+        self.assertEqual((outage.start, outage.end, outage.reason), (10, 100, "quit: Ping timeout"))
+        self.assertIn("1 outages, last noticed in 0s via quit: Ping timeout and lasted 90s", self.presence.statsString())
+
+class ProberTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.changes = []
+        self.prober = Prober("reprap?", self.sent.append, self.clock, lambda responsive, reason: self.changes.append(responsive),
+                             interval=60, timeout=10, maxMisses=2)
+        self.addCleanup(self.prober.stop)
+
+    def test_answers_keep_it_responsive(self):
+        self.prober.start()
+        self.clock.advance(2)
+        self.prober.alive()
+        self.clock.advance(58)
+        self.clock.advance(3)
+        self.prober.alive()
+        self.assertEqual(self.sent, ["reprap?"] * 2)
+        self.assertEqual(self.changes, [])
+        self.assertEqual((self.prober.lastLatency, self.prober.maxLatency), (3, 3))
+
+    def test_missed_probes_mark_it_unresponsive(self):
+        self.prober.start()
+        self.clock.advance(10)
+        self.assertEqual(self.changes, [])
+        self.clock.advance(50)
+        self.clock.advance(10)
+        self.assertEqual(self.changes, [False])
+        self.assertFalse(self.prober.responsive)
+        # Saying anything at all brings it back
+        self.prober.alive()
+        self.assertEqual(self.changes, [False, True])
+        self.assertEqual(self.prober.lapses, 1)
+
+    def test_slow_probe_isnt_repeated(self):
+        prober = Prober("reprap?", self.sent.append, self.clock, self.changes.append, interval=5, timeout=10)
+        prober.start()
+        self.clock.advance(5)
+        self.assertEqual(self.sent, ["reprap?"])
+        prober.stop()
+        self.assertTrue(prober.responsive)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class FactoidSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sync = FactoidSync(self.clock, maxWait=30)
+
+    def test_answer_to_question(self):
+        self.sync.asked("#reprap", "RAMPS", "alice")
+        self.assertEqual(self.sync.answered("#reprap", "ramps is a board and is also a pain to wire"),
+                         ("RAMPS", [(False, "a board"), (False, "a pain to wire")]))
+        # Only once per question
+        self.assertIsNone(self.sync.answered("#reprap", "ramps is a board"))
+
+    def test_addressed_and_plural_answers(self):
+        self.sync.asked("#reprap", "extruders", "alice")
+        self.assertEqual(self.sync.answered("#reprap", "bob, extruders are hot and are also messy"),
+                         ("extruders", [(True, "hot"), (True, "messy")]))
+
+    def test_unrelated_lines_are_ignored(self):
+        self.sync.asked("#reprap", "ramps", "alice")
+        self.assertIsNone(self.sync.answered("#other", "ramps is a board"))
+        self.assertIsNone(self.sync.answered("#reprap", "the weather is nice"))
+        self.assertIsNone(self.sync.answered("#reprap", "I'm not sure what ramps is"))
+
+    def test_old_questions_expire(self):
+        self.sync.asked("#reprap", "ramps", "alice")
+        self.clock.advance(31)
+        self.assertIsNone(self.sync.answered("#reprap", "ramps is a board"))
+
+    def test_personalized_answers_are_skipped(self):
+        self.sync.asked("#reprap", "hello", "alice")
+        self.assertIsNone(self.sync.answered("#reprap", "hello is hi there, alice"))
+        self.sync.asked("#reprap", "hello", "alice")
+        self.assertIsNone(self.sync.answered("#reprap", "hello is welcome to #reprap"))
+
+class StatsResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.db = MemoryDbAccess()
+        self.db.addFactoid("someuser", "petg", False, "a copolyester", False)
+        self.db.getFactoid("petg")
+        self.db.addYoutubeRef("dQw4w9WgXcQ")
+        self.stats = StatsResource(AsyncDbAccess(self.db), cacheTtl=10, clock=lambda: self.now)
+
+    def get(self, **args):
+        request = DummyRequest([b""])
+        for name, value in args.items():
+            request.addArg(name.encode("ascii"), value.encode("utf-8"))
+        self.assertEqual(self.stats.render(request), server.NOT_DONE_YET)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"Content-Type"), [b"text/json"])
+        return json.loads(b"".join(request.written))
+
+    def test_factoids(self):
+        reply = self.get(id="42")
+        self.assertEqual(reply["status"], "success")
+        self.assertEqual(reply["id"], "42")
+        self.assertEqual([(row["item"], row["value"], row["count"]) for row in reply["data"]], [("petg", "a copolyester", 1)])
+
+        reply = self.get(type="youtube", range="recent", order="date")
+        self.assertEqual([row["item"] for row in reply["data"]], ["dQw4w9WgXcQ"])
+
+    def test_invalid_arguments(self):
+        request = DummyRequest([b""])
+        request.addArg(b"type", b"users")
+        reply = json.loads(self.stats.render(request))
+        self.assertEqual(reply, {"status": "failure", "reason": "Invalid type 'users'"})
+        self.assertEqual(self.stats.dbQueries, 0)
+
+    def test_results_cached(self):
+        self.get()
+        self.db.getFactoid("petg")
+        self.assertEqual(self.get()["data"][0]["count"], 1)
+        self.assertEqual(self.stats.dbQueries, 1)
+
+        self.now += 11
+        self.assertEqual(self.get()["data"][0]["count"], 2)
+        self.assertEqual(self.stats.dbQueries, 2)
+        self.assertEqual(self.stats.requests, 3)
+
+class FakeBodyTransport():
+    def __init__(self):
+        self.stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+class TitleExtractorTest(unittest.TestCase):
+    def extract(self, chunks, contentType=None, maxBytes=MAX_TITLE_BYTES, length=None):
+        results = []
+        self.transport = FakeBodyTransport()
+        extractor = TitleExtractor(defer.Deferred().addCallback(results.append), contentType, maxBytes, length)
+        extractor.makeConnection(self.transport)
+        for chunk in chunks:
+            extractor.dataReceived(chunk)
+        extractor.connectionLost(None)
+        self.assertEqual(len(results), 1, "finished didn't fire exactly once")
+        return results[0]
+
+    def test_title_split_across_chunks_and_lines(self):
+        page = b"<html><head><TITLE lang='en'>Prusa i3\n  MK3 &amp; friends - YouTube</TITLE></head><body>"
+        for size in (1, 3, 7, len(page)):
+            chunks = [page[i:i + size] for i in range(0, len(page), size)]
+            self.assertEqual(self.extract(chunks), "Prusa i3 MK3 & friends - YouTube")
+
+    def test_stops_reading_at_end_of_title(self):
+        self.assertEqual(self.extract([b"<title>Found</title>", b"x" * 1000]), "Found")
+        self.assertTrue(self.transport.stopped, "Kept reading after the title")
+
+    def test_short_page_is_read_to_the_end(self):
+        # So the connection can be reused
+        self.assertEqual(self.extract([b"<title>Found</title>", b"x" * 1000], length=1020), "Found")
+        self.assertFalse(self.transport.stopped, "Stopped a download that was nearly done")
+        self.extract([b"<title>Found</title>", b"x" * 1000], length=10 * 1024 * 1024)
+        self.assertTrue(self.transport.stopped, "Kept reading a long page after the title")
+
+    def test_byte_budget(self):
+        chunks = [b"<script>" + b"x" * 1000] * 10 + [b"<title>Too late</title>"]
+        self.assertIsNone(self.extract(chunks, maxBytes=4096))
+        self.assertTrue(self.transport.stopped, "Kept reading past the byte budget")
+
+    def test_no_title(self):
+        self.assertIsNone(self.extract([b"<html><body>Nothing here</body></html>"]))
+        self.assertIsNone(self.extract([b"<title>   </title>"]))
+
+    def test_charset_from_header(self):
+        page = "<title>Caf\u00e9</title>".encode("latin-1")
+        self.assertEqual(self.extract([page], b"text/html; charset=ISO-8859-1"), "Caf\u00e9")
+
+    def test_charset_from_meta(self):
+        page = "<meta charset=\"windows-1252\"><title>\u201cQuoted\u201d</title>".encode("windows-1252")
+        self.assertEqual(self.extract([page], b"text/html"), "\u201cQuoted\u201d")
+
+    def test_utf8_by_default(self):
+        self.assertEqual(self.extract(["<title>\U0001f430 Lover</title>".encode("utf-8")]), "\U0001f430 Lover")
+
+class StandInResource(resource.Resource):
+    """A local web server for HttpClientTest. /hold doesn't answer until told to."""
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.paths = []
+        self.clientPorts = []
+        self.held = []
+        self.holdArrived = None
+
+    def render_GET(self, request):
+        self.paths.append(request.path)
+        self.clientPorts.append(request.getClientAddress().port)
+        if request.path == b"/hold":
+            self.held.append(request)
+            if self.holdArrived:
+                d, self.holdArrived = self.holdArrived, None
+                d.callback(request)
+            return server.NOT_DONE_YET
+        return b"<html><head><title>Stand-in page</title></head></html>"
+
+    def waitForHold(self):
+        self.holdArrived = defer.Deferred()
+        return self.holdArrived
+
+class HttpClientTest(trial.TestCase):
+    def setUp(self):
+        self.resource = StandInResource()
+        self.port = reactor.listenTCP(0, server.Site(self.resource), interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+
+    def makeClient(self, **kwargs):
+        client = HttpClient(reactor, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def url(self, path, host="127.0.0.1"):
+        return "http://%s:%d%s" % (host, self.port.getHost().port, path)
+
+    def release(self, request):
+        request.write(b"released")
+        request.finish()
+
+    @defer.inlineCallbacks
+    def test_connection_is_reused(self):
+        client = self.makeClient()
+        first = yield client.get(self.url("/one"), readBody)
+        second = yield client.get(self.url("/two"), readBody)
+        self.assertIn(b"Stand-in page", first)
+        self.assertEqual(first, second)
+        self.assertEqual(len(set(self.resource.clientPorts)), 1, "The second request opened a new connection")
+
+    @defer.inlineCallbacks
+    def test_read_title(self):
+        client = self.makeClient()
+        title = yield client.get(self.url("/page"), readTitle)
+        self.assertEqual(title, "Stand-in page")
+        # Give the rest of the response time to arrive
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        title = yield client.get(self.url("/page"), readTitle)
+        self.assertEqual(len(set(self.resource.clientPorts)), 1, "Reading the title stopped the connection being reused")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        client = self.makeClient(timeout=0.2)
+        held = self.resource.waitForHold()
+        # The server notices when the client gives up
+        held.addCallback(lambda request: request.notifyFinish().addErrback(lambda failure: None))
+        yield self.assertFailure(client.get(self.url("/hold"), readBody), defer.TimeoutError)
+        yield held
+
+    @defer.inlineCallbacks
+    def test_per_host_limit(self):
+        client = self.makeClient(maxPerHost=1)
+        slow = client.get(self.url("/hold"), readBody)
+        request = yield self.resource.waitForHold()
+        fast = client.get(self.url("/fast"), readBody)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(self.resource.paths, [b"/hold"], "A second request went to a host that was at its limit")
+        self.release(request)
+        self.assertEqual((yield slow), b"released")
+        self.assertIn(b"Stand-in page", (yield fast))
+
+    @defer.inlineCallbacks
+    def test_global_limit(self):
+        client = self.makeClient(maxConcurrent=1)
+        slow = client.get(self.url("/hold"), readBody)
+        request = yield self.resource.waitForHold()
+        fast = client.get(self.url("/fast", "localhost"), readBody)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(self.resource.paths, [b"/hold"], "A request started while the client was at its limit")
+        self.release(request)
+        yield slow
+        yield fast
+        self.assertEqual(client.hostSlots, {})
+
 if __name__ == '__main__':
     unittest.main()
     